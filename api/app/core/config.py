@@ -6,7 +6,128 @@ class Settings(BaseSettings):
     algorithm: str = "HS256"
     access_token_expire_minutes: int = 60
     database_url: str = os.getenv("DATABASE_URL", "postgresql://localhost/invisignia")
+    database_async: bool = os.getenv("DATABASE_ASYNC", "false").lower() == "true"
+    db_pool_size: int = int(os.getenv("DB_POOL_SIZE", 10))
+    db_max_overflow: int = int(os.getenv("DB_MAX_OVERFLOW", 20))
+    db_pool_pre_ping: bool = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+    db_pool_recycle: int = int(os.getenv("DB_POOL_RECYCLE", 1800))
+    # Filas por lote al exportar el registro (/history/export/) con cursor del servidor
+    export_chunk_size: int = int(os.getenv("EXPORT_CHUNK_SIZE", 1000))
     environment: str = os.getenv("ENVIRONMENT", "development")
+    # Crear el esquema al arrancar; en producción se desactiva y se ejecuta migrate.py antes
+    auto_migrate: bool = os.getenv("AUTO_MIGRATE", "true").lower() == "true"
+
+    # Arranque: calentar OpenCV/NumPy y el pool con una imagen sintética antes de aceptar peticiones
+    warmup_enabled: bool = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+    warmup_size: int = int(os.getenv("WARMUP_SIZE", 720))  # lado en px: la mitad central debe caber la marca
+    # Workers de serve.py (0 = uno por CPU)
+    web_concurrency: int = int(os.getenv("WEB_CONCURRENCY", 0))
+
+    # Autenticación: caché de usuarios por token y pool dedicado para bcrypt
+    auth_cache_ttl: int = int(os.getenv("AUTH_CACHE_TTL", 300))  # 0 = sin caché
+    auth_cache_max_entries: int = int(os.getenv("AUTH_CACHE_MAX_ENTRIES", 10000))
+    password_hash_workers: int = int(os.getenv("PASSWORD_HASH_WORKERS", 2))
+
+    # Marcar solo sobre los bloques (sin convertir la imagen entera a YCrCb/float)
+    watermark_roi_mode: bool = os.getenv("WATERMARK_ROI_MODE", "true").lower() == "true"
+
+    # Perfil de codificación de salida: png-fast, png-balanced, png-small, webp-lossless, source
+    default_encoding_profile: str = os.getenv("DEFAULT_ENCODING_PROFILE", "png-fast")
+
+    # Preflight de /upload/ y /test/: límites comprobados antes de decodificar
+    max_upload_bytes: int = int(os.getenv("MAX_UPLOAD_BYTES", 50 * 1024 * 1024))
+    max_image_pixels: int = int(os.getenv("MAX_IMAGE_PIXELS", 100_000_000))
+
+    # Reintentos idempotentes de /upload/: cabecera Idempotency-Key o, si se activa, huella del contenido
+    idempotency_cache_ttl: int = int(os.getenv("IDEMPOTENCY_CACHE_TTL", 3600))  # 0 = sin caché
+    # Con directorio, el límite es del directorio entero (compartido por todos los workers)
+    idempotency_cache_max_bytes: int = int(os.getenv("IDEMPOTENCY_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+    idempotency_cache_dir: str = os.getenv("IDEMPOTENCY_CACHE_DIR", "")  # vacío = en memoria
+    idempotency_content_key: bool = os.getenv("IDEMPOTENCY_CONTENT_KEY", "false").lower() == "true"
+
+    # Bits que pueden diferir entre el hash extraído y el registrado en /verify/
+    verify_max_bit_errors: int = int(os.getenv("VERIFY_MAX_BIT_ERRORS", 16))
+    # Supervivencia mínima de la marca en salidas con pérdidas: por debajo ya no se podría
+    # verificar, así que se recodifica sin pérdidas. Por defecto, lo que tolera /verify/
+    min_survival: float = float(os.getenv("MIN_SURVIVAL", 1 - int(os.getenv("VERIFY_MAX_BIT_ERRORS", 16)) / 256))
+
+    # Caché de /verify/ por huella de los bytes y usuario
+    verify_cache_ttl: int = int(os.getenv("VERIFY_CACHE_TTL", 600))  # 0 = sin caché
+    verify_cache_max_entries: int = int(os.getenv("VERIFY_CACHE_MAX_ENTRIES", 10000))
+    # Usuarios con índice de Hamming en memoria; el menos usado se descarta y se recarga de la tabla
+    hash_index_max_users: int = int(os.getenv("HASH_INDEX_MAX_USERS", 1000))
+
+    # Si la rejilla no está donde se puso (recortes, bordes, reescalado), buscarla
+    verify_sync_search: bool = os.getenv("VERIFY_SYNC_SEARCH", "true").lower() == "true"
+    # Escalas que se prueban, en orden; se para al pasar la confianza de corte
+    verify_sync_scales: list = [
+        float(s) for s in os.getenv("VERIFY_SYNC_SCALES", "1.0,0.95,1.05,0.9,1.1").split(",") if s.strip()
+    ]
+    verify_sync_stop_confidence: float = float(os.getenv("VERIFY_SYNC_STOP_CONFIDENCE", 0.8))
+    # Por debajo de esta confianza el hash sincronizado se descarta
+    verify_sync_min_confidence: float = float(os.getenv("VERIFY_SYNC_MIN_CONFIDENCE", 0.3))
+
+    # Ejecución de trabajo CPU (OpenCV/NumPy) fuera del event loop
+    executor_backend: str = os.getenv("EXECUTOR_BACKEND", "process")  # "process" o "thread"
+    executor_workers: int = int(os.getenv("EXECUTOR_WORKERS", os.cpu_count() or 1))
+    executor_max_queue: int = int(os.getenv("EXECUTOR_MAX_QUEUE", 32))
+    executor_task_timeout: float = float(os.getenv("EXECUTOR_TASK_TIMEOUT", 60))
+
+    # Control de admisión de las rutas de imágenes: presupuestos en unidades de coste
+    admission_enabled: bool = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+    admission_unit_pixels: int = int(os.getenv("ADMISSION_UNIT_PIXELS", 4_000_000))  # 1 unidad ≈ 4 MP
+    admission_unit_bytes: int = int(os.getenv("ADMISSION_UNIT_BYTES", 16 * 1024 * 1024))
+    admission_budget: int = int(os.getenv("ADMISSION_BUDGET", 0))  # 0 = 4 por worker del pool
+    admission_user_budget: int = int(os.getenv("ADMISSION_USER_BUDGET", 0))  # 0 = la mitad del global
+    admission_max_wait: float = float(os.getenv("ADMISSION_MAX_WAIT", 10))
+    admission_max_queue: int = int(os.getenv("ADMISSION_MAX_QUEUE", 64))
+    admission_user_max_queue: int = int(os.getenv("ADMISSION_USER_MAX_QUEUE", 8))
+
+    # Lotes de /upload/batch/
+    batch_max_files: int = int(os.getenv("BATCH_MAX_FILES", 500))
+    batch_max_file_bytes: int = int(os.getenv("BATCH_MAX_FILE_BYTES", 50 * 1024 * 1024))
+
+    # Vídeo (/upload/video/, /verify/video/)
+    video_codec: str = os.getenv("VIDEO_CODEC", "ffv1")  # ffv1, mjpeg, mp4v
+    # Lotes de fotogramas marcados a la vez en el pool de procesos (0 = un lote por worker del pool)
+    video_workers: int = int(os.getenv("VIDEO_WORKERS", 0))
+    video_batch_frames: int = int(os.getenv("VIDEO_BATCH_FRAMES", 8))
+    video_verify_samples: int = int(os.getenv("VIDEO_VERIFY_SAMPLES", 9))
+    video_max_bytes: int = int(os.getenv("VIDEO_MAX_BYTES", 500 * 1024 * 1024))
+    video_task_timeout: float = float(os.getenv("VIDEO_TASK_TIMEOUT", 1800))
+
+    # Imágenes grandes y TIFF (/upload/large/, /verify/large/): mapeo en disco y salida por bandas
+    tiled_band_rows: int = int(os.getenv("TILED_BAND_ROWS", 256))
+    tiled_max_bytes: int = int(os.getenv("TILED_MAX_BYTES", 4 * 1024 * 1024 * 1024))
+    tiled_max_pixels: int = int(os.getenv("TILED_MAX_PIXELS", 2_000_000_000))
+    # Límite de cv2.imread (la misma variable que lee OpenCV): se aplica a lo que no se mapea
+    opencv_max_pixels: int = int(os.getenv("OPENCV_IO_MAX_IMAGE_PIXELS", 1 << 30))
+    # Lo que no se mapea se decodifica entero en RAM (3 bytes por píxel): PNG, JPEG,
+    # TIFF comprimidos... Por encima de esto hay que subir un TIFF RGB de 8 bits sin comprimir
+    tiled_decode_max_pixels: int = int(os.getenv("TILED_DECODE_MAX_PIXELS", 100_000_000))
+    tiled_task_timeout: float = float(os.getenv("TILED_TASK_TIMEOUT", 900))
+
+    # Trabajos asíncronos (/jobs/): cola SQLite + ficheros en disco
+    jobs_dir: str = os.getenv("JOBS_DIR", "jobs")
+    jobs_db_path: str = os.getenv("JOBS_DB_PATH", os.path.join(os.getenv("JOBS_DIR", "jobs"), "jobs.db"))
+    jobs_result_ttl: int = int(os.getenv("JOBS_RESULT_TTL", 3600))
+    # Tiempo que se conserva la fila de un trabajo caducado (responde 410) antes de borrarla
+    jobs_expired_retention: int = int(os.getenv("JOBS_EXPIRED_RETENTION", 7 * 24 * 3600))
+    jobs_stale_after: int = int(os.getenv("JOBS_STALE_AFTER", 600))
+    jobs_poll_interval: float = float(os.getenv("JOBS_POLL_INTERVAL", 1.0))
+    jobs_inline_workers: int = int(os.getenv("JOBS_INLINE_WORKERS", 1))  # 0 = solo workers externos
+
+    # Observabilidad: logging estructurado, /metrics y cabeceras Server-Timing
+    log_level: str = os.getenv("LOG_LEVEL", "INFO")
+    log_format: str = os.getenv("LOG_FORMAT", "json")  # "json" o "text"
+    metrics_enabled: bool = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+    # /metrics solo responde con "Authorization: Bearer <METRICS_TOKEN>" o a las IPs/redes
+    # de METRICS_ALLOWED_IPS (por defecto, solo local)
+    metrics_token: str = os.getenv("METRICS_TOKEN", "")
+    metrics_allowed_ips: list = [
+        s.strip() for s in os.getenv("METRICS_ALLOWED_IPS", "127.0.0.1,::1").split(",") if s.strip()
+    ]
+    server_timing_enabled: bool = os.getenv("SERVER_TIMING_ENABLED", "true").lower() == "true"
 
     class Config:
         env_file = ".env"
@@ -1,17 +1,146 @@
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from starlette.concurrency import run_in_threadpool
 from app.core.config import settings
 
-engine = create_engine(settings.database_url)
+def _pool_options(url: str) -> dict:
+    """Opciones de pool; SQLite usa sus propios pools y no admite tamaño/overflow"""
+    options = {"pool_pre_ping": settings.db_pool_pre_ping}
+    if not url.startswith("sqlite"):
+        options.update(
+            pool_size=settings.db_pool_size,
+            max_overflow=settings.db_max_overflow,
+            pool_recycle=settings.db_pool_recycle,
+        )
+    return options
+
+# Dialecto -> driver asíncrono (ambos en requirements.txt)
+ASYNC_DRIVERS = {
+    "postgresql": "asyncpg",
+    "sqlite": "aiosqlite",
+}
+
+def async_database_url(url: str) -> str:
+    """Traducir la URL síncrona al driver asíncrono equivalente.
+
+    Sustituye cualquier driver explícito (postgresql+psycopg2, sqlite+pysqlite...)
+    porque create_async_engine no acepta drivers síncronos. asyncpg rechaza el
+    parámetro sslmode de libpq al conectar: se pasa como ssl, con el mismo valor.
+    """
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if backend == "postgres":
+        backend = "postgresql"
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(
+            f"DATABASE_ASYNC no admite el dialecto '{backend}': no hay driver asíncrono "
+            f"configurado (admitidos: {', '.join(ASYNC_DRIVERS)})"
+        )
+    drivername = f"{backend}+{ASYNC_DRIVERS[backend]}"
+    parsed = parsed.set(drivername=drivername)
+    if backend == "postgresql" and "sslmode" in parsed.query:
+        sslmode = parsed.query["sslmode"]
+        parsed = parsed.difference_update_query(["sslmode"]).update_query_dict({"ssl": sslmode})
+    return parsed.render_as_string(hide_password=False)
+
+engine = create_engine(settings.database_url, **_pool_options(settings.database_url))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
+# Motor asíncrono opcional (DATABASE_ASYNC=true); se crea al primer uso
+async_engine = None
+AsyncSessionLocal = None
+
+
+def get_async_sessionmaker():
+    global async_engine, AsyncSessionLocal
+    if AsyncSessionLocal is None:
+        url = async_database_url(settings.database_url)
+        async_engine = create_async_engine(url, **_pool_options(url))
+        AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+    return AsyncSessionLocal
+
+
+def create_schema(bind=None):
+    """Crear tablas e índices que falten (lo llama migrate.py o el arranque con AUTO_MIGRATE)"""
+    import app.models  # registrar los modelos en Base.metadata
+    bind = bind or engine
+    Base.metadata.create_all(bind=bind)
+    # create_all no añade índices nuevos a tablas que ya existían
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=bind, checkfirst=True)
+
 
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+async def get_read_db():
+    """Sesión para rutas de lectura: asíncrona si DATABASE_ASYNC está activo, si no la síncrona"""
+    if settings.database_async:
+        async with get_async_sessionmaker()() as db:
+            yield db
+    else:
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+
+async def execute(db, statement):
+    """Ejecutar un select() con cualquiera de las dos sesiones sin bloquear el event loop"""
+    if isinstance(db, AsyncSession):
+        return await db.execute(statement)
+    return await run_in_threadpool(db.execute, statement)
+
+
+async def commit(db):
+    """Confirmar con cualquiera de las dos sesiones sin bloquear el event loop"""
+    if isinstance(db, AsyncSession):
+        await db.commit()
+    else:
+        await run_in_threadpool(db.commit)
+
+
+async def stream_partitions(statement, size: int):
+    """Filas de un select() en lotes de `size` con un cursor del servidor.
+
+    Abre su propia sesión (la de la petición ya está cerrada mientras se
+    envía la respuesta) y solo tiene un lote en memoria: en PostgreSQL
+    stream_results usa un cursor con nombre en lugar de traer todo el
+    resultado al cliente.
+    """
+    statement = statement.execution_options(yield_per=size)
+    if settings.database_async:
+        async with get_async_sessionmaker()() as db:
+            result = await db.stream(statement)
+            async for rows in result.partitions():
+                yield rows
+        return
+
+    db = SessionLocal()
+    try:
+        result = await run_in_threadpool(db.execute, statement)
+        while True:
+            rows = await run_in_threadpool(result.fetchmany, size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        db.close()
+
+
+async def dispose_engines():
+    if async_engine is not None:
+        await async_engine.dispose()
+    engine.dispose()
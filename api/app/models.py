@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, func
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Index, func
 from sqlalchemy.orm import relationship
 from app.database import Base
 
@@ -17,4 +17,9 @@ class Watermark(Base):
     hash_id = Column(String, unique=True, index=True, nullable=False)
     purpose = Column(String, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    user = relationship("User", back_populates="watermarks")
\ No newline at end of file
+    user = relationship("User", back_populates="watermarks")
+
+    # Paginación por cursor de /history/: (user_id, created_at) y id para desempatar
+    __table_args__ = (
+        Index("ix_watermarks_user_id_created_at", "user_id", "created_at", "id"),
+    )
\ No newline at end of file
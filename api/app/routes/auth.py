@@ -4,27 +4,47 @@ from sqlalchemy.orm import Session
 from app.schemas import UserCreate, UserOut, Token, TokenData
 from app.models import User
 from app.database import get_db
-from app.utils.auth import hash_password, verify_password, create_access_token, decode_access_token
+from app.utils.metrics import stage
+from app.utils.auth import (
+    hash_password_async, verify_password_async, create_access_token, decode_access_token,
+    principal_cache
+)
 from jose import JWTError
+from starlette.concurrency import run_in_threadpool
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 router = APIRouter(prefix="/auth", tags=["auth"])
 
-@router.post("/register", response_model=UserOut)
-def register(user_in: UserCreate, db: Session = Depends(get_db)):
-    existing = db.query(User).filter(User.email == user_in.email).first()
-    if existing:
-        raise HTTPException(status_code=400, detail="Ese email ya está registrado")
-    user = User(email=user_in.email, password=hash_password(user_in.password))
+def _find_user(db: Session, email: str):
+    return db.query(User).filter(User.email == email).first()
+
+def _create_user(db: Session, email: str, password: str) -> User:
+    user = User(email=email, password=password)
     db.add(user)
     db.commit()
     db.refresh(user)
+    # SQLite puede reutilizar el id de un usuario borrado: no servir el anterior desde la caché
+    principal_cache.invalidate(user.id)
     return user
 
+# Las consultas van al threadpool y bcrypt a su propio pool: nada bloquea el event loop
+@router.post("/register", response_model=UserOut)
+async def register(user_in: UserCreate, db: Session = Depends(get_db)):
+    existing = await run_in_threadpool(_find_user, db, user_in.email)
+    if existing:
+        raise HTTPException(status_code=400, detail="Ese email ya está registrado")
+    with stage("password_hash"):
+        password = await hash_password_async(user_in.password)
+    return await run_in_threadpool(_create_user, db, user_in.email, password)
+
 @router.post("/login", response_model=Token)
-def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.email == form_data.username).first()
-    if not user or not verify_password(form_data.password, user.password):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+    user = await run_in_threadpool(_find_user, db, form_data.username)
+    valid = False
+    if user:
+        with stage("password_hash"):
+            valid = await verify_password_async(form_data.password, user.password)
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrecto",
@@ -33,7 +53,18 @@ def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depend
     token = create_access_token({"user_id": user.id})
     return {"access_token": token, "token_type": "bearer"}
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> User:
+def _load_user(db: Session, user_id: int):
+    user = db.query(User).get(user_id)
+    if user:
+        # Desligarlo de la sesión para poder reutilizarlo desde la caché en otras peticiones
+        db.expunge(user)
+    return user
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> User:
+    with stage("auth"):
+        return await _authenticate(token, db)
+
+async def _authenticate(token: str, db: Session) -> User:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="No se ha podido validar las credenciales",
@@ -46,7 +77,13 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    user = db.query(User).get(user_id)
-    if not user:
-        raise credentials_exception
+    
+    # En régimen estable el usuario sale de la caché sin tocar la base de datos
+    exp = payload.get("exp", 0)
+    user = principal_cache.get(user_id, exp)
+    if user is None:
+        user = await run_in_threadpool(_load_user, db, user_id)
+        if not user:
+            raise credentials_exception
+        principal_cache.set(user_id, exp, user)
     return user
@@ -0,0 +1,118 @@
+from fastapi import APIRouter, UploadFile, Form, File, Depends, HTTPException
+from fastapi.responses import FileResponse
+from starlette.concurrency import run_in_threadpool
+from app.models import User
+from app.routes.auth import get_current_user
+from app.routes.watermark import marked_filename, purpose_error, run_preflight
+from app.utils.admission import get_admission, request_cost
+from app.utils.dct_watermark import new_hash_id
+from app.utils.jobs import DONE, EXPIRED, FAILED, JobStore
+from datetime import datetime, timezone
+import os
+
+router = APIRouter(prefix="/jobs", tags=["jobs"])
+
+_store = None
+
+def get_job_store() -> JobStore:
+    global _store
+    if _store is None:
+        _store = JobStore()
+    return _store
+
+def _timestamp(value):
+    return datetime.fromtimestamp(value, tz=timezone.utc) if value else None
+
+def _get_user_job(job_id: str, current_user: User):
+    job = get_job_store().get(job_id)
+    # No revelar trabajos de otros usuarios
+    if job is None or job["user_id"] != current_user.id:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return job
+
+def _submit(store: JobStore, user_id: int, hash_id: str, purpose: str, filename: str, data: bytes):
+    job_id = store.submit(user_id, hash_id, purpose, filename, data)
+    job = store.get(job_id)
+    return job_id, job, store.queue_position(job)
+
+@router.post("/", status_code=202)
+async def submit_job(
+    file: UploadFile = File(...),
+    purpose: str = Form(...),
+    current_user: User = Depends(get_current_user)
+):
+    """Encolar una imagen para marcarla en segundo plano; responde al momento con el id"""
+    error = purpose_error(purpose)
+    if error:
+        raise HTTPException(status_code=400, detail=error)
+    
+    if not file.content_type or not file.content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="Solo se permiten archivos de imagen")
+    
+    # Mismos límites que /upload/ antes de guardar nada en disco
+    info = run_preflight(file)
+    image_data = await file.read()
+    
+    if len(image_data) == 0:
+        raise HTTPException(status_code=400, detail="El archivo está vacío")
+    
+    # Escribir la entrada y el INSERT en SQLite fuera del event loop; el
+    # presupuesto de admisión acota cuántos cuerpos se copian a la vez
+    async with get_admission().admit(current_user.id, request_cost(info, len(image_data))):
+        job_id, job, position = await run_in_threadpool(
+            _submit, get_job_store(), current_user.id, new_hash_id(purpose), purpose, file.filename, image_data
+        )
+    
+    return {
+        "job_id": job_id,
+        "status": job["status"],
+        "queue_position": position,
+        "status_url": f"/jobs/{job_id}",
+        "result_url": f"/jobs/{job_id}/result"
+    }
+
+@router.get("/{job_id}")
+async def get_job_status(job_id: str, current_user: User = Depends(get_current_user)):
+    """Estado, progreso y posición en la cola de un trabajo"""
+    store = get_job_store()
+    job = _get_user_job(job_id, current_user)
+    
+    return {
+        "job_id": job_id,
+        "status": job["status"],
+        "stage": job["stage"],
+        "progress": job["progress"],
+        "queue_position": store.queue_position(job),
+        "error": job["error"],
+        "created_at": _timestamp(job["created_at"]),
+        "started_at": _timestamp(job["started_at"]),
+        "finished_at": _timestamp(job["finished_at"]),
+        "expires_at": _timestamp(job["expires_at"])
+    }
+
+@router.get("/{job_id}/result")
+async def get_job_result(job_id: str, current_user: User = Depends(get_current_user)):
+    """Descargar la imagen marcada mientras no haya caducado"""
+    store = get_job_store()
+    job = _get_user_job(job_id, current_user)
+    
+    if job["status"] == FAILED:
+        raise HTTPException(status_code=422, detail=job["error"] or "El trabajo falló")
+    
+    if job["status"] == EXPIRED or (job["status"] == DONE and job["expires_at"] < datetime.now().timestamp()):
+        store.expire(job_id)
+        raise HTTPException(status_code=410, detail="El resultado ha caducado")
+    
+    if job["status"] != DONE:
+        raise HTTPException(status_code=409, detail="El trabajo todavía no ha terminado")
+    
+    path = store.result_path(job_id)
+    if not os.path.exists(path):
+        store.expire(job_id)
+        raise HTTPException(status_code=410, detail="El resultado ha caducado")
+    
+    return FileResponse(
+        path,
+        media_type="image/png",
+        filename=marked_filename(job["filename"])
+    )
@@ -0,0 +1,133 @@
+from fastapi import APIRouter, UploadFile, Form, File, Depends, HTTPException
+from fastapi.responses import FileResponse
+from sqlalchemy.orm import Session
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from app.core.config import settings
+from app.database import commit, get_db
+from app.models import Watermark, User
+from app.routes.auth import get_current_user
+from app.routes.watermark import lookup_watermark, marked_filename, purpose_error, run_cpu
+from app.utils.admission import get_admission, request_cost
+from app.utils.dct_watermark import new_hash_id
+from app.utils.hash_index import get_watermark_index
+from app.utils.metrics import stage
+from app.utils.preflight import PreflightError, check_image, read_image_info
+from app.utils.tiled import decode_max_pixels, embed_watermark_tiled, extract_watermark_tiled, is_mappable
+from app.utils.uploads import spool_to_disk
+from app.utils.video import remove_files
+import logging
+import os
+import tempfile
+
+router = APIRouter()
+logger = logging.getLogger(__name__)
+
+def _check_large_image(file: UploadFile):
+    """Preflight de /upload/large/ y /verify/large/ con los límites de imágenes grandes"""
+    if not file.content_type or not file.content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="Solo se permiten archivos de imagen")
+    if file.size is not None and file.size > settings.tiled_max_bytes:
+        raise HTTPException(status_code=413, detail="La imagen supera el tamaño máximo permitido")
+    try:
+        with stage("preflight"):
+            max_pixels = settings.tiled_max_pixels
+            if not is_mappable(file.file):
+                # Lo que no se mapea se decodifica entero en RAM: límite mucho menor
+                max_pixels = min(max_pixels, decode_max_pixels())
+            info = read_image_info(file.file)
+            check_image(info, max_pixels=max_pixels)
+    except PreflightError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    # Coste para el control de admisión: por píxeles, que es lo que escala aquí
+    return request_cost(info, file.size)
+
+@router.post("/upload/large/")
+async def upload_large_image(
+    file: UploadFile = File(...),
+    purpose: str = Form(...),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Marcar escaneos gigantes y TIFF sin cargarlos enteros en memoria.
+
+    Los TIFF se devuelven como TIFF sin comprimir y el resto como PNG.
+    """
+    error = purpose_error(purpose)
+    if error:
+        raise HTTPException(status_code=400, detail=error)
+    cost = _check_large_image(file)
+
+    input_path = await spool_to_disk(file)
+    fd, output_path = tempfile.mkstemp(prefix="invisignia-")
+    os.close(fd)
+    hash_id = new_hash_id(purpose)
+
+    try:
+        async with get_admission().admit(current_user.id, cost):
+            result = await run_cpu(
+                embed_watermark_tiled, input_path, output_path, hash_id,
+                timeout=settings.tiled_task_timeout
+            )
+    except ValueError as e:
+        remove_files(input_path, output_path)
+        raise HTTPException(status_code=400, detail=str(e))
+    except HTTPException:
+        remove_files(input_path, output_path)
+        raise
+    except Exception:
+        remove_files(input_path, output_path)
+        logger.exception("Error procesando imagen grande")
+        raise HTTPException(status_code=500, detail="Error interno al procesar la imagen")
+
+    remove_files(input_path)
+
+    db.add(Watermark(user_id=current_user.id, hash_id=hash_id, purpose=purpose))
+    with stage("db_commit"):
+        await commit(db)
+    get_watermark_index().add(current_user.id, hash_id)
+
+    headers = {"X-Image-Size": f"{result.width}x{result.height}"}
+    if result.peak_rss_kb is not None:
+        headers["X-Peak-RSS-KB"] = str(result.peak_rss_kb)
+
+    return FileResponse(
+        output_path,
+        media_type=result.media_type,
+        filename=marked_filename(file.filename, result.extension),
+        headers=headers,
+        background=BackgroundTask(remove_files, output_path)
+    )
+
+@router.post("/verify/large/")
+async def verify_large_image(
+    file: UploadFile = File(...),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Verificar una imagen grande leyendo solo los bloques con marca"""
+    cost = _check_large_image(file)
+
+    path = await spool_to_disk(file)
+    try:
+        async with get_admission().admit(current_user.id, cost):
+            hash_extracted = await run_cpu(extract_watermark_tiled, path, timeout=settings.tiled_task_timeout)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        remove_files(path)
+
+    record, distance = await run_in_threadpool(lookup_watermark, db, current_user.id, hash_extracted)
+    if not record:
+        raise HTTPException(
+            status_code=404,
+            detail="Ese documento no contiene una marca de agua válida o no pertenece al usuario"
+        )
+
+    return {
+        "status": "found",
+        "purpose": record.purpose,
+        "created_at": record.created_at,
+        "user_email": current_user.email,
+        "bit_errors": distance
+    }
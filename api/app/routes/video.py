@@ -0,0 +1,143 @@
+from fastapi import APIRouter, UploadFile, Form, File, Depends, HTTPException
+from fastapi.responses import FileResponse
+from sqlalchemy.orm import Session
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from app.core.config import settings
+from app.database import commit, get_db
+from app.models import Watermark, User
+from app.routes.auth import get_current_user
+from app.routes.watermark import lookup_watermark, marked_filename, purpose_error, run_cpu
+from app.utils.admission import get_admission, request_cost
+from app.utils.dct_watermark import new_hash_id
+from app.utils.executor import ExecutorTimeoutError, get_executor
+from app.utils.hash_index import get_watermark_index
+from app.utils.metrics import stage
+from app.utils.uploads import spool_to_disk
+from app.utils.video import VIDEO_CODECS, extract_video_watermark, remove_files, watermark_video_file
+import logging
+import os
+import tempfile
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+router = APIRouter()
+logger = logging.getLogger(__name__)
+
+def _check_video(file: UploadFile):
+    if not file.content_type or not file.content_type.startswith('video/'):
+        raise HTTPException(status_code=400, detail="Solo se permiten archivos de vídeo")
+    if file.size is not None and file.size > settings.video_max_bytes:
+        raise HTTPException(status_code=413, detail="El vídeo supera el tamaño máximo permitido")
+
+@router.post("/upload/video/")
+async def upload_video(
+    file: UploadFile = File(...),
+    purpose: str = Form(...),
+    codec: Optional[str] = Form(None),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Marcar todos los fotogramas de un vídeo y devolverlo (FFV1/MKV por defecto, sin pérdidas)"""
+    error = purpose_error(purpose)
+    if error:
+        raise HTTPException(status_code=400, detail=error)
+    
+    codec = codec or settings.video_codec
+    if codec not in VIDEO_CODECS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Códec de vídeo no válido. Opciones: {', '.join(VIDEO_CODECS)}"
+        )
+    _check_video(file)
+    
+    input_path = await spool_to_disk(file)
+    fd, output_path = tempfile.mkstemp(prefix="invisignia-", suffix=VIDEO_CODECS[codec][1])
+    os.close(fd)
+    hash_id = new_hash_id(purpose)
+    
+    # Sin cabecera de la que sacar píxeles: el coste va por el tamaño del fichero
+    cost = request_cost(None, os.path.getsize(input_path))
+    try:
+        async with get_admission().admit(current_user.id, cost):
+            # Leer y escribir en un hilo; los lotes de fotogramas se marcan en el pool de procesos
+            result = await run_in_threadpool(
+                watermark_video_file, input_path, output_path, hash_id, codec,
+                pool=get_executor(), timeout=settings.video_task_timeout
+            )
+    except ValueError as e:
+        remove_files(input_path, output_path)
+        raise HTTPException(status_code=400, detail=str(e))
+    except ExecutorTimeoutError:
+        remove_files(input_path, output_path)
+        raise HTTPException(status_code=504, detail="El vídeo tardó demasiado en procesarse")
+    except HTTPException:
+        remove_files(input_path, output_path)
+        raise
+    except BrokenProcessPool:
+        remove_files(input_path, output_path)
+        raise HTTPException(
+            status_code=503,
+            detail="Se reinició el procesamiento de vídeo, inténtalo de nuevo en unos segundos",
+            headers={"Retry-After": "5"}
+        )
+    except Exception:
+        remove_files(input_path, output_path)
+        logger.exception("Error procesando vídeo")
+        raise HTTPException(status_code=500, detail="Error interno al procesar el vídeo")
+    
+    remove_files(input_path)
+    
+    db.add(Watermark(user_id=current_user.id, hash_id=hash_id, purpose=purpose))
+    with stage("db_commit"):
+        await commit(db)
+    get_watermark_index().add(current_user.id, hash_id)
+    
+    # El temporal de salida se borra cuando termina de enviarse
+    return FileResponse(
+        output_path,
+        media_type=result.media_type,
+        filename=marked_filename(file.filename, result.extension),
+        headers={
+            "X-Video-Frames": str(result.frames),
+            "X-Video-Codec": result.codec,
+            "X-Watermark-Survival": f"{result.survival:.4f}"
+        },
+        background=BackgroundTask(remove_files, output_path)
+    )
+
+@router.post("/verify/video/")
+async def verify_video(
+    file: UploadFile = File(...),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Verificar un vídeo extrayendo la marca de unos pocos fotogramas y votando el hash"""
+    _check_video(file)
+    
+    path = await spool_to_disk(file)
+    try:
+        # Solo se decodifican unos pocos fotogramas: una unidad
+        async with get_admission().admit(current_user.id, 1):
+            verification = await run_cpu(extract_video_watermark, path, timeout=settings.video_task_timeout)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        remove_files(path)
+    
+    record, distance = await run_in_threadpool(lookup_watermark, db, current_user.id, verification.hash_hex)
+    if not record:
+        raise HTTPException(
+            status_code=404,
+            detail="Ese vídeo no contiene una marca de agua válida o no pertenece al usuario"
+        )
+    
+    return {
+        "status": "found",
+        "purpose": record.purpose,
+        "created_at": record.created_at,
+        "user_email": current_user.email,
+        "bit_errors": distance,
+        "frames_sampled": verification.samples,
+        "frame_agreement": round(verification.agreement, 4)
+    }
@@ -1,148 +1,729 @@
-from fastapi import APIRouter, UploadFile, Form, File, Depends, HTTPException
+from fastapi import APIRouter, UploadFile, Form, File, Depends, Header, HTTPException
 from fastapi.responses import Response, StreamingResponse
+from sqlalchemy import and_, or_, select
 from sqlalchemy.orm import Session
-from app.database import get_db
+from starlette.concurrency import run_in_threadpool
+from app.core.config import settings
+from app.database import SessionLocal, commit, execute, get_db, get_read_db, stream_partitions
 from app.models import Watermark, User
 from app.routes.auth import get_current_user
-from app.utils.dct_watermark import embed_watermark_memory, extract_watermark_memory, test_watermark_integrity_memory
+from app.utils.dct_watermark import (
+    compare_encoding_profiles_memory, compare_images_memory, create_debug_image_memory,
+    extract_watermark_memory, new_hash_id, process_upload_memory, test_watermark_integrity_memory
+)
+from app.utils.encoding import ENCODING_PROFILES
+from app.utils.grid_sync import extract_watermark_synced_memory
+from app.utils.executor import ExecutorBusyError, ExecutorTimeoutError, get_executor
+from app.utils.admission import AdmissionRejected, get_admission, request_cost
+from app.utils.batch import (
+    TABLE_FORMATS, TableStreamWriter, ZipStreamWriter, items_from_archive, items_from_uploads
+)
+from app.utils.hash_index import get_watermark_index
+from app.utils.verify_cache import VerifyEntry, image_digest, verify_cache
+from app.utils.idempotency import CachedUpload, cache_key, get_embed_cache, upload_digest, upload_inflight
+from app.utils.metrics import VERIFY_CACHE_REQUESTS, VERIFY_CACHE_SAVED_SECONDS, stage
+from app.utils.preflight import PreflightError, preflight_upload, read_image_info
+from app.utils.quality import QUALITY_REGIONS, compare_quality_memory
+import asyncio
 import hashlib
+import json
+import logging
+import time
 import uuid
-from typing import List
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from typing import List, Optional
 from io import BytesIO
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
+
+async def run_cpu(func, *args, timeout: Optional[float] = None):
+    """Ejecutar trabajo de OpenCV/NumPy en el pool sin bloquear el event loop"""
+    try:
+        return await get_executor().run(func, *args, timeout=timeout)
+    except ExecutorBusyError:
+        raise HTTPException(
+            status_code=503,
+            detail="El servidor está procesando demasiadas imágenes, inténtalo de nuevo en unos segundos",
+            headers={"Retry-After": "5"}
+        )
+    except ExecutorTimeoutError:
+        raise HTTPException(status_code=504, detail="La imagen tardó demasiado en procesarse")
+    except BrokenProcessPool:
+        # Un worker murió con el trabajo en vuelo; el pool ya se está recreando
+        raise HTTPException(
+            status_code=503,
+            detail="Se reinició el procesamiento de imágenes, inténtalo de nuevo en unos segundos",
+            headers={"Retry-After": "5"}
+        )
+
+def run_preflight(file: UploadFile):
+    """Descartar por cabecera las imágenes inválidas, enormes o sin capacidad para la marca"""
+    try:
+        with stage("preflight"):
+            return preflight_upload(file.file, file.size)
+    except PreflightError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+def purpose_error(purpose: Optional[str]) -> Optional[str]:
+    """Devolver el motivo por el que el propósito no es válido, o None"""
+    if not purpose or not purpose.strip():
+        return "El propósito es obligatorio"
+    
+    if len(purpose) > 255:
+        return "El propósito no puede superar los 255 caracteres"
+    
+    return None
+
+def lookup_watermark(db: Session, user_id: int, hash_extracted: str):
+    """Devolver (marca del usuario, bits distintos) para un hash extraído, o (None, 0)"""
+    # Buscar solo las marcas del usuario logueado
+    record = db.query(Watermark).filter(
+        Watermark.hash_id == hash_extracted,
+        Watermark.user_id == user_id
+    ).first()
+    if record:
+        return record, 0
+    
+    # Tolerar bits cambiados por recompresión: marca más cercana por Hamming
+    match = get_watermark_index().nearest(db, user_id, hash_extracted)
+    if match:
+        hash_id, distance = match
+        record = db.query(Watermark).filter(
+            Watermark.hash_id == hash_id,
+            Watermark.user_id == user_id
+        ).first()
+        if record:
+            return record, distance
+    return None, 0
+
+def marked_filename(original_name: Optional[str], extension: str = ".png") -> str:
+    """Nombre sugerido para la imagen marcada"""
+    original_name = original_name or "image"
+    name_parts = original_name.rsplit('.', 1)
+    if len(name_parts) > 1:
+        return f"{name_parts[0]}_marked{extension}"
+    return f"{original_name}_marked{extension}"
+
+def _upload_response(entry: CachedUpload, replayed: bool = False) -> Response:
+    headers = {"Content-Disposition": f"attachment; filename={entry.filename}", **entry.headers}
+    if replayed:
+        headers["Idempotent-Replayed"] = "true"
+    return Response(content=entry.data, media_type=entry.media_type, headers=headers)
+
+async def _embed_upload(image_data: bytes, purpose: str, profile: str, filename: Optional[str],
+                        user: User, db: Session, fingerprint: str = "", cost: int = 1) -> CachedUpload:
+    """Marcar, registrar la marca y devolver la respuesta lista para guardarla en caché"""
+    # Generar hash único
+    hash_id = new_hash_id(purpose)
+    
+    # Decodificar, marcar, probar integridad y codificar una sola vez (fuera del event loop)
+    try:
+        async with get_admission().admit(user.id, cost):
+            result = await run_cpu(process_upload_memory, image_data, hash_id, profile)
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error procesando imagen")
+        raise HTTPException(status_code=500, detail="Error interno al procesar la imagen")
+    
+    if not result.passed:
+        raise HTTPException(
+            status_code=400, 
+            detail="La imagen no tiene suficiente calidad para agregar una marca de agua invisible. "
+                   "Intenta con una imagen de mayor resolución o menos comprimida."
+        )
+    
+    try:
+        marked_image_data = result.data
+        
+        # Guardar registro en base de datos
+        wm = Watermark(user_id=user.id, hash_id=hash_id, purpose=purpose)
+        db.add(wm)
+        with stage("db_commit"):
+            await commit(db)
+        get_watermark_index().add(user.id, hash_id)
+    except Exception:
+        logger.exception("Error guardando la marca")
+        raise HTTPException(status_code=500, detail="Error interno al procesar la imagen")
+    
+    # Tipo de contenido según el perfil (PNG por defecto para preservar calidad)
+    encoding = result.encoding
+    headers = {
+        "X-Peak-RSS-KB": str(result.peak_rss_kb),
+        "X-Encoding-Profile": encoding.profile,
+        "X-Encode-Time-Ms": f"{encoding.encode_ms:.2f}",
+        "X-Encoded-Size": str(len(marked_image_data)),
+        "X-Watermark-Survival": f"{result.survival:.4f}"
+    }
+    requested = profile or settings.default_encoding_profile
+    if encoding.profile != requested:
+        # La marca no sobrevivía al perfil pedido: se entregó sin pérdidas
+        headers["X-Encoding-Fallback"] = requested
+    return CachedUpload(
+        hash_id=hash_id,
+        fingerprint=fingerprint,
+        media_type=encoding.media_type,
+        # Generar nombre de archivo sugerido
+        filename=marked_filename(filename, encoding.extension),
+        headers=headers,
+        data=marked_image_data
+    )
 
 @router.post("/upload/")
 async def upload_file(
     file: UploadFile = File(...),
     purpose: str = Form(...),
+    profile: str = Form(None),
+    idempotency_key: Optional[str] = Header(None),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    if not purpose or not purpose.strip():
-        raise HTTPException(status_code=400, detail="El propósito es obligatorio")
+    """Marcar una imagen y devolverla.
+
+    Con la cabecera Idempotency-Key (o con IDEMPOTENCY_CONTENT_KEY, por el
+    contenido) los reintentos devuelven la misma imagen y el mismo hash sin
+    volver a marcar ni crear otra fila; llevan Idempotent-Replayed: true.
+    """
+    error = purpose_error(purpose)
+    if error:
+        raise HTTPException(status_code=400, detail=error)
     
-    if len(purpose) > 255:
-        raise HTTPException(status_code=400, detail="El propósito no puede superar los 255 caracteres")
+    profile = profile or settings.default_encoding_profile
+    if profile not in ENCODING_PROFILES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Perfil de codificación no válido. Opciones: {', '.join(ENCODING_PROFILES)}"
+        )
+    
+    if idempotency_key is not None and not 0 < len(idempotency_key) <= 255:
+        raise HTTPException(status_code=400, detail="Idempotency-Key debe tener entre 1 y 255 caracteres")
     
     # Validar tipo de archivo
     if not file.content_type or not file.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="Solo se permiten archivos de imagen")
     
+    # Dimensiones y capacidad desde la cabecera, antes de leer y decodificar
+    info = run_preflight(file)
+    
     # Leer archivo en memoria
     image_data = await file.read()
     
     if len(image_data) == 0:
         raise HTTPException(status_code=400, detail="El archivo está vacío")
     
-    # Generar hash único
-    raw = purpose + uuid.uuid4().hex
-    hash_id = hashlib.sha256(raw.encode()).hexdigest()
+    # Coste para el control de admisión (los reintentos servidos de caché no lo pagan)
+    cost = request_cost(info, len(image_data))
     
-    print(f"TEST: Probando calidad de imagen antes de procesar...")
+    cache = get_embed_cache()
+    if not cache.enabled or not (idempotency_key or settings.idempotency_content_key):
+        return _upload_response(
+            await _embed_upload(image_data, purpose, profile, file.filename, current_user, db, cost=cost)
+        )
     
-    # Probar integridad del algoritmo en memoria
-    test_success = test_watermark_integrity_memory(image_data, hash_id)
+    # Un reintento cuesta solo la huella de los bytes
+    with stage("digest"):
+        fingerprint = await run_in_threadpool(upload_digest, image_data, purpose, profile)
+    key = cache_key(current_user.id, idempotency_key, fingerprint)
     
-    if not test_success:
+    # Con directorio, get y set leen y escriben disco: fuera del event loop
+    entry = await run_in_threadpool(cache.get, key)
+    replayed = entry is not None
+    if entry is None:
+        async def embed_and_cache():
+            entry = await _embed_upload(
+                image_data, purpose, profile, file.filename, current_user, db, fingerprint, cost
+            )
+            await run_in_threadpool(cache.set, key, entry)
+            return entry
+        
+        # Un reintento que llega mientras la primera sigue en marcha espera su resultado
+        entry, replayed = await upload_inflight.run(key, embed_and_cache)
+    
+    if entry.fingerprint != fingerprint:
         raise HTTPException(
-            status_code=400, 
-            detail="La imagen no tiene suficiente calidad para agregar una marca de agua invisible. "
-                   "Intenta con una imagen de mayor resolución o menos comprimida."
+            status_code=422,
+            detail="La Idempotency-Key ya se usó con otra imagen, propósito o perfil"
         )
     
-    print(f"OK: Test exitoso, procesando imagen en memoria...")
-    
+    return _upload_response(entry, replayed)
+
+def _save_batch_rows(user_id: int, marks: List[tuple]):
+    """Guardar en una transacción las marcas (hash_id, propósito) que acaban de terminar"""
+    db = SessionLocal()
     try:
-        # Procesar imagen en memoria
-        marked_image_data = embed_watermark_memory(image_data, hash_id)
-        
-        # Guardar registro en base de datos
-        wm = Watermark(user_id=current_user.id, hash_id=hash_id, purpose=purpose)
-        db.add(wm)
+        db.add_all([Watermark(user_id=user_id, hash_id=hash_id, purpose=purpose) for hash_id, purpose in marks])
         db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+@router.post("/upload/batch/")
+async def upload_batch(
+    files: List[UploadFile] = File(None),
+    archive: UploadFile = File(None),
+    purpose: str = Form(None),
+    purposes: str = Form(None),
+    current_user: User = Depends(get_current_user)
+):
+    """Marcar muchas imágenes en paralelo y devolver un ZIP que se envía según van terminando.
+    
+    `purpose` se aplica a todos los archivos; `purposes` es un JSON {nombre: propósito}
+    que lo sobrescribe por archivo. Los fallos individuales van al manifest.json del
+    ZIP y no cortan el lote. Las marcas de cada tanda de imágenes terminadas se
+    registran (en el threadpool) antes de escribir esas imágenes en el ZIP.
+    """
+    if bool(files) == bool(archive):
+        raise HTTPException(status_code=400, detail="Envía varios archivos o un único ZIP, no ambos")
+    
+    per_file = {}
+    if purposes:
+        try:
+            per_file = json.loads(purposes)
+        except ValueError:
+            per_file = None
+        if not isinstance(per_file, dict):
+            raise HTTPException(status_code=400, detail="purposes debe ser un objeto JSON {archivo: propósito}")
+    
+    if not purpose and not per_file:
+        raise HTTPException(status_code=400, detail="El propósito es obligatorio")
+    
+    if archive:
+        try:
+            items = items_from_archive(archive)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    else:
+        items = items_from_uploads(files)
+    
+    if not items:
+        raise HTTPException(status_code=400, detail="El lote no contiene archivos")
+    
+    if len(items) > settings.batch_max_files:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Un lote no puede superar los {settings.batch_max_files} archivos"
+        )
+    
+    user_id = current_user.id
+    executor = get_executor()
+    admission = get_admission()
+    workers = asyncio.Semaphore(executor.workers)
+    
+    async def process(index, item):
+        entry = {"index": index, "file": item.name, "status": "error"}
+        item_purpose = per_file.get(item.name, purpose)
+        entry["purpose"] = item_purpose
         
-        # Determinar el tipo de contenido apropiado
-        content_type = "image/png"  # Siempre devolvemos PNG para preservar calidad
+        error = purpose_error(item_purpose)
+        if error is None and not item.is_image:
+            error = "Solo se permiten archivos de imagen"
+        if error is None and item.size is not None and item.size > settings.batch_max_file_bytes:
+            error = "El archivo supera el tamaño máximo permitido"
+        if error:
+            entry["detail"] = error
+            return entry, None, None
         
-        # Generar nombre de archivo sugerido
-        original_name = file.filename or "image"
-        name_parts = original_name.rsplit('.', 1)
-        if len(name_parts) > 1:
-            base_name = name_parts[0]
-            suggested_filename = f"{base_name}_marked.png"
-        else:
-            suggested_filename = f"{original_name}_marked.png"
+        # Leer el archivo solo cuando hay un worker libre para él
+        async with workers:
+            image_data = await item.read()
+            if len(image_data) == 0:
+                entry["detail"] = "El archivo está vacío"
+                return entry, None, None
+            
+            hash_id = new_hash_id(item_purpose)
+            cost = request_cost(read_image_info(BytesIO(image_data)), len(image_data))
+            try:
+                async with admission.admit(user_id, cost, max_wait=settings.executor_task_timeout):
+                    result = await executor.run(
+                        process_upload_memory, image_data, hash_id, "png-fast",
+                        wait=settings.executor_task_timeout
+                    )
+            except (ExecutorBusyError, AdmissionRejected, BrokenProcessPool):
+                entry["detail"] = "El servidor está ocupado"
+                return entry, None, None
+            except ExecutorTimeoutError:
+                entry["detail"] = "La imagen tardó demasiado en procesarse"
+                return entry, None, None
+            except Exception:
+                logger.exception("Error procesando imagen del lote", extra={"file": item.name})
+                entry["detail"] = "Error interno al procesar la imagen"
+                return entry, None, None
+        
+        if not result.passed:
+            entry["detail"] = "La imagen no tiene suficiente calidad para agregar una marca de agua invisible"
+            return entry, None, None
+        
+        return entry, hash_id, result.data
+    
+    async def stream():
+        zip_stream = ZipStreamWriter()
+        manifest = []
+        tasks = [asyncio.ensure_future(process(i, item)) for i, item in enumerate(items)]
         
-        # Retornar imagen directamente desde memoria
-        return Response(
-            content=marked_image_data,
-            media_type=content_type,
-            headers={
-                "Content-Disposition": f"attachment; filename={suggested_filename}"
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                results = sorted((task.result() for task in done), key=lambda r: r[0]["index"])
+                marked = [(entry, hash_id, data) for entry, hash_id, data in results if data is not None]
+                manifest.extend(entry for entry, _, _ in results)
+                
+                # Registrar las marcas antes de entregar sus imágenes: el cliente nunca
+                # tiene un hash_id que no esté en la base de datos
+                if marked:
+                    try:
+                        with stage("db_commit"):
+                            await run_in_threadpool(
+                                _save_batch_rows, user_id, [(hash_id, entry["purpose"]) for entry, hash_id, _ in marked]
+                            )
+                    except Exception:
+                        logger.exception("Error guardando lote")
+                        for entry, _, _ in marked:
+                            entry["detail"] = "No se pudo registrar la marca"
+                        continue
+                
+                for entry, hash_id, marked_data in marked:
+                    get_watermark_index().add(user_id, hash_id)
+                    output_name = zip_stream.unique_name(marked_filename(entry["file"]))
+                    entry.update(status="ok", output=output_name)
+                    yield zip_stream.add(output_name, marked_data)
+            
+            manifest.sort(key=lambda e: e["index"])
+            summary = {
+                "total": len(manifest),
+                "ok": sum(1 for e in manifest if e["status"] == "ok"),
+                "files": manifest,
             }
+            yield zip_stream.add("manifest.json", json.dumps(summary, ensure_ascii=False, indent=2))
+            yield zip_stream.close()
+        finally:
+            # Si el cliente corta la descarga, no seguir procesando el resto
+            for task in tasks:
+                task.cancel()
+    
+    return StreamingResponse(
+        stream(),
+        media_type="application/zip",
+        headers={"Content-Disposition": "attachment; filename=marked_images.zip"}
+    )
+
+def _verify_response(entry: VerifyEntry, user: User, response: Response, cache_status: str) -> dict:
+    if cache_status:
+        response.headers["X-Verify-Cache"] = cache_status
+    if entry.record_id is None:
+        raise HTTPException(
+            status_code=404, 
+            detail="Ese documento no contiene una marca de agua válida o no pertenece al usuario",
+            headers={"X-Verify-Cache": cache_status} if cache_status else None
         )
-        
-    except Exception as e:
-        print(f"Error procesando imagen: {str(e)}")
-        raise HTTPException(status_code=500, detail="Error interno al procesar la imagen")
+    
+    result = {
+        "status": "found",
+        "purpose": entry.purpose,
+        "created_at": entry.created_at,
+        "user_email": user.email,
+        "bit_errors": entry.bit_errors
+    }
+    if entry.sync is not None:
+        result["sync"] = entry.sync
+    return result
+
+async def _verify_image(image_data: bytes, user_id: int, db: Session) -> VerifyEntry:
+    """Extraer la marca (buscando la rejilla si hace falta) y resolverla contra las del usuario"""
+    start = time.perf_counter()
+    
+    # Extraer marca de agua desde memoria
+    hash_extracted = await run_cpu(extract_watermark_memory, image_data, 256)
+    
+    # La búsqueda puede traer filas nuevas de la tabla: fuera del event loop
+    record, distance = await run_in_threadpool(lookup_watermark, db, user_id, hash_extracted)
+    
+    # Rejilla desplazada (recorte, bordes, reescalado): buscarla y volver a mirar
+    sync = None
+    if not record and settings.verify_sync_search:
+        synced = await run_cpu(extract_watermark_synced_memory, image_data, 256)
+        sync = {
+            "confidence": round(synced.confidence, 4),
+            "offset": [synced.offset_y, synced.offset_x],
+            "scale": synced.scale
+        }
+        if synced.confidence >= settings.verify_sync_min_confidence:
+            hash_extracted = synced.hash_hex
+            record, distance = await run_in_threadpool(lookup_watermark, db, user_id, hash_extracted)
+    
+    # Solo una coincidencia exacta es definitiva; el resto depende de las marcas que haya
+    exact = record is not None and distance == 0
+    last_id = None if exact else await run_in_threadpool(get_watermark_index().last_id, db, user_id)
+    return VerifyEntry(
+        hash_extracted=hash_extracted,
+        record_id=record.id if record else None,
+        purpose=record.purpose if record else None,
+        created_at=record.created_at if record else None,
+        bit_errors=distance,
+        sync=sync if record else None,
+        last_id=last_id,
+        compute_seconds=time.perf_counter() - start
+    )
 
 @router.post("/verify/")
 async def verify_file(
+    response: Response,
     file: UploadFile = File(...),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
+    """Verificar una imagen. Los mismos bytes del mismo usuario se sirven de caché
+    (cabecera X-Verify-Cache: hit/miss) mientras el resultado siga valiendo."""
     # Validar tipo de archivo
     if not file.content_type or not file.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="Solo se permiten archivos de imagen")
     
+    # Dimensiones de la cabecera para el coste en el control de admisión
+    info = read_image_info(file.file)
+    
     # Leer archivo en memoria
     image_data = await file.read()
     
     if len(image_data) == 0:
         raise HTTPException(status_code=400, detail="El archivo está vacío")
     
+    digest = None
+    cache_status = ""
+    if verify_cache.enabled:
+        with stage("digest"):
+            digest = await run_in_threadpool(image_digest, image_data)
+        entry = verify_cache.get(current_user.id, digest)
+        valid = entry is not None and entry.last_id is None
+        if entry is not None and not valid:
+            # Revalidar contra las marcas nuevas consulta la tabla: también en el threadpool
+            with stage("lookup"):
+                last_id = await run_in_threadpool(get_watermark_index().last_id, db, current_user.id)
+            valid = entry.last_id == last_id
+        if valid:
+            VERIFY_CACHE_REQUESTS.inc(1, "hit")
+            VERIFY_CACHE_SAVED_SECONDS.inc(entry.compute_seconds)
+            return _verify_response(entry, current_user, response, "hit")
+        if entry is not None:
+            # Hay marcas nuevas del usuario: el resultado guardado puede haber cambiado
+            cache_status = "stale"
+            verify_cache.discard(current_user.id, digest)
+        else:
+            cache_status = "miss"
+        VERIFY_CACHE_REQUESTS.inc(1, cache_status)
+    
     try:
-        # Extraer marca de agua desde memoria
-        hash_extracted = extract_watermark_memory(image_data, 256)
-        
-        # Buscar solo las marcas del usuario logueado
-        record = db.query(Watermark).filter(
-            Watermark.hash_id == hash_extracted,
-            Watermark.user_id == current_user.id
-        ).first()
+        async with get_admission().admit(current_user.id, request_cost(info, len(image_data))):
+            entry = await _verify_image(image_data, current_user.id, db)
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error verificando imagen")
+        raise HTTPException(status_code=500, detail="Error interno al verificar la imagen")
+    
+    if digest is not None:
+        verify_cache.set(current_user.id, digest, entry)
+    return _verify_response(entry, current_user, response, cache_status)
+
+def resolve_watermarks(db: Session, user_id: int, hashes: List[str]) -> dict:
+    """Resolver muchos hashes extraídos contra las marcas del usuario: {hash: (marca, bits distintos)}.
+
+    La búsqueda por Hamming es en memoria, así que a la tabla solo va una
+    consulta con todos los hash_id encontrados.
+    """
+    matches = get_watermark_index().nearest_many(db, user_id, hashes)
+    if not matches:
+        return {}
+    
+    hash_ids = {hash_id for hash_id, _ in matches.values()}
+    rows = db.execute(
+        select(Watermark.hash_id, Watermark.purpose, Watermark.created_at).where(
+            Watermark.user_id == user_id, Watermark.hash_id.in_(hash_ids)
+        )
+    ).all()
+    records = {row.hash_id: row for row in rows}
+    return {
+        hash_hex: (records[hash_id], distance)
+        for hash_hex, (hash_id, distance) in matches.items()
+        if hash_id in records
+    }
+
+VERIFY_BATCH_FIELDS = ("index", "file", "status", "purpose", "created_at", "bit_errors", "detail")
+
+@router.post("/verify/batch/")
+async def verify_batch(
+    files: List[UploadFile] = File(None),
+    archive: UploadFile = File(None),
+    format: str = Form("ndjson"),
+    current_user: User = Depends(get_current_user)
+):
+    """Verificar muchas imágenes: extracción en paralelo y una sola consulta al registro.
+    
+    Devuelve una fila por archivo (found, not_found o error) en NDJSON o CSV,
+    en el orden en que se subieron.
+    """
+    if bool(files) == bool(archive):
+        raise HTTPException(status_code=400, detail="Envía varios archivos o un único ZIP, no ambos")
+    
+    try:
+        table = TableStreamWriter(format, VERIFY_BATCH_FIELDS)
+    except ValueError:
+        raise HTTPException(
+            status_code=400, detail=f"Formato no válido. Opciones: {', '.join(TABLE_FORMATS)}"
+        )
+    
+    if archive:
+        try:
+            items = items_from_archive(archive)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    else:
+        items = items_from_uploads(files)
+    
+    if not items:
+        raise HTTPException(status_code=400, detail="El lote no contiene archivos")
+    
+    if len(items) > settings.batch_max_files:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Un lote no puede superar los {settings.batch_max_files} archivos"
+        )
+    
+    user_id = current_user.id
+    executor = get_executor()
+    admission = get_admission()
+    workers = asyncio.Semaphore(executor.workers)
+    
+    async def extract(index, item):
+        entry = {"index": index, "file": item.name, "status": "error"}
         
-        if not record:
-            raise HTTPException(
-                status_code=404, 
-                detail="Ese documento no contiene una marca de agua válida o no pertenece al usuario"
-            )
+        if not item.is_image:
+            entry["detail"] = "Solo se permiten archivos de imagen"
+            return entry, None
+        if item.size is not None and item.size > settings.batch_max_file_bytes:
+            entry["detail"] = "El archivo supera el tamaño máximo permitido"
+            return entry, None
         
-        return {
-            "status": "found",
-            "purpose": record.purpose,
-            "created_at": record.created_at,
-            "user_email": current_user.email
-        }
+        # Leer el archivo solo cuando hay un worker libre para él
+        async with workers:
+            image_data = await item.read()
+            if len(image_data) == 0:
+                entry["detail"] = "El archivo está vacío"
+                return entry, None
+            
+            cost = request_cost(read_image_info(BytesIO(image_data)), len(image_data))
+            try:
+                async with admission.admit(user_id, cost, max_wait=settings.executor_task_timeout):
+                    hash_extracted = await executor.run(
+                        extract_watermark_memory, image_data, 256, wait=settings.executor_task_timeout
+                    )
+            except (ExecutorBusyError, AdmissionRejected, BrokenProcessPool):
+                entry["detail"] = "El servidor está ocupado"
+                return entry, None
+            except ExecutorTimeoutError:
+                entry["detail"] = "La imagen tardó demasiado en procesarse"
+                return entry, None
+            except ValueError as e:
+                entry["detail"] = str(e)
+                return entry, None
+            except Exception:
+                logger.exception("Error verificando imagen del lote", extra={"file": item.name})
+                entry["detail"] = "Error interno al verificar la imagen"
+                return entry, None
         
-    except Exception as e:
-        if isinstance(e, HTTPException):
-            raise e
-        print(f"Error verificando imagen: {str(e)}")
-        raise HTTPException(status_code=500, detail="Error interno al verificar la imagen")
+        return entry, hash_extracted
+    
+    async def stream():
+        tasks = [asyncio.ensure_future(extract(i, item)) for i, item in enumerate(items)]
+        try:
+            yield table.header()
+            extracted = await asyncio.gather(*tasks)
+            
+            # Todos los hashes del lote contra el registro de una vez
+            hashes = [hash_hex for _, hash_hex in extracted if hash_hex is not None]
+            resolved = {}
+            if hashes:
+                db = SessionLocal()
+                try:
+                    with stage("lookup"):
+                        resolved = await run_in_threadpool(resolve_watermarks, db, user_id, hashes)
+                except Exception:
+                    logger.exception("Error resolviendo el lote")
+                    for entry, hash_hex in extracted:
+                        if hash_hex is not None:
+                            entry["detail"] = "Error interno al consultar el registro"
+                    hashes = []
+                finally:
+                    db.close()
+            
+            for entry, hash_hex in extracted:
+                if hash_hex is not None and hashes:
+                    match = resolved.get(hash_hex)
+                    if match is None:
+                        entry["status"] = "not_found"
+                    else:
+                        record, distance = match
+                        entry.update(
+                            status="found",
+                            purpose=record.purpose,
+                            created_at=record.created_at.isoformat() if record.created_at else None,
+                            bit_errors=distance
+                        )
+                yield table.row(entry)
+        finally:
+            # Si el cliente corta la descarga, no seguir extrayendo el resto
+            for task in tasks:
+                task.cancel()
+    
+    extension = "csv" if table.format == "csv" else "ndjson"
+    return StreamingResponse(
+        stream(),
+        media_type=table.media_type,
+        headers={"Content-Disposition": f"attachment; filename=verify_results.{extension}"}
+    )
 
 @router.get("/history/")
 async def get_user_history(
+    response: Response,
     limit: int = 10,
+    cursor: Optional[int] = None,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db = Depends(get_read_db)
 ):
-    """Obtener historial de marcas de agua del usuario"""
-    watermarks = db.query(Watermark).filter(
-        Watermark.user_id == current_user.id
-    ).order_by(Watermark.created_at.desc()).limit(limit).all()
-    
+    """Obtener historial de marcas de agua del usuario.
+
+    Paginación por cursor: la cabecera X-Next-Cursor trae el valor para pedir
+    la página siguiente con ?cursor=, y no aparece en la última página.
+    """
+    limit = max(1, min(limit, 100))
+    statement = select(
+        Watermark.id, Watermark.purpose, Watermark.created_at, Watermark.hash_id
+    ).where(Watermark.user_id == current_user.id)
+
+    if cursor is not None:
+        # La fecha del cursor se lee de la propia fila para compararla tal cual
+        # está guardada (SQLite la guarda como texto sin microsegundos)
+        cursor_created_at = select(Watermark.created_at).where(
+            Watermark.id == cursor, Watermark.user_id == current_user.id
+        ).scalar_subquery()
+        statement = statement.where(
+            or_(
+                Watermark.created_at < cursor_created_at,
+                and_(Watermark.created_at == cursor_created_at, Watermark.id < cursor)
+            )
+        )
+
+    # Pedir una fila de más para saber si hay página siguiente
+    statement = statement.order_by(Watermark.created_at.desc(), Watermark.id.desc()).limit(limit + 1)
+    rows = (await execute(db, statement)).all()
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = str(rows[-1].id)
+
     return [
         {
             "id": wm.id,
@@ -150,9 +731,61 @@ async def get_user_history(
             "created_at": wm.created_at,
             "hash_id": wm.hash_id[:16] + "..."  # Solo mostrar parte del hash por seguridad
         }
-        for wm in watermarks
+        for wm in rows
     ]
 
+EXPORT_FIELDS = ("id", "hash_id", "purpose", "created_at")
+
+@router.get("/history/export/")
+async def export_user_history(
+    format: str = "ndjson",
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """Exportar todas las marcas del usuario, con el hash completo, en NDJSON o CSV.
+
+    Las filas salen por orden de creación (since incluido, until excluido) en
+    lotes de EXPORT_CHUNK_SIZE leídos con un cursor del servidor: la memoria
+    no depende de cuántas marcas tenga la cuenta.
+    """
+    try:
+        table = TableStreamWriter(format, EXPORT_FIELDS)
+    except ValueError:
+        raise HTTPException(
+            status_code=400, detail=f"Formato no válido. Opciones: {', '.join(TABLE_FORMATS)}"
+        )
+
+    statement = select(
+        Watermark.id, Watermark.hash_id, Watermark.purpose, Watermark.created_at
+    ).where(Watermark.user_id == current_user.id)
+    if since is not None:
+        statement = statement.where(Watermark.created_at >= since)
+    if until is not None:
+        statement = statement.where(Watermark.created_at < until)
+    statement = statement.order_by(Watermark.created_at, Watermark.id)
+    user_id = current_user.id
+
+    async def stream():
+        exported = 0
+        start = time.perf_counter()
+        yield table.header()
+        async for rows in stream_partitions(statement, settings.export_chunk_size):
+            # Un trozo de respuesta por lote, no por fila
+            yield "".join(table.row(dict(zip(EXPORT_FIELDS, row))) for row in rows)
+            exported += len(rows)
+        logger.info(
+            "Registro exportado",
+            extra={"user_id": user_id, "rows": exported, "seconds": round(time.perf_counter() - start, 3)}
+        )
+
+    extension = "csv" if table.format == "csv" else "ndjson"
+    return StreamingResponse(
+        stream(),
+        media_type=table.media_type,
+        headers={"Content-Disposition": f"attachment; filename=watermarks.{extension}"}
+    )
+
 @router.post("/test/")
 async def test_watermark_algorithm(
     file: UploadFile = File(...),
@@ -165,6 +798,20 @@ async def test_watermark_algorithm(
     if not file.content_type or not file.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="Solo se permiten archivos de imagen")
     
+    # Las imágenes sin capacidad suficiente no pasan el test: responder sin decodificar
+    try:
+        with stage("preflight"):
+            info = preflight_upload(file.file, file.size)
+    except PreflightError as e:
+        if e.status_code != 400:
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
+        return {
+            "test_passed": False,
+            "hash_used": None,
+            "message": f"ERROR: {e.detail}",
+            "recommendation": "Prueba con una imagen de mayor resolución o menos comprimida"
+        }
+    
     # Leer archivo en memoria
     image_data = await file.read()
     
@@ -175,7 +822,8 @@ async def test_watermark_algorithm(
     test_hash = hashlib.sha256(f"test_{uuid.uuid4().hex}".encode()).hexdigest()
     
     # Probar el algoritmo en memoria
-    success = test_watermark_integrity_memory(image_data, test_hash)
+    async with get_admission().admit(current_user.id, request_cost(info, len(image_data))):
+        success = await run_cpu(test_watermark_integrity_memory, image_data, test_hash)
     
     message = "OK: La imagen es compatible con el algoritmo" if success else "ERROR: La imagen no tiene suficiente calidad para marcas de agua invisibles" 
     
@@ -196,11 +844,12 @@ async def create_debug_image_endpoint(
     if not file.content_type or not file.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="Solo se permiten archivos de imagen")
     
+    info = read_image_info(file.file)
     image_data = await file.read()
     
     # Procesar imagen para crear debug
-    from ..utils.dct_watermark import create_debug_image_memory
-    debug_image_data = create_debug_image_memory(image_data)
+    async with get_admission().admit(current_user.id, request_cost(info, len(image_data))):
+        debug_image_data = await run_cpu(create_debug_image_memory, image_data)
     
     return StreamingResponse(
         BytesIO(debug_image_data),  # ✅ Ahora funcionará
@@ -212,24 +861,171 @@ async def create_debug_image_endpoint(
 async def compare_images_endpoint(
     original: UploadFile = File(..., description="Imagen original"),
     marked: UploadFile = File(..., description="Imagen con watermark"),
+    mode: str = Form("diff"),
+    region: str = Form("full"),
     current_user: User = Depends(get_current_user)
 ):
-    """TEMPORAL: Comparar imagen original vs marcada"""
+    """Comparar imagen original vs marcada.
+
+    mode=diff devuelve un PNG con las diferencias x10; mode=metrics devuelve
+    PSNR, SSIM y error máximo/medio de la luma en JSON. Con region=blocks las
+    métricas se calculan solo sobre los bloques que llevan marca.
+    """
+    if mode not in ("diff", "metrics"):
+        raise HTTPException(status_code=400, detail="Modo no válido. Opciones: diff, metrics")
+    if region not in QUALITY_REGIONS:
+        raise HTTPException(status_code=400, detail=f"Región no válida. Opciones: {', '.join(QUALITY_REGIONS)}")
     
     # Validar archivos
     for f in [original, marked]:
         if not f.content_type or not f.content_type.startswith('image/'):
             raise HTTPException(status_code=400, detail="Solo se permiten archivos de imagen")
     
+    cost = sum(request_cost(read_image_info(f.file), f.size) for f in (original, marked))
     original_data = await original.read()
     marked_data = await marked.read()
     
+    if mode == "metrics":
+        try:
+            async with get_admission().admit(current_user.id, cost):
+                return await run_cpu(compare_quality_memory, original_data, marked_data, region)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
     # Generar imagen de diferencias
-    from ..utils.dct_watermark import compare_images_memory
-    diff_image_data = compare_images_memory(original_data, marked_data)
+    async with get_admission().admit(current_user.id, cost):
+        diff_image_data = await run_cpu(compare_images_memory, original_data, marked_data)
     
     return StreamingResponse(
         BytesIO(diff_image_data),
         media_type="image/png",
         headers={"Content-Disposition": "attachment; filename=differences.png"}
-    )
\ No newline at end of file
+    )
+
+COMPARE_BATCH_FIELDS = (
+    "index", "original", "marked", "status", "width", "height", "pixels",
+    "psnr", "image_psnr", "ssim", "max_error", "mean_error", "detail"
+)
+
+@router.post("/debug/compare-images/batch/")
+async def compare_images_batch(
+    originals: List[UploadFile] = File(...),
+    marked: List[UploadFile] = File(...),
+    region: str = Form("full"),
+    format: str = Form("ndjson"),
+    current_user: User = Depends(get_current_user)
+):
+    """Métricas de calidad de muchos pares (originals[i] con marked[i]) en NDJSON o CSV.
+
+    Las filas salen en el orden de subida según van terminando; un par que
+    falla lleva status=error y no corta el lote.
+    """
+    if region not in QUALITY_REGIONS:
+        raise HTTPException(status_code=400, detail=f"Región no válida. Opciones: {', '.join(QUALITY_REGIONS)}")
+    try:
+        table = TableStreamWriter(format, COMPARE_BATCH_FIELDS)
+    except ValueError:
+        raise HTTPException(
+            status_code=400, detail=f"Formato no válido. Opciones: {', '.join(TABLE_FORMATS)}"
+        )
+    
+    if len(originals) != len(marked):
+        raise HTTPException(status_code=400, detail="Hay que enviar el mismo número de originales y marcadas")
+    if len(originals) > settings.batch_max_files:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Un lote no puede superar los {settings.batch_max_files} pares"
+        )
+    
+    pairs = list(zip(items_from_uploads(originals), items_from_uploads(marked)))
+    user_id = current_user.id
+    executor = get_executor()
+    admission = get_admission()
+    workers = asyncio.Semaphore(executor.workers)
+    
+    async def compare(index, original_item, marked_item):
+        entry = {"index": index, "original": original_item.name, "marked": marked_item.name, "status": "error"}
+        
+        for item in (original_item, marked_item):
+            if not item.is_image:
+                entry["detail"] = "Solo se permiten archivos de imagen"
+                return entry
+            if item.size is not None and item.size > settings.batch_max_file_bytes:
+                entry["detail"] = "El archivo supera el tamaño máximo permitido"
+                return entry
+        
+        # Leer el par solo cuando hay un worker libre para él
+        async with workers:
+            original_data = await original_item.read()
+            marked_data = await marked_item.read()
+            cost = sum(
+                request_cost(read_image_info(BytesIO(data)), len(data)) for data in (original_data, marked_data)
+            )
+            try:
+                async with admission.admit(user_id, cost, max_wait=settings.executor_task_timeout):
+                    metrics = await executor.run(
+                        compare_quality_memory, original_data, marked_data, region,
+                        wait=settings.executor_task_timeout
+                    )
+            except (ExecutorBusyError, AdmissionRejected, BrokenProcessPool):
+                entry["detail"] = "El servidor está ocupado"
+                return entry
+            except ExecutorTimeoutError:
+                entry["detail"] = "La imagen tardó demasiado en procesarse"
+                return entry
+            except ValueError as e:
+                entry["detail"] = str(e)
+                return entry
+            except Exception:
+                logger.exception("Error comparando par del lote", extra={"file": original_item.name})
+                entry["detail"] = "Error interno al comparar las imágenes"
+                return entry
+        
+        entry.update(metrics, status="ok")
+        return entry
+    
+    async def stream():
+        tasks = [asyncio.ensure_future(compare(i, *pair)) for i, pair in enumerate(pairs)]
+        try:
+            yield table.header()
+            for task in tasks:
+                yield table.row(await task)
+        finally:
+            # Si el cliente corta la descarga, no seguir comparando el resto
+            for task in tasks:
+                task.cancel()
+    
+    extension = "csv" if table.format == "csv" else "ndjson"
+    return StreamingResponse(
+        stream(),
+        media_type=table.media_type,
+        headers={"Content-Disposition": f"attachment; filename=quality_metrics.{extension}"}
+    )
+
+@router.post("/debug/encoding-profiles/")
+async def encoding_profiles_endpoint(
+    file: UploadFile = File(...),
+    current_user: User = Depends(get_current_user)
+):
+    """Comparar perfiles de codificación: tiempo, tamaño y supervivencia de la marca"""
+    
+    if not file.content_type or not file.content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="Solo se permiten archivos de imagen")
+    
+    info = read_image_info(file.file)
+    image_data = await file.read()
+    
+    if len(image_data) == 0:
+        raise HTTPException(status_code=400, detail="El archivo está vacío")
+    
+    test_hash = hashlib.sha256(f"test_{uuid.uuid4().hex}".encode()).hexdigest()
+    
+    try:
+        # Se codifica una vez por perfil
+        cost = request_cost(info, len(image_data)) * len(ENCODING_PROFILES)
+        async with get_admission().admit(current_user.id, cost):
+            profiles = await run_cpu(compare_encoding_profiles_memory, image_data, test_hash)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return {"default_profile": settings.default_encoding_profile, "profiles": profiles}
@@ -0,0 +1,197 @@
+import asyncio
+import math
+import time
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Optional
+from fastapi import HTTPException
+from app.core.config import settings
+from app.utils.metrics import ADMISSION_IN_USE, ADMISSION_QUEUE_DEPTH, ADMISSION_REJECTIONS, stage
+from app.utils.preflight import ImageInfo
+
+
+class AdmissionRejected(HTTPException):
+    """La petición no cabe en el presupuesto: 429 si es por el usuario, 503 si es global"""
+
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(status_code=status_code, detail=detail, headers={"Retry-After": str(retry_after)})
+        self.retry_after = retry_after
+
+
+def request_cost(info: Optional[ImageInfo], size: Optional[int]) -> int:
+    """Unidades de coste de procesar una imagen: por megapíxeles y por bytes, lo que pese más.
+
+    Decodificar, marcar y codificar escala con los píxeles; sin cabecera
+    conocida (BMP...) solo queda el tamaño del fichero.
+    """
+    units = 1
+    if info is not None:
+        units = max(units, math.ceil(info.pixels / settings.admission_unit_pixels))
+    if size:
+        units = max(units, math.ceil(size / settings.admission_unit_bytes))
+    return units
+
+
+class _Waiter:
+    __slots__ = ("user_id", "cost", "future", "enqueued")
+
+    def __init__(self, user_id: int, cost: int, future: asyncio.Future):
+        self.user_id = user_id
+        self.cost = cost
+        self.future = future
+        self.enqueued = time.monotonic()
+
+
+class AdmissionController:
+    """Presupuestos ponderados de concurrencia, global y por usuario, con cola acotada.
+
+    Cada petición ocupa tantas unidades como su coste mientras procesa. Las
+    que no caben esperan como mucho max_wait segundos; las pequeñas pueden
+    adelantar a una grande que no cabe todavía, salvo que esa lleve ya la
+    mitad de max_wait esperando (así una 8K no se queda sin turno para siempre).
+    Una petición más cara que el presupuesto del usuario cuenta como todo ese
+    presupuesto: se ejecuta, pero sola.
+    """
+
+    def __init__(self, budget: int, user_budget: int, max_wait: float, max_queue: int, user_max_queue: int):
+        self.budget = max(1, budget)
+        self.user_budget = max(1, min(user_budget, self.budget))
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.user_max_queue = user_max_queue
+        self.in_use = 0
+        self._user_in_use: Dict[int, int] = defaultdict(int)
+        self._user_queued: Dict[int, int] = defaultdict(int)
+        self._waiters: Deque[_Waiter] = deque()
+        # Segundos por unidad de coste (media móvil) para calcular Retry-After
+        self._seconds_per_unit = 0.5
+
+    def _fits(self, user_id: int, cost: int) -> bool:
+        return (self.in_use + cost <= self.budget
+                and self._user_in_use.get(user_id, 0) + cost <= self.user_budget)
+
+    def _grant(self, user_id: int, cost: int):
+        self.in_use += cost
+        self._user_in_use[user_id] += cost
+        ADMISSION_IN_USE.set(self.in_use)
+
+    def _wake(self):
+        """Dar paso, en orden de llegada, a las que ya caben"""
+        now = time.monotonic()
+        for waiter in list(self._waiters):
+            if waiter.future.done():
+                continue
+            if self._fits(waiter.user_id, waiter.cost):
+                self._dequeue(waiter)
+                self._grant(waiter.user_id, waiter.cost)
+                waiter.future.set_result(None)
+            elif (self._user_in_use.get(waiter.user_id, 0) + waiter.cost <= self.user_budget
+                  and now - waiter.enqueued >= self.max_wait / 2):
+                # Lleva mucho esperando y solo le falta hueco global: nadie la adelanta
+                break
+
+    def _dequeue(self, waiter: _Waiter):
+        self._waiters.remove(waiter)
+        self._user_queued[waiter.user_id] -= 1
+        if not self._user_queued[waiter.user_id]:
+            del self._user_queued[waiter.user_id]
+        ADMISSION_QUEUE_DEPTH.set(len(self._waiters))
+
+    def retry_after(self) -> int:
+        """Segundos hasta que probablemente haya hueco: lo ocupado y en cola entre el presupuesto"""
+        pending = self.in_use + sum(w.cost for w in self._waiters)
+        return int(min(60, max(1, math.ceil(self._seconds_per_unit * pending / self.budget))))
+
+    def _reject(self, user_limited: bool, reason: str) -> AdmissionRejected:
+        ADMISSION_REJECTIONS.inc(1, reason)
+        if user_limited:
+            return AdmissionRejected(
+                429, "Tienes demasiadas imágenes procesándose a la vez, inténtalo de nuevo en unos segundos",
+                self.retry_after()
+            )
+        return AdmissionRejected(
+            503, "El servidor está procesando demasiadas imágenes, inténtalo de nuevo en unos segundos",
+            self.retry_after()
+        )
+
+    async def acquire(self, user_id: int, cost: int, max_wait: Optional[float] = None) -> int:
+        """Esperar hueco para cost unidades; devuelve el coste reservado (para release)"""
+        cost = min(max(1, cost), self.user_budget)
+        waiter = _Waiter(user_id, cost, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        self._user_queued[user_id] += 1
+        # Si cabe ya (aunque sea adelantando a otra que espera) pasa sin cola
+        self._wake()
+        if waiter.future.done():
+            return cost
+
+        if self._user_queued[user_id] > self.user_max_queue:
+            self._dequeue(waiter)
+            raise self._reject(True, "user_queue_full")
+        if len(self._waiters) > self.max_queue:
+            self._dequeue(waiter)
+            raise self._reject(False, "queue_full")
+        ADMISSION_QUEUE_DEPTH.set(len(self._waiters))
+
+        try:
+            # asyncio.timeout y no wait_for: en 3.11 wait_for se traga una cancelación
+            # que llega con el hueco ya concedido y la plaza no se soltaría aquí
+            async with asyncio.timeout(self.max_wait if max_wait is None else max_wait):
+                await asyncio.shield(waiter.future)
+        except asyncio.TimeoutError:
+            if waiter.future.done():
+                # Se concedió justo al vencer el plazo
+                return cost
+            self._dequeue(waiter)
+            user_limited = self._user_in_use.get(user_id, 0) + cost > self.user_budget
+            raise self._reject(user_limited, "user_timeout" if user_limited else "timeout")
+        except asyncio.CancelledError:
+            # El cliente se fue: soltar la plaza si se llegó a conceder
+            if waiter.future.done():
+                self.release(user_id, cost)
+            else:
+                self._dequeue(waiter)
+            raise
+        return cost
+
+    def release(self, user_id: int, cost: int, held: Optional[float] = None):
+        self.in_use -= cost
+        self._user_in_use[user_id] -= cost
+        if not self._user_in_use[user_id]:
+            del self._user_in_use[user_id]
+        if held is not None:
+            self._seconds_per_unit = 0.8 * self._seconds_per_unit + 0.2 * held / cost
+        ADMISSION_IN_USE.set(self.in_use)
+        self._wake()
+
+    @asynccontextmanager
+    async def admit(self, user_id: int, cost: int, max_wait: Optional[float] = None):
+        """Ocupar cost unidades mientras dura el bloque (la espera cuenta como etapa "admission")"""
+        if not settings.admission_enabled:
+            yield
+            return
+        with stage("admission"):
+            cost = await self.acquire(user_id, cost, max_wait)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(user_id, cost, time.monotonic() - start)
+
+
+_controller: Optional[AdmissionController] = None
+
+
+def get_admission() -> AdmissionController:
+    global _controller
+    if _controller is None:
+        # Por defecto, cuatro unidades por worker del pool y la mitad para cada usuario
+        budget = settings.admission_budget or 4 * settings.executor_workers
+        _controller = AdmissionController(
+            budget=budget,
+            user_budget=settings.admission_user_budget or max(1, budget // 2),
+            max_wait=settings.admission_max_wait,
+            max_queue=settings.admission_max_queue,
+            user_max_queue=settings.admission_user_max_queue,
+        )
+    return _controller
@@ -2,15 +2,33 @@ from passlib.context import CryptContext
 from datetime import datetime, timedelta
 from jose import jwt, JWTError
 from app.core.config import settings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import threading
+import time
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# Pool propio para bcrypt: una ráfaga de logins no ocupa los hilos del resto de peticiones
+_password_pool = ThreadPoolExecutor(
+    max_workers=settings.password_hash_workers, thread_name_prefix="bcrypt"
+)
+
 def hash_password(password: str) -> str:
     return pwd_context.hash(password)
 
 def verify_password(plain: str, hashed: str) -> bool:
     return pwd_context.verify(plain, hashed)
 
+async def hash_password_async(password: str) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_password_pool, hash_password, password)
+
+async def verify_password_async(plain: str, hashed: str) -> bool:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_password_pool, verify_password, plain, hashed)
+
 def create_access_token(data: dict) -> str:
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=settings.access_token_expire_minutes)
@@ -21,4 +39,55 @@ def decode_access_token(token: str) -> dict:
     try:
         return jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm])
     except JWTError:
-        raise
\ No newline at end of file
+        raise
+
+
+class PrincipalCache:
+    """Caché LRU de usuarios autenticados por (user_id, exp del token).
+
+    Una entrada vive como mucho `ttl` segundos y nunca más allá de la
+    caducidad del token. invalidate() borra todas las entradas de un usuario:
+    hay que llamarlo siempre que cambien sus datos o credenciales. Solo
+    afecta a este proceso; en los demás workers la entrada caduca con el TTL.
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int, exp: int):
+        key = (user_id, exp)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            user, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return user
+
+    def set(self, user_id: int, exp: int, user):
+        if self.ttl <= 0:
+            return
+        expires_at = min(time.time() + self.ttl, exp)
+        with self._lock:
+            self._entries[(user_id, exp)] = (user, expires_at)
+            self._entries.move_to_end((user_id, exp))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == user_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+principal_cache = PrincipalCache(settings.auth_cache_ttl, settings.auth_cache_max_entries)
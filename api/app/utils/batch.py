@@ -0,0 +1,143 @@
+import asyncio
+import csv
+import io
+import json
+import os
+import zipfile
+from typing import List, Optional, Sequence
+from fastapi import UploadFile
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff"}
+
+
+class BatchItem:
+    """Un archivo de un lote; los bytes se leen solo cuando toca procesarlo"""
+
+    def __init__(self, name: str, upload: Optional[UploadFile] = None,
+                 archive: Optional[zipfile.ZipFile] = None, info: Optional[zipfile.ZipInfo] = None):
+        self.name = name
+        self.upload = upload
+        self.archive = archive
+        self.info = info
+
+    @property
+    def is_image(self) -> bool:
+        if self.upload is not None:
+            return bool(self.upload.content_type and self.upload.content_type.startswith('image/'))
+        return os.path.splitext(self.name)[1].lower() in IMAGE_EXTENSIONS
+
+    @property
+    def size(self) -> Optional[int]:
+        if self.info is not None:
+            return self.info.file_size
+        return self.upload.size if self.upload is not None else None
+
+    async def read(self) -> bytes:
+        if self.upload is not None:
+            return await self.upload.read()
+        return await asyncio.to_thread(self.archive.read, self.info)
+
+
+def items_from_uploads(files: List[UploadFile]) -> List[BatchItem]:
+    return [BatchItem(f.filename or f"image_{i}", upload=f) for i, f in enumerate(files)]
+
+
+def items_from_archive(archive: UploadFile) -> List[BatchItem]:
+    """Listar las entradas de un ZIP subido, sin directorios ni metadatos de macOS"""
+    try:
+        zf = zipfile.ZipFile(archive.file)
+    except zipfile.BadZipFile:
+        raise ValueError("El archivo comprimido no es un ZIP válido")
+
+    return [
+        BatchItem(info.filename, archive=zf, info=info)
+        for info in zf.infolist()
+        if not info.is_dir() and not info.filename.startswith("__MACOSX/")
+    ]
+
+
+class _Sink:
+    """Destino no posicionable para zipfile: acumula lo escrito hasta drenarlo"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class ZipStreamWriter:
+    """Genera un ZIP por trozos para enviarlo mientras se va construyendo"""
+
+    def __init__(self):
+        self._sink = _Sink()
+        # Los PNG ya van comprimidos: guardarlos tal cual es más rápido
+        self._zip = zipfile.ZipFile(self._sink, mode="w", compression=zipfile.ZIP_STORED)
+        self._names = set()
+
+    def unique_name(self, name: str) -> str:
+        base, ext = os.path.splitext(name)
+        candidate = name
+        n = 1
+        while candidate in self._names:
+            candidate = f"{base}_{n}{ext}"
+            n += 1
+        self._names.add(candidate)
+        return candidate
+
+    def add(self, name: str, data: bytes) -> bytes:
+        self._zip.writestr(name, data)
+        return self._sink.drain()
+
+    def close(self) -> bytes:
+        self._zip.close()
+        return self._sink.drain()
+
+
+# Formato de tabla de resultados -> tipo MIME
+TABLE_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+class TableStreamWriter:
+    """Filas de resultados como NDJSON o CSV, una a una para enviarlas en streaming"""
+
+    def __init__(self, table_format: str, fields: Sequence[str]):
+        if table_format not in TABLE_FORMATS:
+            raise ValueError(f"Formato desconocido: {table_format}")
+        self.format = table_format
+        self.fields = list(fields)
+        self.media_type = TABLE_FORMATS[table_format]
+        self._buffer = io.StringIO()
+        self._csv = csv.DictWriter(self._buffer, fieldnames=self.fields, extrasaction="ignore")
+
+    def _drain(self) -> str:
+        text = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return text
+
+    def header(self) -> str:
+        if self.format != "csv":
+            return ""
+        self._csv.writeheader()
+        return self._drain()
+
+    def row(self, entry: dict) -> str:
+        if self.format == "csv":
+            self._csv.writerow({k: "" if entry.get(k) is None else entry.get(k) for k in self.fields})
+            return self._drain()
+        return json.dumps(
+            {k: entry.get(k) for k in self.fields}, ensure_ascii=False, default=str
+        ) + "\n"
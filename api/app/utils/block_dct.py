@@ -0,0 +1,155 @@
+from functools import lru_cache
+from typing import NamedTuple
+import cv2
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+# Geometría del esquema: bloques 8x8 cada 20px en la mitad central
+BLOCK_SIZE = 8
+BLOCK_STRIDE = 20
+COEFF_POS = (4, 4)
+# |coeficiente| por encima del cual un bloque lleva bit (el embebido deja al menos 50)
+BIT_THRESHOLD = 25
+WATERMARK_BITS = 256
+MIN_SIDE = 128
+
+# Subir si cambia la colocación de los bloques: invalida los planes en caché
+ALGORITHM_VERSION = 1
+# Pocas resoluciones de cámara concentran casi todo el tráfico
+PLAN_CACHE_SIZE = 64
+
+
+def _dct_matrix(n: int = BLOCK_SIZE) -> np.ndarray:
+    """Matriz DCT-II ortonormal, la misma que usa cv2.dct"""
+    k = np.arange(n).reshape(-1, 1)
+    x = np.arange(n).reshape(1, -1)
+    c = np.sqrt(2.0 / n) * np.cos(np.pi * (2 * x + 1) * k / (2 * n))
+    c[0, :] = np.sqrt(1.0 / n)
+    return c
+
+
+# Se calcula en float64 y se guarda en float32 como los bloques de luma
+_DCT = _dct_matrix().astype(np.float32)
+_DCT_T = np.ascontiguousarray(_DCT.T)
+
+
+def block_grid(rows: int, cols: int):
+    """Devolver (fila inicial, columna inicial, nº filas, nº columnas) de la rejilla central"""
+    start_row = rows // 4
+    end_row = rows - rows // 4
+    start_col = cols // 4
+    end_col = cols - cols // 4
+
+    n_rows = len(range(start_row, end_row - BLOCK_SIZE, BLOCK_STRIDE))
+    n_cols = len(range(start_col, end_col - BLOCK_SIZE, BLOCK_STRIDE))
+    return start_row, start_col, n_rows, n_cols
+
+
+def block_indices(n_rows: int, n_cols: int, length: int):
+    """Índices (fila, columna) de bloque en el mismo orden que el bucle original"""
+    count = min(n_rows * n_cols, length)
+    idx = np.arange(count)
+    if n_cols == 0:
+        return idx, idx
+    return idx // n_cols, idx % n_cols
+
+
+def block_view(Y: np.ndarray, start_row: int, start_col: int, n_rows: int, n_cols: int,
+               size: int = BLOCK_SIZE) -> np.ndarray:
+    """Vista (n_rows, n_cols, size, size[, canales]) sobre Y sin copiar, escribible"""
+    s0, s1 = Y.strides[:2]
+    base = Y[start_row:, start_col:]
+    return as_strided(
+        base,
+        shape=(n_rows, n_cols, size, size) + Y.shape[2:],
+        strides=(s0 * BLOCK_STRIDE, s1 * BLOCK_STRIDE, s0, s1) + Y.strides[2:],
+    )
+
+
+def _read_only(a: np.ndarray) -> np.ndarray:
+    a.setflags(write=False)
+    return a
+
+
+class GeometryPlan(NamedTuple):
+    """Colocación de los bloques para unas dimensiones: la comparten embed, extract,
+    la imagen de debug y el preflight, así que no pueden divergir"""
+    rows: int
+    cols: int
+    start_row: int
+    start_col: int
+    n_rows: int
+    n_cols: int
+    capacity: int
+    # Bloque (fila, columna) de la rejilla que lleva cada bit, en orden
+    block_r: np.ndarray
+    block_c: np.ndarray
+    # Esquina superior izquierda (y, x) en píxeles de cada bloque que lleva bit
+    origin_y: np.ndarray
+    origin_x: np.ndarray
+
+    @property
+    def bits(self) -> int:
+        """Bits de la marca que caben (como mucho WATERMARK_BITS)"""
+        return len(self.block_r)
+
+    @property
+    def too_small(self) -> bool:
+        return self.rows < MIN_SIDE or self.cols < MIN_SIDE
+
+    def indices(self, length: int = WATERMARK_BITS):
+        """(block_r, block_c) de los primeros `length` bits"""
+        if length <= WATERMARK_BITS:
+            return self.block_r[:length], self.block_c[:length]
+        return block_indices(self.n_rows, self.n_cols, length)
+
+    def view(self, img: np.ndarray, size: int = BLOCK_SIZE) -> np.ndarray:
+        """Vista de la rejilla completa sobre una imagen de estas dimensiones"""
+        return block_view(img, self.start_row, self.start_col, self.n_rows, self.n_cols, size)
+
+
+@lru_cache(maxsize=PLAN_CACHE_SIZE)
+def _cached_plan(rows: int, cols: int, version: int) -> GeometryPlan:
+    start_row, start_col, n_rows, n_cols = block_grid(rows, cols)
+    block_r, block_c = block_indices(n_rows, n_cols, WATERMARK_BITS)
+    return GeometryPlan(
+        rows=rows,
+        cols=cols,
+        start_row=start_row,
+        start_col=start_col,
+        n_rows=n_rows,
+        n_cols=n_cols,
+        capacity=n_rows * n_cols,
+        block_r=_read_only(block_r),
+        block_c=_read_only(block_c),
+        origin_y=_read_only(start_row + block_r * BLOCK_STRIDE),
+        origin_x=_read_only(start_col + block_c * BLOCK_STRIDE),
+    )
+
+
+def geometry_plan(rows: int, cols: int) -> GeometryPlan:
+    """Plan de bloques para una imagen de rows x cols (LRU acotado)"""
+    return _cached_plan(int(rows), int(cols), ALGORITHM_VERSION)
+
+
+def dct_blocks(blocks: np.ndarray) -> np.ndarray:
+    """DCT 2D de un lote (N, 8, 8) de bloques"""
+    return _DCT @ blocks @ _DCT_T
+
+
+def idct_blocks(coeffs: np.ndarray) -> np.ndarray:
+    """IDCT 2D de un lote (N, 8, 8) de coeficientes"""
+    return _DCT_T @ coeffs @ _DCT
+
+
+def coefficient_map(Y: np.ndarray) -> np.ndarray:
+    """Coeficiente COEFF_POS de la DCT del bloque 8x8 que empieza en cada píxel.
+
+    El coeficiente es separable (fila de la matriz DCT por columnas y por
+    filas), así que un único sepFilter2D da la respuesta de todos los
+    desplazamientos posibles. Salida de (alto - 7, ancho - 7) en float32.
+    """
+    ky = _DCT[COEFF_POS[0]]
+    kx = _DCT[COEFF_POS[1]]
+    response = cv2.sepFilter2D(Y, cv2.CV_32F, kx, ky, anchor=(0, 0), borderType=cv2.BORDER_CONSTANT)
+    return response[:Y.shape[0] - BLOCK_SIZE + 1, :Y.shape[1] - BLOCK_SIZE + 1]
@@ -0,0 +1,398 @@
+import fcntl
+import logging
+import multiprocessing
+import os
+import sqlite3
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Iterator, List, NamedTuple, Optional
+from sqlalchemy import insert, select
+from app.core.logging import setup_logging
+from app.database import SessionLocal
+from app.models import Watermark
+from app.utils.batch import IMAGE_EXTENSIONS
+from app.utils.dct_watermark import WatermarkPipeline, new_hash_id
+from app.utils.preflight import PreflightError, check_image, read_image_info
+
+logger = logging.getLogger(__name__)
+
+# Estados de un fichero en el diario. PENDING: la salida está escrita pero
+# la marca puede no estar registrada todavía (se resuelve al reanudar)
+OK = "ok"
+PENDING = "pending"
+# Motivos de fallo: son deterministas, así que al reanudar no se repiten
+# salvo con retry_failed
+UNREADABLE = "unreadable"
+DECODE_ERROR = "decode_error"
+TOO_LARGE = "too_large"
+REJECTED = "rejected"
+WRITE_ERROR = "write_error"
+ERROR = "error"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    hash_id TEXT,
+    output TEXT,
+    detail TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_files_status ON files (status);
+"""
+
+
+class FileResult(NamedTuple):
+    """Resultado de marcar un fichero en el pool"""
+    path: str
+    status: str
+    hash_id: Optional[str] = None
+    output: Optional[str] = None
+    detail: Optional[str] = None
+    input_bytes: int = 0
+
+
+class JournalLockedError(Exception):
+    """Otra ejecución está usando el mismo diario"""
+
+
+class BulkJournal:
+    """Diario SQLite de una ejecución: qué ficheros están hechos y cómo terminaron.
+
+    Las rutas se guardan relativas a la raíz de entrada, así que el diario
+    sigue valiendo si el árbol se mueve entero. Solo una ejecución puede
+    usarlo a la vez: dos sobre el mismo árbol marcarían dos veces cada fichero.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._lock = open(db_path + ".lock", "w")
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock.close()
+            raise JournalLockedError(f"Otra ejecución está usando el diario {db_path}")
+        self.conn = sqlite3.connect(db_path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+        self._lock.close()
+
+    def status(self, path: str) -> Optional[str]:
+        row = self.conn.execute("SELECT status FROM files WHERE path = ?", (path,)).fetchone()
+        return row[0] if row else None
+
+    def record(self, results: List[FileResult], status: Optional[str] = None):
+        """Guardar varios resultados en una sola transacción (status sustituye al suyo si se da)"""
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO files (path, status, hash_id, output, detail, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(r.path, status or r.status, r.hash_id, r.output, r.detail, now) for r in results],
+            )
+
+    def pending(self) -> List[sqlite3.Row]:
+        return self.conn.execute(
+            "SELECT path, hash_id, output FROM files WHERE status = ?", (PENDING,)
+        ).fetchall()
+
+    def forget(self, paths: List[str]):
+        with self.conn:
+            self.conn.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in paths])
+
+
+def iter_images(root: str, skip_dirs=(), skip_suffix: Optional[str] = None) -> Iterator[str]:
+    """Rutas relativas de las imágenes bajo root, en orden estable y sin listar el árbol entero.
+
+    skip_suffix descarta las salidas de una ejecución anterior escritas junto
+    a las entradas ("foto.jpg_marked.png").
+    """
+    skip_dirs = {os.path.realpath(d) for d in skip_dirs}
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError as e:
+            logger.warning("No se pudo leer el directorio %s: %s", directory, e)
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if os.path.realpath(entry.path) not in skip_dirs:
+                    subdirs.append(entry.path)
+                continue
+            stem, ext = os.path.splitext(entry.name)
+            if ext.lower() not in IMAGE_EXTENSIONS:
+                continue
+            if skip_suffix and stem.endswith(skip_suffix):
+                continue
+            yield os.path.relpath(entry.path, root)
+        # Recorrer los subdirectorios en orden alfabético
+        stack.extend(reversed(subdirs))
+
+
+def output_base(rel_path: str, root: str, output_root: Optional[str], suffix: str) -> str:
+    """Ruta de salida sin extensión: junto a la entrada o en el mismo sitio de un árbol espejo.
+
+    Conserva la extensión de la entrada ("foto.jpg_marked"): foto.jpg y
+    foto.png del mismo directorio no pueden acabar en la misma salida.
+    """
+    return os.path.join(output_root or root, rel_path + suffix)
+
+
+def mark_file(path: str, rel_path: str, base: str, hash_id: str, profile: str) -> FileResult:
+    """Marcar un fichero del disco y escribir la salida (apto para el pool de procesos)"""
+    try:
+        with open(path, "rb") as f:
+            info = read_image_info(f)
+            image_data = f.read()
+    except OSError as e:
+        return FileResult(rel_path, UNREADABLE, detail=str(e))
+
+    try:
+        check_image(info)
+    except PreflightError as e:
+        return FileResult(rel_path, TOO_LARGE if e.status_code == 413 else REJECTED,
+                          detail=e.detail, input_bytes=len(image_data))
+
+    try:
+        pipeline = WatermarkPipeline(image_data)
+        if pipeline.decode() is None:
+            return FileResult(rel_path, DECODE_ERROR, detail="No se pudo decodificar la imagen",
+                              input_bytes=len(image_data))
+        result = pipeline.run(hash_id, profile)
+    except Exception as e:
+        logger.exception("Error marcando fichero", extra={"file": rel_path})
+        return FileResult(rel_path, ERROR, detail=str(e), input_bytes=len(image_data))
+    if not result.passed:
+        return FileResult(rel_path, REJECTED,
+                          detail="La imagen no tiene suficiente calidad para agregar una marca de agua invisible",
+                          input_bytes=len(image_data))
+
+    output = base + result.encoding.extension
+    try:
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        # Escribir a un temporal y renombrar: nunca queda una salida a medias
+        tmp_path = output + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(result.data)
+        os.replace(tmp_path, output)
+    except OSError as e:
+        return FileResult(rel_path, WRITE_ERROR, detail=str(e), input_bytes=len(image_data))
+    return FileResult(rel_path, OK, hash_id=hash_id, output=output, input_bytes=len(image_data))
+
+
+def _recover_pending(journal: BulkJournal) -> int:
+    """Cerrar los ficheros que quedaron a medias al cortarse la ejecución anterior.
+
+    Si su marca llegó a registrarse, el fichero está hecho; si no, se olvida
+    y se vuelve a marcar (la salida se sobrescribe con un hash nuevo).
+    """
+    pending = journal.pending()
+    if not pending:
+        return 0
+    registered = set()
+    db = SessionLocal()
+    try:
+        for start in range(0, len(pending), 500):
+            hashes = [row[1] for row in pending[start:start + 500]]
+            registered.update(db.execute(select(Watermark.hash_id).where(Watermark.hash_id.in_(hashes))).scalars())
+    finally:
+        db.close()
+
+    done = [FileResult(row[0], OK, hash_id=row[1], output=row[2]) for row in pending if row[1] in registered]
+    journal.record(done)
+    journal.forget([row[0] for row in pending if row[1] not in registered])
+    return len(done)
+
+
+class BulkRun:
+    """Marcar un árbol de ficheros con un pool de procesos, registrando las marcas por lotes.
+
+    Cada lote se apunta primero en el diario como PENDING, luego se inserta
+    en la base de datos en una transacción y por último pasa a OK: si la
+    ejecución se corta en cualquier punto, al reanudar no se pierde ni se
+    duplica ninguna marca.
+    """
+
+    # Función que marca cada fichero en el pool (las pruebas la sustituyen)
+    task = staticmethod(mark_file)
+
+    def __init__(self, root: str, user_id: int, purpose: str, journal_path: str,
+                 output_root: Optional[str] = None, suffix: str = "_marked", profile: str = "png-fast",
+                 workers: int = 1, db_batch: int = 500, retry_failed: bool = False,
+                 flush_interval: float = 5.0, progress_interval: float = 10.0):
+        self.root = root
+        self.user_id = user_id
+        self.purpose = purpose
+        self.output_root = output_root
+        self.suffix = suffix
+        self.profile = profile
+        self.workers = max(1, workers)
+        self.db_batch = max(1, db_batch)
+        self.retry_failed = retry_failed
+        self.flush_interval = flush_interval
+        self.progress_interval = progress_interval
+        self.journal = BulkJournal(journal_path)
+
+        self.counts: Dict[str, int] = {}
+        self.skipped = 0
+        self.input_bytes = 0
+        self.interrupted = False
+        self._done: List[FileResult] = []
+        self._failed: List[FileResult] = []
+        self._last_flush = time.monotonic()
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def _start_pool(self):
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=setup_logging,
+        )
+
+    def _drain(self, in_flight: Dict[Future, str], return_when=ALL_COMPLETED):
+        """Recoger los ficheros terminados; si un worker murió, dar por fallidos los que llevaba el pool.
+
+        Un worker que muere (OOM, fallo nativo) rompe el pool entero: todos los
+        ficheros en vuelo fallan con BrokenProcessPool y no se sabe cuál fue.
+        Se apuntan como error (se reintentan con retry_failed) y se crea un
+        pool nuevo para seguir con el resto del árbol.
+        """
+        finished, _ = wait(in_flight, return_when=return_when)
+        broken = any(isinstance(f.exception(), BrokenProcessPool) for f in finished)
+        if broken:
+            finished, _ = wait(in_flight)
+        for future in finished:
+            rel_path = in_flight.pop(future)
+            if isinstance(future.exception(), BrokenProcessPool):
+                result = FileResult(rel_path, ERROR,
+                                    detail="El proceso que marcaba el fichero terminó de forma inesperada")
+            else:
+                result = future.result()
+            self._collect(result)
+        if broken:
+            logger.error("Un worker del pool terminó de forma inesperada, se crea un pool nuevo")
+            self._pool.shutdown(wait=True)
+            self._start_pool()
+
+    def _submit(self, in_flight: Dict[Future, str], rel_path: str):
+        args = (
+            os.path.join(self.root, rel_path), rel_path,
+            output_base(rel_path, self.root, self.output_root, self.suffix),
+            new_hash_id(self.purpose), self.profile
+        )
+        try:
+            future = self._pool.submit(self.task, *args)
+        except BrokenProcessPool:
+            # El pool se rompió después de la última recogida
+            self._drain(in_flight)
+            future = self._pool.submit(self.task, *args)
+        in_flight[future] = rel_path
+
+    def _should_skip(self, rel_path: str) -> bool:
+        status = self.journal.status(rel_path)
+        if status is None:
+            return False
+        return status == OK or not self.retry_failed
+
+    def _collect(self, result: FileResult):
+        self.counts[result.status] = self.counts.get(result.status, 0) + 1
+        self.input_bytes += result.input_bytes
+        (self._done if result.status == OK else self._failed).append(result)
+        if (len(self._done) >= self.db_batch
+                or time.monotonic() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Registrar las marcas acumuladas con un único INSERT por lotes y apuntarlo en el diario"""
+        if self._failed:
+            self.journal.record(self._failed)
+            self._failed = []
+        if self._done:
+            self.journal.record(self._done, PENDING)
+            db = SessionLocal()
+            try:
+                db.execute(insert(Watermark), [
+                    {"user_id": self.user_id, "hash_id": r.hash_id, "purpose": self.purpose}
+                    for r in self._done
+                ])
+                db.commit()
+            finally:
+                db.close()
+            self.journal.record(self._done)
+            self._done = []
+        self._last_flush = time.monotonic()
+
+    def _log_progress(self, started: float):
+        elapsed = time.perf_counter() - started
+        processed = sum(self.counts.values())
+        logger.info(
+            "Progreso",
+            extra={"processed": processed, "ok": self.counts.get(OK, 0), "skipped": self.skipped,
+                   "files_per_second": round(processed / elapsed, 2) if elapsed else 0.0}
+        )
+
+    def run(self) -> dict:
+        started = time.perf_counter()
+        recovered = _recover_pending(self.journal)
+        if recovered:
+            logger.info("Ficheros pendientes recuperados", extra={"files": recovered})
+
+        skip_dirs = [self.output_root] if self.output_root else []
+        skip_suffix = None if self.output_root else self.suffix
+        # Con el árbol recorriéndose a la vez, no tener más de unos pocos ficheros en vuelo por worker
+        max_in_flight = self.workers * 4
+        in_flight: Dict[Future, str] = {}
+        last_progress = time.monotonic()
+
+        self._start_pool()
+        try:
+            for rel_path in iter_images(self.root, skip_dirs, skip_suffix):
+                if self._should_skip(rel_path):
+                    self.skipped += 1
+                    continue
+                if len(in_flight) >= max_in_flight:
+                    self._drain(in_flight, FIRST_COMPLETED)
+                self._submit(in_flight, rel_path)
+                if time.monotonic() - last_progress >= self.progress_interval:
+                    self._log_progress(started)
+                    last_progress = time.monotonic()
+
+            self._drain(in_flight)
+        except KeyboardInterrupt:
+            # Guardar lo que ya terminó; lo que estaba en vuelo se repite al reanudar
+            self.interrupted = True
+            for future in in_flight:
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    self._collect(future.result())
+        finally:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self.flush()
+            self.journal.close()
+
+        elapsed = time.perf_counter() - started
+        processed = sum(self.counts.values())
+        return {
+            "processed": processed,
+            "ok": self.counts.get(OK, 0),
+            "skipped": self.skipped,
+            "recovered": recovered,
+            "failures": {k: v for k, v in sorted(self.counts.items()) if k != OK},
+            "seconds": round(elapsed, 3),
+            "files_per_second": round(processed / elapsed, 2) if elapsed else 0.0,
+            "input_mb_per_second": round(self.input_bytes / 1e6 / elapsed, 2) if elapsed else 0.0,
+            "interrupted": self.interrupted,
+        }
@@ -2,197 +2,319 @@ import cv2
 import numpy as np
 import hashlib
 import io
+import logging
+import uuid
+from typing import NamedTuple, Optional
 from PIL import Image
+from app.core.config import settings
+from app.utils.block_dct import (
+    BIT_THRESHOLD, BLOCK_SIZE, COEFF_POS, WATERMARK_BITS, dct_blocks, geometry_plan, idct_blocks
+)
+from app.utils.encoding import ENCODING_PROFILES, EncodedImage, detect_format, encode_image
+from app.utils.memory import peak_rss_kb, reset_peak_rss
+from app.utils.metrics import stage
+
+logger = logging.getLogger(__name__)
+
+def new_hash_id(purpose: str) -> str:
+    """Generar hash único para una marca nueva"""
+    raw = purpose + uuid.uuid4().hex
+    return hashlib.sha256(raw.encode()).hexdigest()
 
 def text_to_bits(hexstr, length=256):
     binary = bin(int(hexstr, 16))[2:].zfill(256)
     return [int(b) for b in binary[:length]]
 
-def embed_watermark_memory(image_data: bytes, hash_hex: str) -> bytes:
-    """Procesar imagen directamente en memoria sin guardar archivos"""
-    # Convertir bytes a imagen OpenCV
+def bits_to_hex(bits, length=256) -> str:
+    """Convertir bits extraídos a hex, rellenando con ceros hasta length"""
+    bits = list(bits) + [0] * (length - len(bits))
+    
+    bitstring = "".join(str(b) for b in bits[:length])
+    try:
+        intval = int(bitstring, 2)
+        hexstr = hex(intval)[2:].zfill(64)
+        return hexstr
+    except ValueError:
+        return "0" * 64
+
+def decode_image(image_data: bytes) -> np.ndarray:
+    """Decodificar bytes a imagen OpenCV (BGR)"""
     nparr = np.frombuffer(image_data, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    with stage("decode"):
+        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
     
     if img is None:
         raise ValueError("No se pudo cargar la imagen")
     
-    # Convertir RGB a YCrCb
-    ycrcb = cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb)
-    Y = ycrcb[:,:,0].astype(np.float32)
+    return img
+
+def _embed_bits(Y_blocks: np.ndarray, bits) -> np.ndarray:
+    """Meter un bit por bloque en un lote (N, 8, 8) de luma float32"""
+    with stage("embed"):
+        dct_batch = dct_blocks(Y_blocks)
+
+        # Forzar el signo del coeficiente (4,4) según el bit, con margen de 50
+        original_values = np.abs(dct_batch[:, COEFF_POS[0], COEFF_POS[1]])
+        bits_arr = np.array(bits, dtype=bool)
+        dct_batch[:, COEFF_POS[0], COEFF_POS[1]] = np.where(
+            bits_arr, original_values + 50, -original_values - 50
+        )
+
+        return np.clip(idct_blocks(dct_batch), 0, 255)
+
+def _tiles_to_luma(tiles: np.ndarray):
+    """Convertir a YCrCb solo los bloques (N, 8, 8, 3) y devolver (ycrcb, Y float32)"""
+    with stage("color"):
+        ycrcb = cv2.cvtColor(tiles.reshape(-1, BLOCK_SIZE, 3), cv2.COLOR_BGR2YCrCb)
+    Y = ycrcb[:, :, 0].reshape(-1, BLOCK_SIZE, BLOCK_SIZE).astype(np.float32)
+    return ycrcb, Y
+
+def embed_watermark_array(img: np.ndarray, hash_hex: str, roi: Optional[bool] = None) -> np.ndarray:
+    """Meter la marca en una imagen ya decodificada y devolver la imagen marcada.
+    
+    En modo ROI solo se convierten de color y se pasan a float los bloques que
+    llevan marca, y se escriben de vuelta en `img` (se modifica en el sitio).
+    El modo completo convierte la imagen entera y devuelve una copia.
+    """
+    if roi is None:
+        roi = settings.watermark_roi_mode
     
-    bits = text_to_bits(hash_hex, 256)
-    rows, cols = Y.shape
+    bits = text_to_bits(hash_hex, WATERMARK_BITS)
+    plan = geometry_plan(*img.shape[:2])
     
-    if rows < 128 or cols < 128:
+    if plan.too_small:
         raise ValueError("La imagen es demasiado pequeña")
     
-    # Meter marca en centro de la imagen
-    start_row = rows // 4
-    end_row = rows - rows // 4
-    start_col = cols // 4
-    end_col = cols - cols // 4
-    
-    bit_idx = 0
-    positions = []
-    
-    # Espaciar marcas
-    for i in range(start_row, end_row - 8, 20):  
-        for j in range(start_col, end_col - 8, 20):
-            if bit_idx >= len(bits):
-                break
-                
-            block = Y[i:i+8, j:j+8]
-            dct_block = cv2.dct(block)
-            
-            coeff_pos = (4, 4) 
-            
-            original_value = dct_block[coeff_pos]
-            
-            if bits[bit_idx]:
-                if original_value >= 0:
-                    dct_block[coeff_pos] = original_value + 50
-                else:
-                    dct_block[coeff_pos] = abs(original_value) + 50
-            else:
-                if original_value <= 0:
-                    dct_block[coeff_pos] = original_value - 50
-                else:
-                    dct_block[coeff_pos] = -abs(original_value) - 50
-            
-            idct_block = cv2.idct(dct_block)
-            Y[i:i+8, j:j+8] = np.clip(idct_block, 0, 255)
-            
-            positions.append((i, j))
-            bit_idx += 1
-            
-        if bit_idx >= len(bits):
-            break
+    # Meter marca en centro de la imagen, espaciando los bloques
+    block_r, block_c = plan.block_r, plan.block_c
+    bit_idx = plan.bits
+    
+    if roi:
+        if bit_idx:
+            # Reunir los bloques BGR (N, 8, 8, 3); la conversión de color es por píxel
+            view = plan.view(img)
+            ycrcb, Y = _tiles_to_luma(view[block_r, block_c])
+            ycrcb[:, :, 0] = _embed_bits(Y, bits[:bit_idx]).astype(np.uint8).reshape(-1, BLOCK_SIZE)
+            with stage("color"):
+                view[block_r, block_c] = cv2.cvtColor(ycrcb, cv2.COLOR_YCrCb2BGR).reshape(
+                    -1, BLOCK_SIZE, BLOCK_SIZE, 3
+                )
+        marked_img = img
+    else:
+        # Convertir RGB a YCrCb
+        with stage("color"):
+            ycrcb = cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb)
+            Y = ycrcb[:,:,0].astype(np.float32)
+        
+        # Reunir todos los bloques objetivo en un lote (N, 8, 8) y devolverlos a su sitio
+        view = plan.view(Y)
+        if bit_idx:
+            view[block_r, block_c] = _embed_bits(view[block_r, block_c], bits[:bit_idx])
+        
+        with stage("color"):
+            ycrcb[:,:,0] = Y.astype(np.uint8)
+            marked_img = cv2.cvtColor(ycrcb, cv2.COLOR_YCrCb2BGR)
     
-    print(f"Bits embebidos: {bit_idx}/{len(bits)}")
+    logger.debug("Bits embebidos: %d/%d", bit_idx, len(bits))
     
-    ycrcb[:,:,0] = Y.astype(np.uint8)
-    marked_img = cv2.cvtColor(ycrcb, cv2.COLOR_YCrCb2BGR)
+    return marked_img
+
+def extract_watermark_array(img: np.ndarray, length=256) -> str:
+    """Extraer marca de agua de una imagen ya decodificada (solo convierte los bloques)"""
+    plan = geometry_plan(*img.shape[:2])
+    block_r, block_c = plan.indices(length)
+
+    bits = []
+    if len(block_r):
+        view = plan.view(img)
+        Y = _tiles_to_luma(view[block_r, block_c])[1]
+        with stage("extract"):
+            dct_batch = dct_blocks(Y)
+            bits = (dct_batch[:, COEFF_POS[0], COEFF_POS[1]] > BIT_THRESHOLD).astype(int).tolist()
     
-    # Convertir imagen procesada de vuelta a bytes
-    success, encoded_img = cv2.imencode('.png', marked_img)
-    if not success:
-        raise ValueError("Error al codificar la imagen procesada")
+    logger.debug("Bits extraídos: %d/%d", len(bits), length)
     
-    return encoded_img.tobytes()
+    return bits_to_hex(bits, length)
+
+def embed_watermark_memory(image_data: bytes, hash_hex: str, profile: Optional[str] = None) -> bytes:
+    """Procesar imagen directamente en memoria sin guardar archivos"""
+    img = decode_image(image_data)
+    marked_img = embed_watermark_array(img, hash_hex)
+    
+    # Convertir imagen procesada de vuelta a bytes con el perfil pedido
+    encoded = encode_image(
+        marked_img, profile or settings.default_encoding_profile, detect_format(image_data)
+    )
+    return encoded.data
+
+def bit_survival(hash_hex: str, extracted: str) -> float:
+    """Fracción de los 256 bits de la marca que siguen intactos"""
+    errors = (int(hash_hex, 16) ^ int(extracted, 16)).bit_count()
+    return 1 - errors / 256
 
 def extract_watermark_memory(image_data: bytes, length=256) -> str:
     """Extraer marca de agua directamente de datos en memoria"""
-    # Convertir bytes a imagen OpenCV
-    nparr = np.frombuffer(image_data, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    
-    if img is None:
-        raise ValueError("No se pudo cargar la imagen")
-    
-    ycrcb = cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb)
-    Y = ycrcb[:,:,0].astype(np.float32)
-    
-    rows, cols = Y.shape
-    
-    start_row = rows // 4
-    end_row = rows - rows // 4
-    start_col = cols // 4
-    end_col = cols - cols // 4
-    
-    bits = []
+    img = decode_image(image_data)
+    return extract_watermark_array(img, length)
+
+
+# Perfil al que se recurre si la marca no sobrevive a uno con pérdidas
+LOSSLESS_FALLBACK_PROFILE = "png-fast"
+
+
+class PipelineResult(NamedTuple):
+    passed: bool
+    extracted: Optional[str]
+    data: Optional[bytes]
+    peak_rss_kb: Optional[int] = None
+    encoding: Optional[EncodedImage] = None
+    survival: Optional[float] = None
+
+
+class WatermarkPipeline:
+    """Decodificar una vez, marcar una vez, comprobar en memoria y codificar una sola vez.
     
-    for i in range(start_row, end_row - 8, 20):  
-        for j in range(start_col, end_col - 8, 20):
-            if len(bits) >= length:
-                break
-                
-            block = Y[i:i+8, j:j+8]
-            dct_block = cv2.dct(block)
+    PNG es sin pérdidas, así que extraer de la imagen marcada en memoria da el mismo
+    resultado que codificarla y volver a decodificarla. En modo ROI la marca se
+    escribe directamente sobre la imagen decodificada.
+    """
+
+    def __init__(self, image_data: bytes):
+        self.image_data = image_data
+        self.img = None
+        self.marked_img = None
+
+    def decode(self) -> Optional[np.ndarray]:
+        if self.img is None:
+            nparr = np.frombuffer(self.image_data, np.uint8)
+            with stage("decode"):
+                self.img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        return self.img
+
+    def check(self, hash_hex: str) -> PipelineResult:
+        """Marcar y verificar sin codificar; el resultado no trae bytes"""
+        try:
+            img = self.decode()
             
-            coeff_pos = (4, 4)
-            coeff_value = dct_block[coeff_pos]
+            if img is None:
+                logger.warning("No se pudo cargar la imagen")
+                return PipelineResult(False, None, None)
             
-            bit_value = 1 if coeff_value > 25 else 0
-            bits.append(bit_value)
+            # Verificar tamaño mínimo
+            if geometry_plan(*img.shape[:2]).too_small:
+                height, width = img.shape[:2]
+                logger.info("Imagen demasiado pequeña: %dx%d (mínimo 128x128)", width, height)
+                return PipelineResult(False, None, None)
             
-        if len(bits) >= length:
-            break
-    
-    print(f"Bits extraídos: {len(bits)}/{length}")
-    
-    while len(bits) < length:
-        bits.append(0)
-    
-    bitstring = "".join(str(b) for b in bits[:length])
-    try:
-        intval = int(bitstring, 2)
-        hexstr = hex(intval)[2:].zfill(64)
-        return hexstr
-    except ValueError:
-        return "0" * 64
+            # Marcar una sola vez y extraer de la luma de la imagen marcada
+            self.marked_img = embed_watermark_array(img, hash_hex)
+            with stage("integrity"):
+                extracted = extract_watermark_array(self.marked_img)
+            
+            success = hash_hex == extracted
+            
+            logger.debug(
+                "Test de integridad: %s", "OK" if success else "ERROR",
+                extra={"hash": hash_hex[:16], "extracted": extracted[:16]}
+            )
+            
+            return PipelineResult(success, extracted, None)
+            
+        except Exception as e:
+            logger.error("Error en test de integridad: %s", e)
+            return PipelineResult(False, None, None)
+
+    def encode(self, profile: Optional[str] = None) -> EncodedImage:
+        """Codificar la imagen marcada por check() con un perfil (PNG por defecto)"""
+        if self.marked_img is None:
+            raise ValueError("La imagen todavía no se ha marcado")
+        return encode_image(
+            self.marked_img,
+            profile or settings.default_encoding_profile,
+            detect_format(self.image_data)
+        )
+
+    def survival(self, encoded: EncodedImage, hash_hex: str) -> float:
+        """Fracción de bits que sobreviven a la codificación (1.0 si es sin pérdidas)"""
+        if encoded.lossless:
+            return 1.0
+        with stage("integrity"):
+            return bit_survival(hash_hex, extract_watermark_array(decode_image(encoded.data)))
+
+    def run(self, hash_hex: str, profile: Optional[str] = None) -> PipelineResult:
+        """Marcar, verificar y, si pasa el test, codificar una única vez.
+
+        Si la codificación con pérdidas deja la marca por debajo de
+        MIN_SURVIVAL, se recodifica con LOSSLESS_FALLBACK_PROFILE: no se
+        entrega (ni se registra) una marca que /verify/ no reconocería.
+        """
+        result = self.check(hash_hex)
+        if not result.passed:
+            return result
+        
+        encoded = self.encode(profile)
+        survival = self.survival(encoded, hash_hex)
+        if survival < settings.min_survival:
+            logger.warning(
+                "La marca no sobrevive al perfil %s (%.4f); se codifica sin pérdidas",
+                encoded.profile, survival
+            )
+            encoded = self.encode(LOSSLESS_FALLBACK_PROFILE)
+            survival = self.survival(encoded, hash_hex)
+        return result._replace(data=encoded.data, encoding=encoded, survival=survival)
+
+
+def process_upload_memory(image_data: bytes, hash_hex: str, profile: Optional[str] = None) -> PipelineResult:
+    """Pipeline completo de /upload/ en una sola llamada (apto para el pool de procesos)"""
+    # En el pool de procesos cada worker atiende una petición a la vez, así que el
+    # pico de RSS medido es el de esta petición
+    reset_peak_rss()
+    result = WatermarkPipeline(image_data).run(hash_hex, profile)
+    peak = peak_rss_kb()
+    logger.debug("Pico de RSS: %d kB", peak)
+    return result._replace(peak_rss_kb=peak)
+
+
+def compare_encoding_profiles_memory(image_data: bytes, hash_hex: str) -> list:
+    """Marcar una vez y codificar con cada perfil: tiempo, tamaño y supervivencia de la marca"""
+    pipeline = WatermarkPipeline(image_data)
+    if not pipeline.check(hash_hex).passed:
+        raise ValueError("La imagen no tiene suficiente calidad para agregar una marca de agua invisible")
+    
+    profiles = []
+    for profile in ENCODING_PROFILES:
+        encoded = pipeline.encode(profile)
+        profiles.append({
+            "profile": profile,
+            "format": encoded.extension.lstrip("."),
+            "lossless": encoded.lossless,
+            "encode_ms": round(encoded.encode_ms, 2),
+            "size_bytes": len(encoded.data),
+            "input_size_bytes": len(image_data),
+            "survival": pipeline.survival(encoded, hash_hex)
+        })
+    return profiles
+
 
 def test_watermark_integrity_memory(image_data: bytes, hash_hex: str) -> bool:
     """Función para probar que el watermark funciona correctamente - solo en memoria"""
-    print("TEST: Testeando integridad del watermark en memoria...")
-    
-    try:
-        # Verificar que la imagen se puede cargar
-        nparr = np.frombuffer(image_data, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        if img is None:
-            print("ERROR: No se pudo cargar la imagen")
-            return False
-        
-        # Verificar tamaño mínimo
-        height, width = img.shape[:2]
-        if height < 128 or width < 128:
-            print(f"ERROR: Imagen demasiado pequeña: {width}x{height} (mínimo 128x128)")
-            return False
-        
-        # Procesar imagen con marca en memoria
-        marked_data = embed_watermark_memory(image_data, hash_hex)
-        
-        # Extraer inmediatamente
-        extracted = extract_watermark_memory(marked_data)
-        
-        success = hash_hex == extracted
-        
-        print(f"Hash original: {hash_hex[:16]}...")
-        print(f"Hash extraído: {extracted[:16]}...")
-        print(f"¿Coinciden?: {'OK: SI' if success else 'ERROR: NO'}")
-        
-        return success
-        
-    except Exception as e:
-        print(f"ERROR: Error en test: {str(e)}")
-        return False
+    return WatermarkPipeline(image_data).check(hash_hex).passed
 
 
 def create_debug_image_memory(image_data: bytes) -> bytes:
     """Crear imagen debug EN MEMORIA para ver ubicaciones de watermarks"""
 
-    nparr = np.frombuffer(image_data, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    
-    if img is None:
-        raise ValueError("No se pudo cargar la imagen")
-    
-    ycrcb = cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb)
-    Y = ycrcb[:,:,0].astype(np.float32)
-    
-    rows, cols = Y.shape
-    start_row = rows // 4
-    end_row = rows - rows // 4
-    start_col = cols // 4
-    end_col = cols - cols // 4
+    img = decode_image(image_data)
+    plan = geometry_plan(*img.shape[:2])
     
+    # Marco verde de 9x9 px (como cv2.rectangle de grosor 1) en cada bloque de la rejilla
     debug_img = img.copy()
-    
-    for i in range(start_row, end_row - 8, 20):
-        for j in range(start_col, end_col - 8, 20):
-            cv2.rectangle(debug_img, (j, i), (j+8, i+8), (0, 255, 0), 1)
+    frames = plan.view(debug_img, BLOCK_SIZE + 1)
+    green = (0, 255, 0)
+    frames[:, :, 0] = green
+    frames[:, :, -1] = green
+    frames[:, :, :, 0] = green
+    frames[:, :, :, -1] = green
     
     success, encoded_img = cv2.imencode('.png', debug_img)
     if not success:
@@ -0,0 +1,86 @@
+import time
+from typing import NamedTuple, Optional
+import cv2
+import numpy as np
+from app.utils.metrics import stage
+
+# Perfil -> (extensión, parámetros de cv2.imencode, sin pérdidas)
+ENCODING_PROFILES = {
+    # Parámetros por defecto de OpenCV (nivel 1 + RLE): el comportamiento de siempre
+    "png-fast": (".png", [], True),
+    "png-balanced": (".png", [cv2.IMWRITE_PNG_COMPRESSION, 6], True),
+    "png-small": (".png", [cv2.IMWRITE_PNG_COMPRESSION, 9], True),
+    # Calidad > 100 activa el modo sin pérdidas de WebP en OpenCV
+    "webp-lossless": (".webp", [cv2.IMWRITE_WEBP_QUALITY, 101], True),
+    # Recodificar al formato de origen con calidad alta (con pérdidas si es JPEG/WebP)
+    "source": (None, None, False),
+}
+
+# Formato de origen -> (extensión, parámetros, sin pérdidas) para el perfil "source"
+_SOURCE_FORMATS = {
+    "jpeg": (".jpg", [cv2.IMWRITE_JPEG_QUALITY, 95], False),
+    "webp": (".webp", [cv2.IMWRITE_WEBP_QUALITY, 95], False),
+    "png": (".png", [], True),
+}
+
+MEDIA_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".webp": "image/webp",
+    ".tif": "image/tiff",
+}
+
+
+class EncodedImage(NamedTuple):
+    data: bytes
+    profile: str
+    extension: str
+    media_type: str
+    encode_ms: float
+    lossless: bool
+
+
+def detect_format(image_data: bytes) -> Optional[str]:
+    """Formato de la imagen según su firma (magic bytes)"""
+    head = bytes(image_data[:12])
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def resolve_profile(profile: str, source_format: Optional[str]):
+    """Devolver (extensión, parámetros, sin pérdidas) de un perfil"""
+    if profile not in ENCODING_PROFILES:
+        raise ValueError(f"Perfil de codificación desconocido: {profile}")
+
+    if profile == "source":
+        # Formatos sin equivalente (BMP, TIFF...) se guardan como PNG
+        return _SOURCE_FORMATS.get(source_format, _SOURCE_FORMATS["png"])
+
+    return ENCODING_PROFILES[profile]
+
+
+def encode_image(img: np.ndarray, profile: str, source_format: Optional[str] = None) -> EncodedImage:
+    """Codificar con el perfil pedido midiendo el tiempo de codificación"""
+    extension, params, lossless = resolve_profile(profile, source_format)
+
+    start = time.perf_counter()
+    with stage("encode"):
+        success, encoded_img = cv2.imencode(extension, img, params)
+    encode_ms = (time.perf_counter() - start) * 1000
+
+    if not success:
+        raise ValueError("Error al codificar la imagen procesada")
+
+    return EncodedImage(
+        data=encoded_img.tobytes(),
+        profile=profile,
+        extension=extension,
+        media_type=MEDIA_TYPES[extension],
+        encode_ms=encode_ms,
+        lossless=lossless,
+    )
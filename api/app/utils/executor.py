@@ -0,0 +1,235 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Optional
+from app.core.config import settings
+from app.core.logging import setup_logging
+from app.utils.metrics import record_stages, run_timed
+
+
+class ExecutorBusyError(Exception):
+    """La cola de trabajos CPU está llena"""
+
+
+class ExecutorTimeoutError(Exception):
+    """El trabajo superó el tiempo máximo permitido"""
+
+
+def _run_with_shared_memory(func, args):
+    """Ejecutar func en el worker, leyendo los bytes desde memoria compartida"""
+    handles = []
+    call_args = []
+    for arg in args:
+        if isinstance(arg, _SharedBytes):
+            # Con "spawn" el worker comparte el resource tracker del padre,
+            # que es quien hace unlink del segmento
+            shm = shared_memory.SharedMemory(name=arg.name)
+            view = shm.buf[:arg.size]
+            handles.append((shm, view))
+            call_args.append(view)
+        else:
+            call_args.append(arg)
+
+    error = None
+    result = None
+    try:
+        result = func(*call_args)
+    except Exception as e:
+        # Soltar los frames que aún referencian el buffer compartido
+        error = e.with_traceback(None)
+        error.__context__ = None
+        error.__cause__ = None
+    del call_args
+
+    for shm, view in handles:
+        try:
+            view.release()
+            shm.close()
+        except BufferError:
+            pass
+
+    if error is not None:
+        raise error
+    return result
+
+
+class _SharedBytes:
+    """Referencia serializable a un segmento de memoria compartida"""
+
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+
+
+class WatermarkExecutor:
+    """Ejecuta las funciones CPU de dct_watermark fuera del event loop.
+
+    Con backend "process" los bytes de la imagen se copian una sola vez a
+    memoria compartida y el worker los lee sin pasar por pickle.
+    """
+
+    def __init__(self, backend: str = "process", workers: int = 1,
+                 max_queue: int = 0, timeout: Optional[float] = None):
+        if backend not in ("process", "thread"):
+            raise ValueError(f"Backend de ejecución no soportado: {backend}")
+
+        self.backend = backend
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self.timeout = timeout
+        self._pool: Optional[Executor] = None
+        self._in_flight = 0
+
+    @property
+    def pool(self) -> Executor:
+        if self._pool is None:
+            if self.backend == "process":
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=setup_logging,
+                )
+            else:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def capacity(self) -> int:
+        return self.workers + self.max_queue
+
+    def _share(self, args):
+        segments = []
+        shared_args = []
+        for arg in args:
+            if self.backend == "process" and isinstance(arg, (bytes, bytearray)) and len(arg) > 0:
+                shm = shared_memory.SharedMemory(create=True, size=len(arg))
+                shm.buf[:len(arg)] = arg
+                segments.append(shm)
+                shared_args.append(_SharedBytes(shm.name, len(arg)))
+            else:
+                shared_args.append(arg)
+        return segments, shared_args
+
+    def _submit(self, func, shared_args):
+        # run_timed devuelve también las etapas medidas en el worker
+        if self.backend == "process":
+            return self.pool.submit(_run_with_shared_memory, run_timed, [func] + shared_args)
+        return self.pool.submit(run_timed, func, *shared_args)
+
+    @staticmethod
+    def _unlink(segments):
+        for shm in segments:
+            shm.close()
+            shm.unlink()
+
+    def _discard(self, broken: Executor):
+        """Apagar un pool roto (procesos, colas y tareas pendientes) para que el siguiente uso cree otro"""
+        if self._pool is broken:
+            self._pool = None
+        # Cancelar lo pendiente dispara sus callbacks, que liberan la memoria compartida
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, func, *args) -> Future:
+        """Mandar func(*args) al pool desde un hilo que no es el event loop (bucles de vídeo).
+
+        No pasa por la cola acotada de run(): el llamante limita lo que tiene en vuelo.
+        """
+        pool = self.pool
+        try:
+            return pool.submit(func, *args)
+        except BrokenProcessPool:
+            self._discard(pool)
+            return self.pool.submit(func, *args)
+
+    async def run(self, func, *args, timeout: Optional[float] = None, wait: float = 0):
+        """Ejecutar func(*args) en el pool; rechaza si la cola sigue llena tras `wait` segundos"""
+        if self._in_flight >= self.capacity and wait > 0:
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + wait
+            while self._in_flight >= self.capacity and loop.time() < deadline:
+                await asyncio.sleep(0.05)
+
+        if self._in_flight >= self.capacity:
+            raise ExecutorBusyError("Cola de procesamiento llena")
+
+        segments, shared_args = self._share(args)
+        pool = self.pool
+        try:
+            future = self._submit(func, shared_args)
+        except BrokenProcessPool:
+            # Un worker murió (p. ej. OOM): recrear el pool y reintentar una vez
+            self._discard(pool)
+            pool = self.pool
+            try:
+                future = self._submit(func, shared_args)
+            except Exception:
+                self._unlink(segments)
+                raise
+
+        self._in_flight += 1
+
+        def _release(_):
+            # El hueco y la memoria compartida se liberan cuando el worker termina,
+            # aunque el cliente ya haya recibido el timeout
+            self._in_flight -= 1
+            self._unlink(segments)
+
+        loop = asyncio.get_running_loop()
+
+        def _on_done(f):
+            try:
+                loop.call_soon_threadsafe(_release, f)
+            except RuntimeError:
+                # Event loop ya cerrado (apagado del servidor)
+                _release(f)
+
+        future.add_done_callback(_on_done)
+
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            result, timings = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            future.cancel()
+            raise ExecutorTimeoutError(f"El trabajo superó {timeout}s")
+        except BrokenProcessPool:
+            # Se rompió con el trabajo en vuelo: no reintentar (pudo ser este trabajo
+            # el que lo tumbó), pero dejar un pool nuevo para las siguientes
+            self._discard(pool)
+            raise
+
+        # Sumar las etapas del worker a la petición que lo pidió
+        record_stages(timings)
+        return result
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+_executor: Optional[WatermarkExecutor] = None
+
+
+def get_executor() -> WatermarkExecutor:
+    global _executor
+    if _executor is None:
+        _executor = WatermarkExecutor(
+            backend=settings.executor_backend,
+            workers=settings.executor_workers,
+            max_queue=settings.executor_max_queue,
+            timeout=settings.executor_task_timeout,
+        )
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
@@ -0,0 +1,179 @@
+import logging
+import math
+from typing import NamedTuple, Optional, Sequence, Tuple
+import cv2
+import numpy as np
+from app.core.config import settings
+from app.utils.block_dct import (
+    BIT_THRESHOLD, BLOCK_SIZE, BLOCK_STRIDE, MIN_SIDE, WATERMARK_BITS, coefficient_map
+)
+from app.utils.dct_watermark import bits_to_hex, decode_image
+from app.utils.metrics import stage
+
+logger = logging.getLogger(__name__)
+
+# Fases (dy, dx) módulo el paso de la rejilla que se examinan a fondo
+PHASE_CANDIDATES = 4
+
+
+class SyncResult(NamedTuple):
+    hash_hex: str
+    # 0 = nada distingue la rejilla elegida del fondo, 1 = todos sus bloques marcados y el fondo limpio
+    confidence: float
+    # Esquina (y, x) del bloque del primer bit, en píxeles de la imagen recibida
+    offset_y: int
+    offset_x: int
+    # Columnas de la rejilla original: fijan el orden de los bits
+    n_cols: int
+    # Factor de escala que se deshizo (1.0 = sin reescalar)
+    scale: float
+
+
+class _Candidate(NamedTuple):
+    score: float
+    phase_y: int
+    phase_x: int
+    row: int
+    col: int
+    n_cols: int
+
+
+def _phase_candidates(energy: np.ndarray, count: int) -> Sequence[Tuple[int, int]]:
+    """Las fases (dy, dx) con más energía en su retícula de 20x20 px"""
+    h = energy.shape[0] // BLOCK_STRIDE * BLOCK_STRIDE
+    w = energy.shape[1] // BLOCK_STRIDE * BLOCK_STRIDE
+    scores = energy[:h, :w].reshape(h // BLOCK_STRIDE, BLOCK_STRIDE, w // BLOCK_STRIDE, BLOCK_STRIDE).sum(axis=(0, 2))
+    best = np.argsort(scores, axis=None)[::-1][:count]
+    return [divmod(int(i), BLOCK_STRIDE) for i in best]
+
+
+def _search_lattice(energy: np.ndarray, length: int, min_cols: int) -> Optional[Tuple[float, int, int, int]]:
+    """Mejor (puntuación, fila, columna, n_cols) para una retícula de energías por bloque.
+
+    Los bits van por filas de n_cols bloques, así que la región marcada es un
+    rectángulo de length // n_cols filas más una fila parcial. Con la imagen
+    integral se puntúan todas las esquinas posibles de cada ancho a la vez:
+    energía dentro menos energía en el borde exterior.
+    """
+    ni, nj = energy.shape
+    integral = np.zeros((ni + 3, nj + 3), np.float64)
+    integral[1:, 1:] = np.pad(energy, 1).cumsum(0).cumsum(1)
+
+    best = None
+    for n_cols in range(max(1, min_cols), nj + 1):
+        full_rows, rem = divmod(length, n_cols)
+        rows_needed = full_rows + (rem > 0)
+        if rows_needed > ni:
+            continue
+        # Esquinas posibles, en coordenadas de la retícula con borde de 1
+        ny, nx = ni - rows_needed + 1, nj - n_cols + 1
+
+        def rect(y, x, h, w):
+            return (integral[y + h:y + h + ny, x + w:x + w + nx] - integral[y:y + ny, x + w:x + w + nx]
+                    - integral[y + h:y + h + ny, x:x + nx] + integral[y:y + ny, x:x + nx])
+
+        inside = rect(1, 1, full_rows, n_cols)
+        border = rect(0, 1, 1, n_cols) + rect(1, 0, full_rows, 1) + rect(1, 1 + n_cols, full_rows, 1)
+        if rem:
+            inside = inside + rect(1 + full_rows, 1, 1, rem)
+            border = border + rect(1 + full_rows, 1 + rem, 1, n_cols - rem)
+        score = inside - border
+        i, j = np.unravel_index(int(np.argmax(score)), score.shape)
+        if best is None or score[i, j] > best[0]:
+            best = (float(score[i, j]), int(i), int(j), n_cols)
+    return best
+
+
+def sync_luma(Y: np.ndarray, length: int = WATERMARK_BITS) -> Optional[Tuple[str, float, int, int, int]]:
+    """Buscar la rejilla en una luma a escala original: (hash, confianza, y, x, n_cols)"""
+    rows = Y.shape[0]
+    with stage("sync"):
+        response = coefficient_map(Y)
+        # Energía acotada: un bloque marcado cuenta igual en una zona lisa que en
+        # una con textura, y desempata las fases a 2 px que invierten el signo
+        energy_map = np.minimum(np.abs(response), 2 * BIT_THRESHOLD)
+
+        # El ancho de la rejilla original no se deduce de la imagen recibida (un
+        # recorte lo estrecha y un borde lo ensancha): solo se sabe que las
+        # filas de la marca caben en la retícula
+        min_cols = math.ceil(length / len(range(0, rows - BLOCK_SIZE + 1, BLOCK_STRIDE)))
+
+        best = None
+        for phase_y, phase_x in _phase_candidates(energy_map, PHASE_CANDIDATES):
+            energy = energy_map[phase_y::BLOCK_STRIDE, phase_x::BLOCK_STRIDE]
+            found = _search_lattice(energy, length, min_cols)
+            if found is None:
+                continue
+            score, i, j, n_cols = found
+            if best is None or score > best.score:
+                best = _Candidate(score, phase_y, phase_x, i, j, n_cols)
+
+        if best is None:
+            return None
+
+        k = np.arange(length)
+        ys = best.phase_y + (best.row + k // best.n_cols) * BLOCK_STRIDE
+        xs = best.phase_x + (best.col + k % best.n_cols) * BLOCK_STRIDE
+        values = response[ys, xs]
+        bits = (values > BIT_THRESHOLD).astype(int).tolist()
+
+        # Confianza: bloques claramente marcados en la rejilla elegida menos la
+        # proporción de bloques fuertes en el resto de la retícula
+        lattice = np.abs(response[best.phase_y::BLOCK_STRIDE, best.phase_x::BLOCK_STRIDE]) > BIT_THRESHOLD
+        inside = int((np.abs(values) > BIT_THRESHOLD).sum())
+        background = (int(lattice.sum()) - inside) / max(lattice.size - length, 1)
+        confidence = float(np.clip(inside / length - background, 0.0, 1.0))
+
+    y0 = best.phase_y + best.row * BLOCK_STRIDE
+    x0 = best.phase_x + best.col * BLOCK_STRIDE
+    return bits_to_hex(bits, length), confidence, y0, x0, best.n_cols
+
+
+def extract_watermark_synced(img: np.ndarray, length: int = WATERMARK_BITS,
+                             scales: Optional[Sequence[float]] = None) -> SyncResult:
+    """Extraer la marca de una imagen recortada o con bordes cambiados.
+
+    Prueba cada escala (la 1.0 primero) deshaciendo el reescalado sobre la
+    luma, busca la rejilla y se queda con la de más confianza; para en cuanto
+    una supera settings.verify_sync_stop_confidence.
+    """
+    scales = scales or settings.verify_sync_scales
+    with stage("color"):
+        Y = cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb)[:, :, 0]
+    rows, cols = Y.shape
+
+    best = None
+    for scale in scales:
+        if scale == 1.0:
+            luma = Y
+        else:
+            size = (round(cols / scale), round(rows / scale))
+            if min(size) < MIN_SIDE:
+                continue
+            interpolation = cv2.INTER_AREA if scale > 1.0 else cv2.INTER_CUBIC
+            luma = cv2.resize(Y, size, interpolation=interpolation)
+
+        found = sync_luma(luma, length)
+        if found is None:
+            continue
+        hash_hex, confidence, y0, x0, n_cols = found
+        result = SyncResult(hash_hex, confidence, round(y0 * scale), round(x0 * scale), n_cols, scale)
+        if best is None or result.confidence > best.confidence:
+            best = result
+        if best.confidence >= settings.verify_sync_stop_confidence:
+            break
+
+    if best is None:
+        raise ValueError("La imagen es demasiado pequeña")
+
+    logger.debug(
+        "Rejilla sincronizada",
+        extra={"confidence": round(best.confidence, 4), "offset": (best.offset_y, best.offset_x),
+               "n_cols": best.n_cols, "scale": best.scale}
+    )
+    return best
+
+
+def extract_watermark_synced_memory(image_data: bytes, length: int = WATERMARK_BITS) -> SyncResult:
+    """extract_watermark_synced desde bytes (apto para el pool de procesos)"""
+    return extract_watermark_synced(decode_image(image_data), length)
@@ -0,0 +1,169 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from app.core.config import settings
+from app.models import Watermark
+
+HASH_BITS = 256
+
+
+class HammingIndex:
+    """Índice multi-hash (MIH) para buscar hashes de 256 bits por distancia de Hamming.
+
+    El hash se parte en max_distance + 1 trozos. Por el principio del palomar,
+    cualquier hash a distancia <= max_distance coincide exactamente en al menos
+    un trozo, así que basta con mirar un cubo por trozo y verificar los
+    candidatos con popcount.
+    """
+
+    def __init__(self, max_distance: int):
+        self.max_distance = max_distance
+        n_chunks = min(max_distance + 1, HASH_BITS)
+        bounds = [round(i * HASH_BITS / n_chunks) for i in range(n_chunks + 1)]
+        # (desplazamiento, máscara) de cada trozo, contando desde el bit menos significativo
+        self._chunks = [
+            (start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])
+        ]
+        self._tables: List[Dict[int, List[int]]] = [{} for _ in self._chunks]
+        self._hashes = set()
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def add(self, value: int):
+        if value in self._hashes:
+            return
+        self._hashes.add(value)
+        for table, (shift, mask) in zip(self._tables, self._chunks):
+            table.setdefault((value >> shift) & mask, []).append(value)
+
+    def nearest(self, value: int, max_distance: Optional[int] = None) -> Optional[Tuple[int, int]]:
+        """Devolver (hash, distancia) del más cercano dentro del umbral, o None"""
+        if max_distance is None or max_distance > self.max_distance:
+            max_distance = self.max_distance
+
+        best = None
+        best_distance = max_distance + 1
+        seen = set()
+        for table, (shift, mask) in zip(self._tables, self._chunks):
+            for candidate in table.get((value >> shift) & mask, ()):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                distance = (candidate ^ value).bit_count()
+                if distance < best_distance:
+                    best, best_distance = candidate, distance
+                    if distance == 0:
+                        return best, 0
+        return (best, best_distance) if best is not None else None
+
+
+class _UserPartition:
+    def __init__(self, max_distance: int):
+        self.index = HammingIndex(max_distance)
+        self.last_id = 0
+        # Protege index y last_id; nunca se tiene mientras se consulta la tabla
+        self.lock = threading.Lock()
+
+
+class WatermarkIndex:
+    """Índices de Hamming por usuario, cargados bajo demanda desde la tabla watermarks.
+
+    Cada partición recuerda el último Watermark.id cargado y antes de buscar
+    trae solo las filas nuevas, así que ve también lo que insertan otros
+    procesos (lotes, trabajos, otros workers de uvicorn). La consulta se hace
+    sin ningún lock tomado y cada usuario tiene el suyo: una carga lenta no
+    frena las búsquedas de los demás. Como mucho hay max_users particiones;
+    la menos usada se descarta y se vuelve a cargar cuando haga falta.
+    """
+
+    def __init__(self, max_distance: int, max_users: Optional[int] = None):
+        self.max_distance = max_distance
+        self.max_users = max_users if max_users is not None else settings.hash_index_max_users
+        self._partitions: "OrderedDict[int, _UserPartition]" = OrderedDict()
+        # Solo protege el diccionario de particiones
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._partitions)
+
+    def _partition(self, user_id: int, create: bool = True) -> Optional[_UserPartition]:
+        with self._lock:
+            partition = self._partitions.get(user_id)
+            if partition is not None:
+                self._partitions.move_to_end(user_id)
+            elif create:
+                partition = self._partitions[user_id] = _UserPartition(self.max_distance)
+                while len(self._partitions) > max(self.max_users, 1):
+                    self._partitions.popitem(last=False)
+            return partition
+
+    def add(self, user_id: int, hash_id: str):
+        """Registrar una marca recién insertada (si la partición ya está cargada)"""
+        partition = self._partition(user_id, create=False)
+        if partition is not None:
+            with partition.lock:
+                partition.index.add(int(hash_id, 16))
+
+    def sync(self, db: Session, user_id: int) -> _UserPartition:
+        """Traer las filas nuevas del usuario (consulta a la tabla: llamar fuera del event loop)"""
+        partition = self._partition(user_id)
+        with partition.lock:
+            last_id = partition.last_id
+
+        # Dos syncs a la vez pueden traer las mismas filas: add() las ignora
+        result = db.execute(
+            select(Watermark.id, Watermark.hash_id).where(
+                Watermark.user_id == user_id,
+                Watermark.id > last_id
+            ).execution_options(yield_per=10000)
+        )
+        for chunk in result.partitions():
+            with partition.lock:
+                for wm_id, hash_id in chunk:
+                    partition.index.add(int(hash_id, 16))
+                    partition.last_id = max(partition.last_id, wm_id)
+        return partition
+
+    def last_id(self, db: Session, user_id: int) -> int:
+        """Último Watermark.id del usuario, trayendo antes las filas nuevas"""
+        partition = self.sync(db, user_id)
+        with partition.lock:
+            return partition.last_id
+
+    def nearest(self, db: Session, user_id: int, hash_hex: str,
+                max_distance: Optional[int] = None) -> Optional[Tuple[str, int]]:
+        """Devolver (hash_id, distancia) de la marca del usuario más cercana, o None"""
+        partition = self.sync(db, user_id)
+        with partition.lock:
+            match = partition.index.nearest(int(hash_hex, 16), max_distance)
+        if match is None:
+            return None
+        value, distance = match
+        return format(value, "064x"), distance
+
+
+    def nearest_many(self, db: Session, user_id: int, hashes: Iterable[str],
+                     max_distance: Optional[int] = None) -> Dict[str, Tuple[str, int]]:
+        """Como nearest() para muchos hashes, sincronizando la partición una sola vez"""
+        partition = self.sync(db, user_id)
+        matches = {}
+        with partition.lock:
+            for hash_hex in set(hashes):
+                match = partition.index.nearest(int(hash_hex, 16), max_distance)
+                if match is not None:
+                    value, distance = match
+                    matches[hash_hex] = (format(value, "064x"), distance)
+        return matches
+
+
+_index: Optional[WatermarkIndex] = None
+
+
+def get_watermark_index() -> WatermarkIndex:
+    global _index
+    if _index is None:
+        _index = WatermarkIndex(settings.verify_max_bit_errors)
+    return _index
@@ -0,0 +1,261 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, NamedTuple, Optional, Tuple
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class CachedUpload(NamedTuple):
+    """Respuesta de /upload/ guardada para servir los reintentos tal cual"""
+    hash_id: str
+    # Huella de la petición original (bytes, propósito y perfil)
+    fingerprint: str
+    media_type: str
+    filename: str
+    headers: Dict[str, str]
+    data: bytes
+
+
+def upload_digest(image_data: bytes, purpose: str, profile: str) -> str:
+    """Huella de una subida: lo único que se calcula para servir un reintento"""
+    digest = hashlib.sha256(image_data)
+    digest.update(b"\0" + purpose.encode() + b"\0" + profile.encode())
+    return digest.hexdigest()
+
+
+def cache_key(user_id: int, idempotency_key: Optional[str], digest: str) -> str:
+    """Clave por Idempotency-Key si la hay o por contenido, siempre dentro del usuario"""
+    if idempotency_key:
+        raw = f"{user_id}\0key\0{idempotency_key}"
+    else:
+        raw = f"{user_id}\0content\0{digest}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class EmbedCache:
+    """Caché LRU con TTL de subidas ya marcadas, acotada por bytes.
+
+    Sin directorio, los datos viven en memoria del proceso. Con directorio,
+    cada entrada es <clave>.bin + <clave>.json y el directorio es la única
+    fuente de verdad: lo comparten todos los workers y sobrevive a reinicios.
+    El límite de bytes se aplica al directorio entero con sweep(), que se
+    ejecuta al crear la caché y cada vez que este proceso ha escrito
+    1/SWEEP_FRACTION del límite; entre barridos cada worker puede pasarse
+    como mucho en esa fracción.
+    """
+
+    SWEEP_FRACTION = 16
+    # Un .tmp o una entrada a medias más antigua que esto es de una escritura que murió
+    ORPHAN_AGE = 60
+
+    def __init__(self, ttl: float, max_bytes: int, directory: Optional[str] = None):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.directory = directory or None
+        # Solo en memoria: clave -> (expira, tamaño, entrada)
+        self._entries: "OrderedDict[str, Tuple[float, int, CachedUpload]]" = OrderedDict()
+        self._size = 0
+        # Con directorio: bytes escritos por este proceso desde el último barrido
+        self._written = 0
+        self._lock = threading.Lock()
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self.sweep()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_bytes > 0
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        base = os.path.join(self.directory, key)
+        return base + ".bin", base + ".json"
+
+    def get(self, key: str) -> Optional[CachedUpload]:
+        if self.directory:
+            return self._load(key)
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, _, entry = item
+            if expires_at <= time.time():
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key: str, entry: CachedUpload):
+        if not self.enabled or len(entry.data) > self.max_bytes:
+            return
+        expires_at = time.time() + self.ttl
+        if self.directory:
+            self._store(key, entry, expires_at)
+            with self._lock:
+                self._written += len(entry.data)
+                sweep = self._written * self.SWEEP_FRACTION >= self.max_bytes
+            if sweep:
+                self.sweep()
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (expires_at, len(entry.data), entry)
+            self._size += len(entry.data)
+            while self._size > self.max_bytes and self._entries:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key: str):
+        """Sacar una entrada de memoria; se llama con el lock cogido"""
+        _, size, _ = self._entries.pop(key)
+        self._size -= size
+
+    @staticmethod
+    def _remove(*paths: str):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _store(self, key: str, entry: CachedUpload, expires_at: float):
+        data_path, meta_path = self._paths(key)
+        meta = entry._asdict()
+        del meta["data"]
+        meta["expires_at"] = expires_at
+        # Escribir y renombrar (el .json el último): otro worker nunca ve un fichero a medias
+        for path, content in ((data_path, entry.data), (meta_path, json.dumps(meta).encode())):
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(content)
+            os.replace(tmp, path)
+
+    def _load(self, key: str) -> Optional[CachedUpload]:
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, "rb") as f:
+                meta = json.loads(f.read())
+            with open(data_path, "rb") as f:
+                data = f.read()
+        except (OSError, ValueError):
+            return None
+        expires_at = meta.pop("expires_at")
+        if expires_at <= time.time():
+            self._remove(data_path, meta_path)
+            return None
+        try:
+            # El mtime del .bin es la última vez que se usó (orden del LRU en sweep)
+            os.utime(data_path)
+        except OSError:
+            pass
+        return CachedUpload(data=data, **meta)
+
+    def sweep(self):
+        """Borrar del directorio lo caducado, lo huérfano y, por encima de max_bytes, lo menos usado.
+
+        La caducidad sale del mtime del .json (se escribe una vez) y el uso
+        del mtime del .bin (cada acierto lo renueva), sin abrir ningún fichero.
+        """
+        now = time.time()
+        data_files: Dict[str, Tuple[float, int]] = {}
+        meta_files: Dict[str, float] = {}
+        with os.scandir(self.directory) as it:
+            for item in it:
+                try:
+                    stat = item.stat()
+                except FileNotFoundError:
+                    continue
+                base, ext = os.path.splitext(item.name)
+                if ext == ".tmp":
+                    if stat.st_mtime < now - self.ORPHAN_AGE:
+                        self._remove(item.path)
+                elif ext == ".bin":
+                    data_files[base] = (stat.st_mtime, stat.st_size)
+                elif ext == ".json":
+                    meta_files[base] = stat.st_mtime
+
+        live = []
+        for key in set(data_files) | set(meta_files):
+            data_path, meta_path = self._paths(key)
+            written = meta_files.get(key)
+            if key not in data_files or written is None:
+                # Entrada a medias: se está escribiendo ahora o la escritura murió
+                if max(data_files.get(key, (0, 0))[0], written or 0) < now - self.ORPHAN_AGE:
+                    self._remove(data_path, meta_path)
+            elif written + self.ttl <= now:
+                self._remove(data_path, meta_path)
+            else:
+                used, size = data_files[key]
+                live.append((used, size, key))
+
+        total = sum(size for _, size, _ in live)
+        evicted = 0
+        for used, size, key in sorted(live):
+            if total <= self.max_bytes:
+                break
+            self._remove(*self._paths(key))
+            total -= size
+            evicted += 1
+        with self._lock:
+            self._written = 0
+        if evicted:
+            logger.info("Caché de subidas recortada", extra={"evicted": evicted, "bytes": total})
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+        if self.directory:
+            with os.scandir(self.directory) as it:
+                for item in it:
+                    if item.name.endswith((".bin", ".json", ".tmp")):
+                        self._remove(item.path)
+
+
+class InFlight:
+    """Peticiones con la misma clave en curso: las repetidas esperan a la primera"""
+
+    def __init__(self):
+        self._futures: Dict[str, asyncio.Future] = {}
+
+    async def run(self, key: str, func: Callable[[], Awaitable]):
+        """Devolver (resultado, compartido); compartido es True si lo calculó otra petición"""
+        future = self._futures.get(key)
+        if future is not None:
+            return await asyncio.shield(future), True
+
+        future = asyncio.get_running_loop().create_future()
+        self._futures[key] = future
+        try:
+            result = await func()
+        except BaseException as e:
+            future.set_exception(e)
+            # Marcar la excepción como recogida aunque nadie estuviera esperando
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self._futures[key]
+
+
+_cache: Optional[EmbedCache] = None
+upload_inflight = InFlight()
+
+
+def get_embed_cache() -> EmbedCache:
+    global _cache
+    if _cache is None:
+        _cache = EmbedCache(
+            settings.idempotency_cache_ttl,
+            settings.idempotency_cache_max_bytes,
+            settings.idempotency_cache_dir
+        )
+    return _cache
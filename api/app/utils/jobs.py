@@ -0,0 +1,338 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+from app.core.config import settings
+from app.database import SessionLocal
+from app.models import Watermark
+from app.utils.admission import AdmissionRejected, get_admission, request_cost
+from app.utils.dct_watermark import WatermarkPipeline
+from app.utils.executor import ExecutorBusyError, ExecutorTimeoutError, get_executor
+from app.utils.metrics import stage
+from app.utils.preflight import read_image_info
+
+logger = logging.getLogger(__name__)
+
+# Estados de un trabajo
+QUEUED = "queued"
+PROCESSING = "processing"
+DONE = "done"
+FAILED = "failed"
+EXPIRED = "expired"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    hash_id TEXT NOT NULL,
+    purpose TEXT NOT NULL,
+    filename TEXT,
+    status TEXT NOT NULL,
+    stage TEXT,
+    progress REAL NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS ix_jobs_status_created ON jobs (status, created_at);
+"""
+
+
+class JobStore:
+    """Cola de trabajos en SQLite y almacén de ficheros en disco.
+
+    Es el backend local de referencia: la API y los workers solo comparten
+    el fichero SQLite y el directorio de trabajos, así que pueden correr en
+    procesos (o máquinas con disco compartido) distintos.
+    """
+
+    def __init__(self, db_path: Optional[str] = None, base_dir: Optional[str] = None):
+        self.db_path = db_path or settings.jobs_db_path
+        self.base_dir = base_dir or settings.jobs_dir
+        self.inputs_dir = os.path.join(self.base_dir, "inputs")
+        self.results_dir = os.path.join(self.base_dir, "results")
+        os.makedirs(self.inputs_dir, exist_ok=True)
+        os.makedirs(self.results_dir, exist_ok=True)
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        self.conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def input_path(self, job_id: str) -> str:
+        return os.path.join(self.inputs_dir, job_id)
+
+    def result_path(self, job_id: str) -> str:
+        return os.path.join(self.results_dir, f"{job_id}.png")
+
+    def submit(self, user_id: int, hash_id: str, purpose: str, filename: Optional[str], data: bytes) -> str:
+        """Guardar la imagen de entrada y encolar el trabajo"""
+        job_id = uuid.uuid4().hex
+        # Escribir a un temporal y renombrar para que ningún worker lea un fichero a medias
+        tmp_path = self.input_path(job_id) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self.input_path(job_id))
+
+        self.conn.execute(
+            "INSERT INTO jobs (id, user_id, hash_id, purpose, filename, status, stage, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, user_id, hash_id, purpose, filename, QUEUED, QUEUED, time.time()),
+        )
+        return job_id
+
+    def get(self, job_id: str) -> Optional[sqlite3.Row]:
+        return self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+    def queue_position(self, job: sqlite3.Row) -> Optional[int]:
+        """Posición en la cola (1 = el siguiente), o None si ya no está encolado"""
+        if job["status"] != QUEUED:
+            return None
+        (ahead,) = self.conn.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = ? AND created_at < ?",
+            (QUEUED, job["created_at"]),
+        ).fetchone()
+        return ahead + 1
+
+    def claim(self) -> Optional[str]:
+        """Tomar el trabajo encolado más antiguo de forma atómica"""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute(
+                "SELECT id FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1", (QUEUED,)
+            ).fetchone()
+            if row is None:
+                self.conn.execute("COMMIT")
+                return None
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, stage = ?, started_at = ? WHERE id = ?",
+                (PROCESSING, "starting", time.time(), row["id"]),
+            )
+            self.conn.execute("COMMIT")
+            return row["id"]
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def requeue(self, job_id: str):
+        self.conn.execute(
+            "UPDATE jobs SET status = ?, stage = ?, progress = 0, started_at = NULL WHERE id = ?",
+            (QUEUED, QUEUED, job_id),
+        )
+
+    # Solo se actualiza un trabajo que sigue en proceso: si el worker inline
+    # ya lo dio por fallido (timeout) o purge lo reencoló, un proceso que
+    # termina tarde no debe pisar ese estado.
+    def set_progress(self, job_id: str, stage: str, progress: float):
+        self.conn.execute(
+            "UPDATE jobs SET stage = ?, progress = ? WHERE id = ? AND status = ?",
+            (stage, progress, job_id, PROCESSING),
+        )
+
+    def finish(self, job_id: str) -> bool:
+        """Marcar el trabajo como terminado; False si ya no estaba en proceso"""
+        now = time.time()
+        cursor = self.conn.execute(
+            "UPDATE jobs SET status = ?, stage = ?, progress = 1, finished_at = ?, expires_at = ? "
+            "WHERE id = ? AND status = ?",
+            (DONE, DONE, now, now + settings.jobs_result_ttl, job_id, PROCESSING),
+        )
+        return cursor.rowcount == 1
+
+    def fail(self, job_id: str, error: str) -> bool:
+        """Marcar el trabajo como fallido; False si ya no estaba en proceso"""
+        now = time.time()
+        cursor = self.conn.execute(
+            "UPDATE jobs SET status = ?, stage = ?, error = ?, finished_at = ?, expires_at = ? "
+            "WHERE id = ? AND status = ?",
+            (FAILED, FAILED, error, now, now + settings.jobs_result_ttl, job_id, PROCESSING),
+        )
+        return cursor.rowcount == 1
+
+    def expire(self, job_id: str):
+        self.conn.execute("UPDATE jobs SET status = ?, stage = ? WHERE id = ?", (EXPIRED, EXPIRED, job_id))
+        self._remove(self.result_path(job_id))
+
+    def purge(self) -> int:
+        """Caducar resultados vencidos, borrar los caducados hace tiempo y reencolar trabajos de workers caídos"""
+        now = time.time()
+        expired = self.conn.execute(
+            "SELECT id FROM jobs WHERE status IN (?, ?) AND expires_at < ?", (DONE, FAILED, now)
+        ).fetchall()
+        for row in expired:
+            self.expire(row["id"])
+
+        # Durante JOBS_EXPIRED_RETENTION siguen respondiendo 410; después, 404
+        self.conn.execute(
+            "DELETE FROM jobs WHERE status = ? AND expires_at < ?",
+            (EXPIRED, now - settings.jobs_expired_retention),
+        )
+
+        self.conn.execute(
+            "UPDATE jobs SET status = ?, stage = ?, progress = 0, started_at = NULL "
+            "WHERE status = ? AND started_at < ?",
+            (QUEUED, QUEUED, PROCESSING, now - settings.jobs_stale_after),
+        )
+        return len(expired)
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def process_job(job_id: str) -> str:
+    """Procesar un trabajo ya reclamado: marcar, guardar el resultado y registrar la marca.
+
+    Es una función de módulo para poder ejecutarse en el pool de procesos
+    de la API o directamente en un worker independiente.
+    """
+    store = JobStore()
+    try:
+        job = store.get(job_id)
+        if job is None:
+            return FAILED
+
+        try:
+            with open(store.input_path(job_id), "rb") as f:
+                image_data = f.read()
+
+            store.set_progress(job_id, "decoding", 0.1)
+            pipeline = WatermarkPipeline(image_data)
+            pipeline.decode()
+
+            store.set_progress(job_id, "embedding", 0.3)
+            result = pipeline.check(job["hash_id"])
+            if not result.passed:
+                store.fail(job_id, "La imagen no tiene suficiente calidad para agregar una marca de agua invisible")
+                return FAILED
+
+            store.set_progress(job_id, "encoding", 0.7)
+            marked_data = pipeline.encode("png-fast").data
+            tmp_path = store.result_path(job_id) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(marked_data)
+            os.replace(tmp_path, store.result_path(job_id))
+
+            store.set_progress(job_id, "saving", 0.9)
+            db = SessionLocal()
+            try:
+                watermark = Watermark(user_id=job["user_id"], hash_id=job["hash_id"], purpose=job["purpose"])
+                db.add(watermark)
+                with stage("db_commit"):
+                    db.commit()
+
+                if not store.finish(job_id):
+                    # Se dio por fallido mientras tanto: el cliente nunca recibirá
+                    # esta imagen, así que tampoco debe quedar registrada la marca
+                    logger.warning("Trabajo terminado fuera de plazo, se descarta", extra={"job_id": job_id})
+                    store._remove(store.result_path(job_id))
+                    db.delete(watermark)
+                    db.commit()
+                    return FAILED
+            finally:
+                db.close()
+
+            return DONE
+
+        except Exception:
+            logger.exception("Error procesando trabajo", extra={"job_id": job_id})
+            store._remove(store.result_path(job_id))
+            store.fail(job_id, "Error interno al procesar la imagen")
+            return FAILED
+
+        finally:
+            store._remove(store.input_path(job_id))
+    finally:
+        store.close()
+
+
+def run_worker(poll_interval: Optional[float] = None):
+    """Bucle de un worker independiente: reclamar, procesar y repetir"""
+    poll_interval = poll_interval or settings.jobs_poll_interval
+    store = JobStore()
+    last_purge = 0.0
+    logger.info("Worker de trabajos escuchando en %s", store.db_path)
+    try:
+        while True:
+            if time.time() - last_purge > poll_interval * 30:
+                store.purge()
+                last_purge = time.time()
+
+            job_id = store.claim()
+            if job_id is None:
+                time.sleep(poll_interval)
+                continue
+
+            status = process_job(job_id)
+            logger.info("Trabajo %s: %s", job_id, status, extra={"job_id": job_id, "status": status})
+    finally:
+        store.close()
+
+
+def job_cost(store: JobStore, job_id: str) -> int:
+    """Coste de admisión de un trabajo, leído de la cabecera de su entrada"""
+    path = store.input_path(job_id)
+    with open(path, "rb") as f:
+        return request_cost(read_image_info(f), os.path.getsize(path))
+
+
+async def run_inline_worker(store: Optional[JobStore] = None):
+    """Worker dentro de la API: reclama en un hilo y procesa en el pool de procesos.
+
+    Usa su propia conexión (BEGIN IMMEDIATE no debe mezclarse con las de las
+    rutas) y todo acceso a SQLite va por asyncio.to_thread: con la base de
+    datos bloqueada, claim() puede esperar hasta 30 s sin parar el event loop.
+    Cada trabajo pasa por el mismo control de admisión que las rutas; si no
+    cabe, vuelve a la cola.
+    """
+    store = store or JobStore()
+    poll_interval = settings.jobs_poll_interval
+    last_purge = 0.0
+    try:
+        while True:
+            try:
+                if time.time() - last_purge > poll_interval * 30:
+                    await asyncio.to_thread(store.purge)
+                    last_purge = time.time()
+
+                job_id = await asyncio.to_thread(store.claim)
+                if job_id is None:
+                    await asyncio.sleep(poll_interval)
+                    continue
+
+                job = await asyncio.to_thread(store.get, job_id)
+                cost = await asyncio.to_thread(job_cost, store, job_id)
+                try:
+                    # Comparte presupuesto con las rutas: los trabajos no se cuelan delante
+                    async with get_admission().admit(job["user_id"], cost, max_wait=settings.executor_task_timeout):
+                        await get_executor().run(process_job, job_id, wait=settings.executor_task_timeout)
+                except (ExecutorBusyError, AdmissionRejected, BrokenProcessPool):
+                    # Devolverlo a la cola; otro worker (o este más tarde) lo tomará
+                    await asyncio.to_thread(store.requeue, job_id)
+                    await asyncio.sleep(poll_interval)
+                except ExecutorTimeoutError:
+                    await asyncio.to_thread(store.fail, job_id, "La imagen tardó demasiado en procesarse")
+
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Error en worker de trabajos")
+                await asyncio.sleep(poll_interval)
+    finally:
+        store.close()
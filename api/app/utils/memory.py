@@ -0,0 +1,28 @@
+import resource
+
+# Linux: escribir "5" en clear_refs reinicia el pico de RSS (VmHWM) del proceso
+_CLEAR_REFS = "/proc/self/clear_refs"
+_STATUS = "/proc/self/status"
+
+
+def reset_peak_rss() -> bool:
+    """Reiniciar el pico de RSS para medir solo la petición actual"""
+    try:
+        with open(_CLEAR_REFS, "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_kb() -> int:
+    """Pico de RSS en kB desde el último reset (o desde el arranque si no se pudo)"""
+    try:
+        with open(_STATUS) as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    # ru_maxrss va en kB en Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
@@ -0,0 +1,192 @@
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+# Buckets en segundos: de 1 ms a 30 s, suficiente desde la caché de auth hasta un 8K
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """Histograma acumulativo con etiquetas, serializable en formato de texto de Prometheus"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # etiquetas -> [conteo por bucket..., conteo por encima del último, suma]
+        self._series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted(self._series.items())
+            items = [(labels, list(series)) for labels, series in items]
+        for labels, series in items:
+            base = [f'{k}="{v}"' for k, v in zip(self.labelnames, labels)]
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_labels = ",".join(base + ['le="%s"' % le])
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {cumulative}")
+            label_str = "{" + ",".join(base) + "}" if base else ""
+            lines.append(f"{self.name}_sum{label_str} {series[-1]}")
+            lines.append(f"{self.name}_count{label_str} {cumulative}")
+        return lines
+
+
+class Counter:
+    """Contador acumulado con etiquetas, en formato de texto de Prometheus"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, *labels: str):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels: str) -> float:
+        with self._lock:
+            return self._values.get(labels, 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            base = [f'{k}="{v}"' for k, v in zip(self.labelnames, labels)]
+            label_str = "{" + ",".join(base) + "}" if base else ""
+            lines.append(f"{self.name}{label_str} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    """Valor instantáneo con etiquetas (se fija en lugar de acumularse)"""
+
+    def set(self, value: float, *labels: str):
+        with self._lock:
+            self._values[labels] = value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+STAGE_SECONDS = Histogram(
+    "invisignia_stage_seconds", "Duración de cada etapa del procesamiento", ("stage",)
+)
+REQUEST_SECONDS = Histogram(
+    "invisignia_request_seconds", "Duración de las peticiones HTTP", ("method", "route", "status")
+)
+VERIFY_CACHE_REQUESTS = Counter(
+    "invisignia_verify_cache_requests_total", "Consultas a la caché de /verify/ por resultado", ("result",)
+)
+VERIFY_CACHE_SAVED_SECONDS = Counter(
+    "invisignia_verify_cache_saved_seconds_total", "Segundos de extracción y búsqueda ahorrados por los aciertos"
+)
+ADMISSION_IN_USE = Gauge(
+    "invisignia_admission_in_use_units", "Unidades de coste de las peticiones que están procesando"
+)
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "invisignia_admission_queue_depth", "Peticiones esperando hueco en el control de admisión"
+)
+ADMISSION_REJECTIONS = Counter(
+    "invisignia_admission_rejections_total", "Peticiones rechazadas por el control de admisión por motivo",
+    ("reason",)
+)
+STARTUP_SECONDS = Gauge(
+    "invisignia_startup_seconds", "Duración de cada fase del arranque del worker", ("phase",)
+)
+
+# Etapas medidas en la petición (o en la llamada al pool) actual
+_timings: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar("stage_timings", default=None)
+# Etapa abierta: las etapas anidadas cuentan dentro de la exterior
+_active_stage: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("active_stage", default=None)
+
+
+def start_timings() -> list:
+    """Empezar a recoger etapas en el contexto actual y devolver la lista"""
+    timings = []
+    _timings.set(timings)
+    return timings
+
+
+def record_stages(timings: List[Tuple[str, float]]):
+    """Añadir etapas medidas en otro sitio (p. ej. un worker del pool) al contexto actual"""
+    current = _timings.get()
+    if current is not None:
+        current.extend(timings)
+    else:
+        observe_stages(timings)
+
+
+def observe_stages(timings: List[Tuple[str, float]]):
+    for name, seconds in timings:
+        STAGE_SECONDS.observe(seconds, name)
+
+
+@contextmanager
+def stage(name: str):
+    """Medir una etapa; se registra en la petición actual o, si no hay, directamente"""
+    if _active_stage.get() is not None:
+        yield
+        return
+
+    token = _active_stage.set(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        _active_stage.reset(token)
+        record_stages([(name, seconds)])
+
+
+def run_timed(func, *args):
+    """Ejecutar func recogiendo sus etapas; devuelve (resultado, etapas) para el proceso padre"""
+    timings = start_timings()
+    return func(*args), timings
+
+
+def stage_totals(timings: List[Tuple[str, float]]) -> Dict[str, float]:
+    """Segundos por etapa sumando repeticiones, en el orden en que aparecieron"""
+    totals: Dict[str, float] = {}
+    for name, seconds in timings:
+        totals[name] = totals.get(name, 0.0) + seconds
+    return totals
+
+
+def server_timing(timings: List[Tuple[str, float]], total: Optional[float] = None) -> str:
+    """Cabecera Server-Timing con la suma por etapa"""
+    entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in stage_totals(timings).items()]
+    if total is not None:
+        entries.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(entries)
+
+
+def render_metrics() -> str:
+    metrics = (
+        STAGE_SECONDS, REQUEST_SECONDS, VERIFY_CACHE_REQUESTS, VERIFY_CACHE_SAVED_SECONDS,
+        ADMISSION_IN_USE, ADMISSION_QUEUE_DEPTH, ADMISSION_REJECTIONS, STARTUP_SECONDS
+    )
+    return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
@@ -0,0 +1,243 @@
+import json
+import struct
+from typing import BinaryIO, NamedTuple, Optional
+from fastapi import HTTPException
+from PIL import TiffImagePlugin
+from app.core.config import settings
+from app.utils.block_dct import MIN_SIDE, WATERMARK_BITS, geometry_plan
+
+# Marcadores SOF de JPEG (no lo son DHT=C4, JPG=C8 ni DAC=CC)
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# Marcadores sin campo de longitud
+_JPEG_STANDALONE = {0x01, 0xD8} | set(range(0xD0, 0xD8))
+
+
+class ImageInfo(NamedTuple):
+    format: str
+    width: int
+    height: int
+
+    @property
+    def pixels(self) -> int:
+        return self.width * self.height
+
+
+class PreflightError(Exception):
+    """La imagen se descarta antes de decodificarla"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def _read_png(f: BinaryIO) -> Optional[ImageInfo]:
+    f.seek(8)
+    chunk = f.read(16)
+    if len(chunk) < 16 or chunk[4:8] != b"IHDR":
+        return None
+    width, height = struct.unpack(">II", chunk[8:16])
+    return ImageInfo("png", width, height)
+
+
+def _read_jpeg(f: BinaryIO) -> Optional[ImageInfo]:
+    """Recorrer los segmentos saltando su contenido hasta el primer SOF"""
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != b"\xff":
+            continue
+        marker = f.read(1)
+        # Bytes de relleno 0xFF antes del marcador
+        while marker == b"\xff":
+            marker = f.read(1)
+        if not marker:
+            return None
+        code = marker[0]
+        if code in _JPEG_STANDALONE or code == 0x00:
+            continue
+        if code == 0xDA:
+            # Empiezan los datos de la imagen sin haber visto un SOF
+            return None
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            return None
+        (length,) = struct.unpack(">H", length_bytes)
+        if code in _JPEG_SOF:
+            sof = f.read(5)
+            if len(sof) < 5:
+                return None
+            height, width = struct.unpack(">HH", sof[1:5])
+            return ImageInfo("jpeg", width, height)
+        f.seek(length - 2, 1)
+
+
+def _read_webp(f: BinaryIO) -> Optional[ImageInfo]:
+    f.seek(12)
+    chunk = f.read(18)
+    if len(chunk) < 18:
+        return None
+    kind = chunk[:4]
+    if kind == b"VP8 ":
+        # Tras la firma 9D 01 2A van ancho y alto de 14 bits
+        width, height = struct.unpack("<HH", chunk[14:18])
+        return ImageInfo("webp", width & 0x3FFF, height & 0x3FFF)
+    if kind == b"VP8L":
+        (bits,) = struct.unpack("<I", chunk[9:13])
+        return ImageInfo("webp", (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1)
+    if kind == b"VP8X":
+        width = int.from_bytes(chunk[12:15], "little") + 1
+        height = int.from_bytes(chunk[15:18], "little") + 1
+        return ImageInfo("webp", width, height)
+    return None
+
+
+def _read_tiff(f: BinaryIO, head: bytes) -> Optional[ImageInfo]:
+    """Ancho y alto del primer IFD (TIFF clásico o BigTIFF)"""
+    f.seek(8)
+    header = head[:8]
+    if 43 in header[2:4]:
+        header += f.read(8)
+    tags = TiffImagePlugin.ImageFileDirectory_v2(header)
+    f.seek(tags.next)
+    tags.load(f)
+    width, height = tags.get(256), tags.get(257)
+    if not width or not height:
+        return None
+    return ImageInfo("tiff", width, height)
+
+
+def read_image_info(f: BinaryIO) -> Optional[ImageInfo]:
+    """Dimensiones leídas de la cabecera PNG/JPEG/WebP/TIFF, o None si no se reconoce.
+
+    Solo lee unos pocos bytes (en JPEG, salta segmento a segmento) y deja el
+    fichero al principio para poder leerlo entero después.
+    """
+    try:
+        f.seek(0)
+        head = f.read(12)
+        if head.startswith(b"\x89PNG\r\n\x1a\n"):
+            return _read_png(f)
+        if head.startswith(b"\xff\xd8"):
+            return _read_jpeg(f)
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+            return _read_webp(f)
+        if head[:4] in TiffImagePlugin.PREFIXES:
+            return _read_tiff(f, head)
+        return None
+    except (SyntaxError, struct.error):
+        # Cabecera TIFF corrupta: que falle al decodificar como cualquier otra
+        return None
+    finally:
+        f.seek(0)
+
+
+def embedding_capacity(width: int, height: int) -> int:
+    """Número de bloques de la rejilla central, es decir, bits que caben en la imagen"""
+    return geometry_plan(height, width).capacity
+
+
+def check_size(size: Optional[int]):
+    if size is not None and size > settings.max_upload_bytes:
+        raise PreflightError(
+            413, f"El archivo supera el tamaño máximo permitido ({settings.max_upload_bytes // (1024 * 1024)} MB)"
+        )
+
+
+def check_image(info: Optional[ImageInfo], max_pixels: Optional[int] = None) -> Optional[int]:
+    """Validar dimensiones y capacidad; devuelve la capacidad o None si no hay cabecera conocida"""
+    if info is None:
+        # Formatos sin lector de cabecera (BMP...): se validan al decodificar
+        return None
+
+    max_pixels = max_pixels or settings.max_image_pixels
+    if info.pixels > max_pixels:
+        raise PreflightError(
+            413, f"La imagen tiene demasiados píxeles: {info.width}x{info.height} "
+                 f"(máximo {max_pixels} píxeles)"
+        )
+    plan = geometry_plan(info.height, info.width)
+    if plan.too_small:
+        raise PreflightError(
+            400, f"Imagen demasiado pequeña: {info.width}x{info.height} (mínimo {MIN_SIDE}x{MIN_SIDE})"
+        )
+    if plan.capacity < WATERMARK_BITS:
+        raise PreflightError(
+            400, f"La imagen es demasiado pequeña para la marca de agua: caben {plan.capacity} de "
+                 f"{WATERMARK_BITS} bits. Intenta con una imagen de mayor resolución."
+        )
+    return plan.capacity
+
+
+def preflight_upload(f: BinaryIO, size: Optional[int]) -> Optional[ImageInfo]:
+    """Comprobar tamaño, píxeles y capacidad leyendo solo la cabecera"""
+    check_size(size)
+    info = read_image_info(f)
+    check_image(info)
+    return info
+
+
+class _BodyTooLarge(HTTPException):
+    def __init__(self, limit: int):
+        super().__init__(
+            status_code=413,
+            detail=f"El archivo supera el tamaño máximo permitido ({limit // (1024 * 1024)} MB)"
+        )
+
+
+class UploadLimitMiddleware:
+    """Cortar las subidas de las rutas indicadas en cuanto superan el límite de bytes.
+
+    Rechaza por Content-Length antes de leer nada y, si no viene o miente,
+    cuenta los bytes según llegan y aborta el parseo del formulario.
+    """
+
+    # Margen para los campos y cabeceras del multipart
+    OVERHEAD = 64 * 1024
+
+    def __init__(self, app, paths, max_bytes: Optional[int] = None):
+        self.app = app
+        self.paths = set(paths)
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        max_bytes = self.max_bytes or settings.max_upload_bytes
+        limit = max_bytes + self.OVERHEAD
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > limit:
+            await self._reject(send, _BodyTooLarge(max_bytes))
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # FastAPI deja pasar HTTPException al parsear el formulario
+                    raise _BodyTooLarge(max_bytes)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+    @staticmethod
+    async def _reject(send, error: HTTPException):
+        body = json.dumps({"detail": error.detail}, ensure_ascii=False, separators=(",", ":")).encode()
+        await send({
+            "type": "http.response.start",
+            "status": error.status_code,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"connection", b"close"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
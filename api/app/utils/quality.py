@@ -0,0 +1,147 @@
+import math
+from typing import NamedTuple, Optional
+import cv2
+import numpy as np
+from app.utils.block_dct import BLOCK_SIZE, geometry_plan
+from app.utils.dct_watermark import decode_image
+from app.utils.metrics import stage
+
+# Constantes de SSIM (Wang et al. 2004) para un rango de 0 a 255
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+SSIM_WINDOW = 11
+
+# "full": la imagen entera; "blocks": solo los bloques 8x8 que llevan marca
+QUALITY_REGIONS = ("full", "blocks")
+
+
+class QualityMetrics(NamedTuple):
+    region: str
+    width: int
+    height: int
+    # Píxeles comparados (todos, o los de los bloques)
+    pixels: int
+    # Sobre la luma de la región comparada; None si no hay ninguna diferencia
+    psnr: Optional[float]
+    ssim: float
+    max_error: int
+    mean_error: float
+    # Solo con "blocks": PSNR de la imagen entera contando como iguales los píxeles fuera de los bloques
+    image_psnr: Optional[float] = None
+
+
+def _psnr(sse: float, pixels: int) -> Optional[float]:
+    if sse == 0:
+        return None
+    return 10 * math.log10(255 ** 2 * pixels / sse)
+
+
+def _ssim_map(mu_a, mu_b, var_a, var_b, cov):
+    return ((2 * mu_a * mu_b + SSIM_C1) * (2 * cov + SSIM_C2)
+            / ((mu_a ** 2 + mu_b ** 2 + SSIM_C1) * (var_a + var_b + SSIM_C2)))
+
+
+def _gaussian_ssim_map(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    def blur(x):
+        return cv2.GaussianBlur(x, (SSIM_WINDOW, SSIM_WINDOW), 1.5)
+
+    mu_a, mu_b = blur(a), blur(b)
+    var_a = blur(a * a) - mu_a * mu_a
+    var_b = blur(b * b) - mu_b * mu_b
+    cov = blur(a * b) - mu_a * mu_b
+    return _ssim_map(mu_a, mu_b, var_a, var_b, cov)
+
+
+def _gaussian_ssim(a: np.ndarray, b: np.ndarray, changed: np.ndarray) -> float:
+    """SSIM medio con ventana gaussiana 11x11 (sigma 1.5), como la definición original.
+
+    Una ventana sin ningún píxel distinto vale 1, así que el mapa solo se
+    calcula en el rectángulo que rodea los cambios (más el radio de la
+    ventana y el contexto que necesita el desenfoque).
+    """
+    rows = np.flatnonzero(changed.any(axis=1))
+    if not rows.size:
+        return 1.0
+    cols = np.flatnonzero(changed.any(axis=0))
+    h, w = a.shape
+    radius = SSIM_WINDOW // 2
+    # Píxeles cuyo SSIM cambia y, alrededor, los que necesita el desenfoque
+    r0, r1 = max(0, rows[0] - radius), min(h, rows[-1] + radius + 1)
+    c0, c1 = max(0, cols[0] - radius), min(w, cols[-1] + radius + 1)
+    p0, p1 = max(0, r0 - radius), min(h, r1 + radius)
+    q0, q1 = max(0, c0 - radius), min(w, c1 + radius)
+
+    ssim = _gaussian_ssim_map(a[p0:p1, q0:q1], b[p0:p1, q0:q1])[r0 - p0:r1 - p0, c0 - q0:c1 - q0]
+    return float((ssim.sum(dtype=np.float64) + (h * w - ssim.size)) / (h * w))
+
+
+def _block_ssim(a: np.ndarray, b: np.ndarray) -> float:
+    """SSIM medio con una ventana por bloque: a y b son (N, 64)"""
+    mu_a, mu_b = a.mean(axis=1), b.mean(axis=1)
+    da, db = a - mu_a[:, None], b - mu_b[:, None]
+    var_a = (da * da).mean(axis=1)
+    var_b = (db * db).mean(axis=1)
+    cov = (da * db).mean(axis=1)
+    return float(_ssim_map(mu_a, mu_b, var_a, var_b, cov).mean())
+
+
+def _block_luma(img: np.ndarray, block_r: np.ndarray, block_c: np.ndarray) -> np.ndarray:
+    """Luma (N, 64) en float32 de los bloques indicados, sin convertir la imagen entera"""
+    tiles = geometry_plan(*img.shape[:2]).view(img)[block_r, block_c]
+    # BGR2GRAY usa los mismos pesos que la Y de YCrCb de la marca (el redondeo puede variar en 1)
+    luma = cv2.cvtColor(tiles.reshape(-1, BLOCK_SIZE, 3), cv2.COLOR_BGR2GRAY)
+    return luma.reshape(len(block_r), -1).astype(np.float32)
+
+
+def quality_metrics(original: np.ndarray, marked: np.ndarray, region: str = "full") -> QualityMetrics:
+    """PSNR, SSIM y error máximo/medio de la luma entre dos imágenes ya decodificadas.
+
+    Con "blocks" solo se leen los bloques que llevan marca: es exacto cuando
+    la marcada se codificó sin pérdidas, porque el resto de píxeles no cambia.
+    """
+    if region not in QUALITY_REGIONS:
+        raise ValueError(f"Región desconocida: {region}")
+    if original.shape[:2] != marked.shape[:2]:
+        raise ValueError("Las imágenes deben tener las mismas dimensiones")
+    rows, cols = original.shape[:2]
+
+    image_psnr = None
+    if region == "blocks":
+        plan = geometry_plan(rows, cols)
+        if plan.too_small or not plan.bits:
+            raise ValueError("La imagen es demasiado pequeña")
+        with stage("color"):
+            a = _block_luma(original, plan.block_r, plan.block_c)
+            b = _block_luma(marked, plan.block_r, plan.block_c)
+        with stage("metrics"):
+            ssim = _block_ssim(a, b)
+    else:
+        with stage("color"):
+            a = cv2.cvtColor(original, cv2.COLOR_BGR2GRAY).astype(np.float32)
+            b = cv2.cvtColor(marked, cv2.COLOR_BGR2GRAY).astype(np.float32)
+        with stage("metrics"):
+            ssim = _gaussian_ssim(a, b, a != b)
+
+    with stage("metrics"):
+        diff = np.abs(a - b)
+        flat = diff.ravel()
+        sse = float(np.dot(flat, flat))
+        max_error = int(diff.max())
+        mean_error = float(flat.mean())
+    if region == "blocks":
+        image_psnr = _psnr(sse, rows * cols)
+
+    return QualityMetrics(region, cols, rows, flat.size, _psnr(sse, flat.size), ssim, max_error, mean_error,
+                          image_psnr)
+
+
+def compare_quality_memory(original_data: bytes, marked_data: bytes, region: str = "full") -> dict:
+    """quality_metrics desde bytes, redondeado para JSON (apto para el pool de procesos)"""
+    metrics = quality_metrics(decode_image(original_data), decode_image(marked_data), region)
+    result = metrics._asdict()
+    for key in ("psnr", "image_psnr"):
+        if result[key] is not None:
+            result[key] = round(result[key], 4)
+    result["ssim"] = round(metrics.ssim, 6)
+    result["mean_error"] = round(metrics.mean_error, 6)
+    return result
@@ -0,0 +1,344 @@
+import logging
+import mmap
+import os
+import struct
+import zlib
+from typing import BinaryIO, NamedTuple, Optional, Tuple
+import cv2
+import numpy as np
+from PIL import TiffImagePlugin
+from app.core.config import settings
+from app.utils.dct_watermark import embed_watermark_array, extract_watermark_array
+from app.utils.encoding import MEDIA_TYPES
+from app.utils.memory import peak_rss_kb, reset_peak_rss
+from app.utils.metrics import stage
+from app.utils.preflight import read_image_info
+
+logger = logging.getLogger(__name__)
+
+# Etiquetas TIFF que hacen falta para mapear los datos sin decodificar
+_COMPRESSION = 259
+_PHOTOMETRIC = 262
+_BITS_PER_SAMPLE = 258
+_STRIP_OFFSETS = 273
+_SAMPLES_PER_PIXEL = 277
+_STRIP_BYTE_COUNTS = 279
+_PLANAR_CONFIG = 284
+_TILE_WIDTH = 322
+
+
+class TiledResult(NamedTuple):
+    width: int
+    height: int
+    extension: str
+    media_type: str
+    # True si la imagen se mapeó del fichero sin decodificarla a RAM
+    mapped: bool
+    peak_rss_kb: Optional[int] = None
+
+
+def _tiff_layout(f: BinaryIO, header: bytes) -> Optional[Tuple[int, int, int, int]]:
+    """(offset, alto, ancho, canales) si los píxeles se pueden mapear; solo lee el primer IFD.
+
+    Se leen las etiquetas directamente (sin Image.open) para no pasar por
+    el límite anti-bombas de Pillow: los límites los pone el preflight.
+    """
+    if header[2] == 43 or header[3] == 43:
+        header += f.read(8)  # BigTIFF
+    tags = TiffImagePlugin.ImageFileDirectory_v2(header)
+    f.seek(tags.next)
+    tags.load(f)
+
+    spp = tags.get(_SAMPLES_PER_PIXEL, 1)
+    bits = tags.get(_BITS_PER_SAMPLE, (1,))
+    bits = bits if isinstance(bits, tuple) else (bits,)
+    offsets = tags.get(_STRIP_OFFSETS)
+    counts = tags.get(_STRIP_BYTE_COUNTS)
+    if (
+        tags.get(_COMPRESSION, 1) != 1
+        or tags.get(_PHOTOMETRIC) != 2
+        or tags.get(_PLANAR_CONFIG, 1) != 1
+        or spp not in (3, 4)
+        or any(b != 8 for b in bits)
+        or _TILE_WIDTH in tags
+        or not offsets
+        or not counts
+    ):
+        return None
+    offsets = list(offsets) if isinstance(offsets, tuple) else [offsets]
+    counts = list(counts) if isinstance(counts, tuple) else [counts]
+    # Tiras contiguas: un único mapeo cubre toda la imagen
+    for offset, count, next_offset in zip(offsets, counts, offsets[1:]):
+        if offset + count != next_offset:
+            return None
+    width, height = tags.get(256), tags.get(257)
+    if not width or not height or sum(counts) < width * height * spp:
+        return None
+    return offsets[0], height, width, spp
+
+
+def decode_max_pixels() -> int:
+    """Píxeles máximos de lo que no se mapea y hay que decodificar entero en RAM"""
+    return min(settings.tiled_decode_max_pixels, settings.opencv_max_pixels)
+
+
+def is_mappable(f: BinaryIO) -> bool:
+    """Si TiledSource mapeará el fichero en lugar de decodificarlo con OpenCV.
+
+    Deja el fichero al principio, como read_image_info.
+    """
+    try:
+        f.seek(0)
+        header = f.read(8)
+        return header[:4] in TiffImagePlugin.PREFIXES and _tiff_layout(f, header) is not None
+    except (SyntaxError, struct.error):
+        return False
+    finally:
+        f.seek(0)
+
+
+class TiledSource:
+    """Imagen de entrada accesible como array (alto, ancho, canales) sin cargarla entera.
+
+    Un TIFF RGB/RGBA de 8 bits sin comprimir y con tiras contiguas se mapea
+    en memoria directamente desde el fichero (copy-on-write: el original no
+    se toca y solo ocupan RAM las páginas de los bloques marcados). Cualquier
+    otro formato (PNG, JPEG, TIFF LZW/Deflate...) se decodifica entero con
+    OpenCV, así que solo se acepta hasta TILED_DECODE_MAX_PIXELS: por encima,
+    la memoria ya no estaría acotada.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.is_tiff = False
+        self.mapped = False
+        self.rgb = None
+        self.bgr = None
+        self._mmap = None
+        self._data_start = 0
+
+        mapped = None
+        with open(path, "rb") as f:
+            header = f.read(8)
+            self.is_tiff = header[:4] in TiffImagePlugin.PREFIXES
+            if self.is_tiff:
+                mapped = self._map_tiff(f, header)
+
+        if mapped is not None:
+            self.rgb = mapped
+            # Vista BGR sin copiar (canales en orden inverso) para el esquema de OpenCV
+            self.bgr = mapped[..., 2::-1]
+            self.mapped = True
+            self._mmap = mapped._mmap
+            # np.memmap mapea desde el offset alineado a la granularidad
+            self._data_start = mapped.offset % mmap.ALLOCATIONGRANULARITY
+        else:
+            with open(path, "rb") as f:
+                info = read_image_info(f)
+            max_pixels = decode_max_pixels()
+            if info is not None and info.pixels > max_pixels:
+                raise ValueError(
+                    f"La imagen tiene demasiados píxeles para decodificarla: {info.width}x{info.height} "
+                    f"(máximo {max_pixels} salvo TIFF RGB de 8 bits sin comprimir)"
+                )
+            # Sin cabecera conocida (BMP...) solo queda acotar por el tamaño del fichero
+            if info is None and os.path.getsize(path) > 3 * max_pixels:
+                raise ValueError(
+                    f"La imagen es demasiado grande para decodificarla (máximo {max_pixels} píxeles "
+                    f"salvo TIFF RGB de 8 bits sin comprimir)"
+                )
+            with stage("decode"):
+                self.bgr = cv2.imread(path, cv2.IMREAD_COLOR)
+            if self.bgr is None:
+                raise ValueError("No se pudo cargar la imagen")
+
+    def _map_tiff(self, f: BinaryIO, header: bytes) -> Optional[np.ndarray]:
+        """Mapear los píxeles si el TIFF lo permite"""
+        layout = _tiff_layout(f, header)
+        if layout is None:
+            return None
+        offset, height, width, spp = layout
+        return np.memmap(self.path, dtype=np.uint8, mode="c", offset=offset, shape=(height, width, spp))
+
+    @property
+    def height(self) -> int:
+        return self.bgr.shape[0]
+
+    @property
+    def width(self) -> int:
+        return self.bgr.shape[1]
+
+    def rgb_rows(self, y0: int, y1: int) -> np.ndarray:
+        """Filas [y0, y1) en RGB(A) contiguo, listas para escribir"""
+        if self.rgb is not None:
+            return np.ascontiguousarray(self.rgb[y0:y1])
+        return cv2.cvtColor(self.bgr[y0:y1], cv2.COLOR_BGR2RGB)
+
+    def release_rows(self, y0: int, y1: int):
+        """Devolver al sistema las páginas de filas ya escritas.
+
+        Sin esto el RSS acaba incluyendo todo el fichero mapeado. En un mapeo
+        privado las páginas modificadas se descartan, así que solo se llama
+        cuando las filas ya están en la salida.
+        """
+        if self._mmap is None or not hasattr(mmap, "MADV_DONTNEED"):
+            return
+        row_bytes = self.width * self.channels
+        start = self._data_start + y0 * row_bytes
+        end = self._data_start + y1 * row_bytes
+        start -= start % mmap.PAGESIZE
+        end -= end % mmap.PAGESIZE
+        if end > start:
+            self._mmap.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+    @property
+    def channels(self) -> int:
+        return self.rgb.shape[2] if self.rgb is not None else 3
+
+    def close(self):
+        # Soltar el mapeo antes de borrar los temporales
+        self.rgb = None
+        self.bgr = None
+        self._mmap = None
+
+
+def _band_ranges(height: int, band_rows: int):
+    for y0 in range(0, height, band_rows):
+        yield y0, min(y0 + band_rows, height)
+
+
+def write_tiff(f: BinaryIO, source: TiledSource, band_rows: int):
+    """TIFF sin comprimir escrito banda a banda (BigTIFF si no cabe en 4 GB)"""
+    width, height, spp = source.width, source.height, source.channels
+    row_bytes = width * spp
+    bands = list(_band_ranges(height, band_rows))
+    data_bytes = row_bytes * height
+    big = data_bytes + 4096 + 16 * len(bands) > 0xFFFFFFFF
+
+    # Cabecera, datos y después el IFD con los arrays de offsets
+    header_size = 16 if big else 8
+    data_offset = header_size
+    strip_offsets = [data_offset + y0 * row_bytes for y0, _ in bands]
+    strip_counts = [(y1 - y0) * row_bytes for y0, y1 in bands]
+    ifd_offset = data_offset + data_bytes
+    ifd_offset += ifd_offset % 2
+
+    if big:
+        f.write(b"II" + struct.pack("<HHHQ", 43, 8, 0, ifd_offset))
+    else:
+        f.write(b"II" + struct.pack("<HI", 42, ifd_offset))
+
+    for y0, y1 in bands:
+        f.write(source.rgb_rows(y0, y1).tobytes())
+        source.release_rows(y0, y1)
+    if f.tell() < ifd_offset:
+        f.write(b"\0")
+
+    SHORT, LONG, LONG8 = 3, 4, 16
+    offset_type = LONG8 if big else LONG
+    entries = [
+        (256, LONG, [width]),
+        (257, LONG, [height]),
+        (258, SHORT, [8] * spp),
+        (259, SHORT, [1]),
+        (262, SHORT, [2]),
+        (273, offset_type, strip_offsets),
+        (277, SHORT, [spp]),
+        (278, LONG, [band_rows]),
+        (279, offset_type, strip_counts),
+        (284, SHORT, [1]),
+    ]
+    if spp == 4:
+        # Alfa sin premultiplicar
+        entries.append((338, SHORT, [2]))
+
+    sizes = {SHORT: ("H", 2), LONG: ("I", 4), LONG8: ("Q", 8)}
+    inline = 8 if big else 4
+    entry_size = 20 if big else 12
+    count_size = 8 if big else 2
+    next_size = 8 if big else 4
+    extra_offset = ifd_offset + count_size + entry_size * len(entries) + next_size
+
+    ifd = [struct.pack("<Q" if big else "<H", len(entries))]
+    extra = []
+    for tag, typ, values in entries:
+        code, size = sizes[typ]
+        payload = struct.pack(f"<{len(values)}{code}", *values)
+        if len(payload) <= inline:
+            value = payload.ljust(inline, b"\0")
+        else:
+            value = struct.pack("<Q" if big else "<I", extra_offset)
+            extra.append(payload)
+            extra_offset += len(payload)
+        ifd.append(struct.pack("<HHQ" if big else "<HHI", tag, typ, len(values)) + value)
+    ifd.append(b"\0" * next_size)
+    f.write(b"".join(ifd) + b"".join(extra))
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def write_png(f: BinaryIO, source: TiledSource, band_rows: int, level: int = 1):
+    """PNG escrito banda a banda: filtro 0 por fila y zlib incremental"""
+    width, height, spp = source.width, source.height, source.channels
+    color_type = 6 if spp == 4 else 2
+    f.write(b"\x89PNG\r\n\x1a\n")
+    f.write(_png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)))
+
+    compressor = zlib.compressobj(level)
+    for y0, y1 in _band_ranges(height, band_rows):
+        rows = source.rgb_rows(y0, y1).reshape(y1 - y0, width * spp)
+        # Byte de filtro (0 = ninguno) delante de cada fila
+        filtered = np.empty((y1 - y0, width * spp + 1), dtype=np.uint8)
+        filtered[:, 0] = 0
+        filtered[:, 1:] = rows
+        data = compressor.compress(filtered.tobytes())
+        if data:
+            f.write(_png_chunk(b"IDAT", data))
+        source.release_rows(y0, y1)
+    f.write(_png_chunk(b"IDAT", compressor.flush()))
+    f.write(_png_chunk(b"IEND", b""))
+
+
+def embed_watermark_tiled(input_path: str, output_path: str, hash_hex: str) -> TiledResult:
+    """Marcar una imagen grande tocando solo los bloques con marca y escribir por bandas.
+
+    Usa la misma colocación y el mismo embebido que embed_watermark_array en
+    modo ROI, así que extract_watermark_memory sobre la imagen completa lee
+    los mismos bits. Los TIFF se devuelven como TIFF y el resto como PNG.
+    """
+    reset_peak_rss()
+    source = TiledSource(input_path)
+    try:
+        embed_watermark_array(source.bgr, hash_hex, roi=True)
+        with stage("integrity"):
+            extracted = extract_watermark_array(source.bgr)
+        if extracted != hash_hex:
+            raise ValueError("La imagen no tiene suficiente calidad para agregar una marca de agua invisible")
+
+        extension = ".tif" if source.is_tiff else ".png"
+        with stage("encode"), open(output_path, "wb") as f:
+            if source.is_tiff:
+                write_tiff(f, source, settings.tiled_band_rows)
+            else:
+                write_png(f, source, settings.tiled_band_rows)
+
+        peak = peak_rss_kb()
+        logger.info(
+            "Imagen grande marcada por bandas",
+            extra={"width": source.width, "height": source.height, "mapped": source.mapped, "peak_rss_kb": peak}
+        )
+        return TiledResult(source.width, source.height, extension, MEDIA_TYPES[extension], source.mapped, peak)
+    finally:
+        source.close()
+
+
+def extract_watermark_tiled(input_path: str, length: int = 256) -> str:
+    """Extraer la marca de una imagen grande leyendo solo los bloques"""
+    source = TiledSource(input_path)
+    try:
+        return extract_watermark_array(source.bgr, length)
+    finally:
+        source.close()
+
@@ -0,0 +1,23 @@
+import os
+import shutil
+import tempfile
+from fastapi import HTTPException, UploadFile
+from starlette.concurrency import run_in_threadpool
+from app.utils.video import remove_files
+
+
+async def spool_to_disk(file: UploadFile) -> str:
+    """Copiar la subida a un fichero temporal: cv2.VideoCapture y el mapeo de TIFF necesitan una ruta"""
+    suffix = os.path.splitext(file.filename or "")[1] or ".bin"
+    fd, path = tempfile.mkstemp(prefix="invisignia-", suffix=suffix)
+
+    def copy():
+        with os.fdopen(fd, "wb") as out:
+            file.file.seek(0)
+            shutil.copyfileobj(file.file, out, 1024 * 1024)
+            return out.tell()
+
+    if await run_in_threadpool(copy) == 0:
+        remove_files(path)
+        raise HTTPException(status_code=400, detail="El archivo está vacío")
+    return path
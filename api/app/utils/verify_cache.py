@@ -0,0 +1,80 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+from app.core.config import settings
+
+
+class VerifyEntry(NamedTuple):
+    """Resultado de /verify/ para unos bytes concretos de un usuario"""
+    hash_extracted: str
+    # Marca resuelta, o None si no se encontró (se cachea también el 404)
+    record_id: Optional[int]
+    purpose: Optional[str]
+    created_at: Optional[object]
+    bit_errors: int
+    sync: Optional[dict]
+    # Último Watermark.id del usuario al calcularlo; None si el resultado es
+    # definitivo (coincidencia exacta: las marcas no se borran ni cambian)
+    last_id: Optional[int]
+    # Lo que costó calcularlo, para medir el tiempo ahorrado
+    compute_seconds: float
+
+
+def image_digest(image_data: bytes) -> str:
+    """Huella rápida de los bytes (sha256 va por hardware en la mayoría de CPUs)"""
+    return hashlib.sha256(image_data).hexdigest()
+
+
+class VerifyCache:
+    """Caché LRU con TTL de resultados de /verify/ por (usuario, huella).
+
+    Un resultado que una marca nueva podría cambiar (no encontrado o por
+    distancia de Hamming) guarda el último Watermark.id del usuario y solo
+    vale mientras no haya filas nuevas: las inserte este proceso u otro.
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def get(self, user_id: int, digest: str) -> Optional[VerifyEntry]:
+        key = (user_id, digest)
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            entry, expires_at = item
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, user_id: int, digest: str, entry: VerifyEntry):
+        if not self.enabled:
+            return
+        key = (user_id, digest)
+        with self._lock:
+            self._entries[key] = (entry, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, user_id: int, digest: str):
+        with self._lock:
+            self._entries.pop((user_id, digest), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+verify_cache = VerifyCache(settings.verify_cache_ttl, settings.verify_cache_max_entries)
@@ -0,0 +1,231 @@
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Callable, List, NamedTuple, Optional
+import cv2
+import numpy as np
+from app.core.config import settings
+from app.utils.block_dct import WATERMARK_BITS, geometry_plan
+from app.utils.dct_watermark import bit_survival, embed_watermark_array, extract_watermark_array
+from app.utils.executor import ExecutorTimeoutError
+from app.utils.metrics import stage
+
+logger = logging.getLogger(__name__)
+
+# Códec de salida -> (fourcc, extensión, tipo MIME, sin pérdidas)
+VIDEO_CODECS = {
+    # FFV1 es sin pérdidas en luma: la marca sobrevive intacta
+    "ffv1": ("FFV1", ".mkv", "video/x-matroska", True),
+    "mjpeg": ("MJPG", ".avi", "video/x-msvideo", False),
+    "mp4v": ("mp4v", ".mp4", "video/mp4", False),
+}
+
+
+class VideoResult(NamedTuple):
+    frames: int
+    fps: float
+    width: int
+    height: int
+    codec: str
+    extension: str
+    media_type: str
+    # Fracción de bits del hash votado que coinciden con el original (1.0 sin pérdidas)
+    survival: float
+    # Fracción de fotogramas muestreados que dan el hash votado
+    agreement: float
+
+
+class VideoVerification(NamedTuple):
+    hash_hex: str
+    samples: int
+    # Fracción de fotogramas muestreados cuyo hash coincide con el votado
+    agreement: float
+
+
+def _open_capture(path: str) -> cv2.VideoCapture:
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        cap.release()
+        raise ValueError("No se pudo abrir el vídeo")
+    return cap
+
+
+def _read_batch(cap: cv2.VideoCapture, size: int) -> List[np.ndarray]:
+    batch = []
+    while len(batch) < size:
+        ok, frame = cap.read()
+        if not ok:
+            break
+        batch.append(frame)
+    return batch
+
+
+def mark_frames(frames: List[np.ndarray], hash_hex: str) -> List[np.ndarray]:
+    """Marcar un lote de fotogramas (en un worker del pool de procesos)"""
+    for frame in frames:
+        # En modo ROI la marca se escribe sobre el propio fotograma
+        embed_watermark_array(frame, hash_hex, roi=True)
+    return frames
+
+
+def _run_now(func, *args) -> Future:
+    future = Future()
+    future.set_result(func(*args))
+    return future
+
+
+def watermark_video_file(input_path: str, output_path: str, hash_hex: str,
+                         codec: Optional[str] = None, pool=None, workers: Optional[int] = None,
+                         batch_frames: Optional[int] = None, timeout: Optional[float] = None,
+                         progress: Optional[Callable[[int], None]] = None) -> VideoResult:
+    """Marcar todos los fotogramas de un vídeo leyéndolo como stream.
+
+    Leer y escribir son secuenciales, así que se hacen en este hilo; los lotes
+    de fotogramas se marcan en paralelo en `pool` (cualquier objeto con
+    submit(), normalmente el ejecutor de procesos) y se escriben en orden.
+    Como mucho hay 2 lotes por worker en vuelo, así que la memoria no depende
+    de la duración del vídeo. Sin pool se marca en este mismo hilo.
+
+    Con códecs con pérdidas se mide la supervivencia de la marca sobre el
+    fichero escrito y, si queda por debajo de MIN_SURVIVAL, se rechaza el
+    vídeo: la marca no se podría verificar.
+    """
+    codec = codec or settings.video_codec
+    if codec not in VIDEO_CODECS:
+        raise ValueError(f"Códec de vídeo desconocido: {codec}")
+    fourcc, extension, media_type, lossless = VIDEO_CODECS[codec]
+    submit = pool.submit if pool is not None else _run_now
+    workers = workers or settings.video_workers or settings.executor_workers
+    batch_frames = batch_frames or settings.video_batch_frames
+    max_pending = 2 * workers
+    deadline = time.monotonic() + timeout if timeout else None
+
+    cap = _open_capture(input_path)
+    writer = None
+    pending = deque()
+    try:
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+
+        plan = geometry_plan(height, width)
+        if plan.too_small or plan.capacity < WATERMARK_BITS:
+            raise ValueError("El vídeo tiene una resolución demasiado pequeña para la marca de agua")
+
+        writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height))
+        if not writer.isOpened():
+            raise ValueError(f"No se pudo crear el vídeo de salida con el códec {codec}")
+
+        frames = 0
+
+        def write_oldest():
+            nonlocal frames
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                batch = pending.popleft().result(remaining)
+            except FutureTimeoutError:
+                raise ExecutorTimeoutError(f"El vídeo superó {timeout}s")
+            for frame in batch:
+                writer.write(frame)
+            frames += len(batch)
+            if progress is not None:
+                progress(frames)
+
+        with stage("video"):
+            while True:
+                batch = _read_batch(cap, batch_frames)
+                if not batch:
+                    break
+                pending.append(submit(mark_frames, batch, hash_hex))
+                # Búfer acotado: escribir en orden antes de seguir leyendo
+                while len(pending) >= max_pending:
+                    write_oldest()
+                if deadline is not None and time.monotonic() > deadline:
+                    raise ExecutorTimeoutError(f"El vídeo superó {timeout}s")
+            while pending:
+                write_oldest()
+    finally:
+        for future in pending:
+            future.cancel()
+        cap.release()
+        if writer is not None:
+            writer.release()
+
+    if frames == 0:
+        raise ValueError("El vídeo no contiene fotogramas legibles")
+
+    survival, agreement = 1.0, 1.0
+    if not lossless:
+        # Mismo criterio que los perfiles con pérdidas de imagen: medir sobre la salida
+        verification = extract_video_watermark(output_path)
+        survival = bit_survival(hash_hex, verification.hash_hex)
+        agreement = verification.agreement
+        if survival < settings.min_survival:
+            raise ValueError(
+                f"La marca no sobrevive al códec {codec} (supervivencia {survival:.2f}); "
+                f"usa ffv1, que es sin pérdidas"
+            )
+
+    logger.info("Vídeo marcado", extra={
+        "frames": frames, "codec": codec, "width": width, "height": height,
+        "workers": workers, "survival": survival, "agreement": agreement
+    })
+    return VideoResult(frames, fps, width, height, codec, extension, media_type, survival, agreement)
+
+
+def _sample_positions(frame_count: int, samples: int) -> List[int]:
+    """Índices repartidos por todo el vídeo, sin repetir"""
+    if frame_count <= samples:
+        return list(range(frame_count))
+    step = frame_count / samples
+    return sorted({int(step * i + step / 2) for i in range(samples)})
+
+
+def majority_vote(hashes: List[str], length: int = WATERMARK_BITS) -> str:
+    """Voto por mayoría bit a bit entre los hashes extraídos"""
+    counts = [0] * length
+    for hash_hex in hashes:
+        value = int(hash_hex, 16)
+        for i in range(length):
+            counts[i] += (value >> (length - 1 - i)) & 1
+    bits = "".join("1" if 2 * c > len(hashes) else "0" for c in counts)
+    return format(int(bits, 2), f"0{length // 4}x")
+
+
+def extract_video_watermark(path: str, samples: Optional[int] = None) -> VideoVerification:
+    """Extraer la marca de unos pocos fotogramas repartidos y votar el hash"""
+    samples = samples or settings.video_verify_samples
+    cap = _open_capture(path)
+    hashes = []
+    try:
+        with stage("video"):
+            frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            if frame_count > 0:
+                for position in _sample_positions(frame_count, samples):
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, position)
+                    ok, frame = cap.read()
+                    if ok:
+                        hashes.append(extract_watermark_array(frame))
+            else:
+                # Contenedor sin número de fotogramas: usar los primeros
+                for frame in _read_batch(cap, samples):
+                    hashes.append(extract_watermark_array(frame))
+    finally:
+        cap.release()
+
+    if not hashes:
+        raise ValueError("El vídeo no contiene fotogramas legibles")
+
+    voted = majority_vote(hashes)
+    agreement = sum(1 for h in hashes if h == voted) / len(hashes)
+    return VideoVerification(voted, len(hashes), agreement)
+
+
+def remove_files(*paths: str):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,480 @@
+"""Benchmarks del motor de marcas de agua y de la API.
+
+Uso (desde api/):
+    python bench.py engine                    # funciones de dct_watermark en memoria
+    python bench.py api                       # carga de /upload/ y /verify/ contra SQLite
+    python bench.py startup                   # arranque en frío: uvicorn frente a serve.py
+    python bench.py all --output base.json    # ambos, guardando el resultado
+    python bench.py all --compare base.json   # comparar con una ejecución anterior
+
+Las imágenes son sintéticas y deterministas (misma semilla, mismos píxeles),
+así que dos ejecuciones en la misma máquina son comparables entre sí.
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+# Resolución -> (ancho, alto)
+RESOLUTIONS = {
+    "256": (256, 256),
+    "720p": (1280, 720),
+    "1080p": (1920, 1080),
+    "4k": (3840, 2160),
+    "8k": (7680, 4320),
+}
+
+# Formato -> (extensión, parámetros de cv2.imencode)
+FORMATS = {
+    "jpeg": (".jpg", [cv2.IMWRITE_JPEG_QUALITY, 90]),
+    "png": (".png", []),
+    "webp": (".webp", [cv2.IMWRITE_WEBP_QUALITY, 90]),
+}
+
+BENCH_HASH = "a5" * 32
+
+
+def synthetic_image(width: int, height: int, seed: int = 0) -> np.ndarray:
+    """Degradado suave con textura de ruido: parecido a una foto y reproducible"""
+    rng = np.random.default_rng(seed)
+    # Ruido de baja resolución ampliado para que haya estructura y no solo grano
+    coarse = rng.random((max(height // 32, 2), max(width // 32, 2), 3), dtype=np.float32)
+    texture = cv2.resize(coarse, (width, height), interpolation=cv2.INTER_CUBIC)
+    x = np.linspace(0, 1, width, dtype=np.float32)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    gradient = (x + y)[..., None] / 2
+    img = 255 * (0.5 * gradient + 0.5 * texture)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def encode_input(img: np.ndarray, fmt: str) -> bytes:
+    extension, params = FORMATS[fmt]
+    success, encoded = cv2.imencode(extension, img, params)
+    if not success:
+        raise ValueError(f"No se pudo codificar la imagen de prueba como {fmt}")
+    return encoded.tobytes()
+
+
+def percentile(values, q: float) -> float:
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def summarize_ms(samples) -> dict:
+    return {
+        "runs": len(samples),
+        "min_ms": round(min(samples), 3),
+        "p50_ms": round(percentile(samples, 50), 3),
+        "p99_ms": round(percentile(samples, 99), 3),
+        "max_ms": round(max(samples), 3),
+    }
+
+
+def time_call(func, args, repeat: int):
+    """Tiempos en ms y pico de RSS (kB) de varias llamadas a func"""
+    from app.utils.memory import peak_rss_kb, reset_peak_rss
+
+    samples = []
+    reset_peak_rss()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples, peak_rss_kb()
+
+
+def bench_engine(resolutions, formats, repeat: int) -> list:
+    """Medir las funciones en memoria de dct_watermark para cada resolución y formato"""
+    from app.utils.dct_watermark import (
+        compare_images_memory, embed_watermark_memory,
+        extract_watermark_memory, test_watermark_integrity_memory
+    )
+
+    results = []
+    for res in resolutions:
+        width, height = RESOLUTIONS[res]
+        img = synthetic_image(width, height)
+        for fmt in formats:
+            original = encode_input(img, fmt)
+            marked = embed_watermark_memory(original, BENCH_HASH)
+            cases = [
+                ("embed_watermark_memory", embed_watermark_memory, (original, BENCH_HASH)),
+                ("extract_watermark_memory", extract_watermark_memory, (marked,)),
+                ("test_watermark_integrity_memory", test_watermark_integrity_memory, (original, BENCH_HASH)),
+                ("compare_images_memory", compare_images_memory, (original, marked)),
+            ]
+            for name, func, args in cases:
+                samples, peak_kb = time_call(func, args, repeat)
+                row = {
+                    "function": name,
+                    "resolution": res,
+                    "width": width,
+                    "height": height,
+                    "format": fmt,
+                    "input_bytes": len(original),
+                    "peak_rss_kb": peak_kb,
+                    **summarize_ms(samples),
+                }
+                results.append(row)
+                print(f"{name:34s} {res:>6s} {fmt:5s} p50={row['p50_ms']:9.2f}ms "
+                      f"p99={row['p99_ms']:9.2f}ms rss={peak_kb // 1024}MB")
+    return results
+
+
+# --- Carga de la API -------------------------------------------------------
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _multipart(fields: dict, files: dict):
+    """Cuerpo multipart/form-data para urllib (sin dependencias extra)"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        )
+    for name, (filename, data, content_type) in files.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n'.encode() + data + b"\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def _request(url: str, body: bytes = None, content_type: str = None, token: str = None):
+    """(código, cuerpo) de una petición HTTP; los errores HTTP también se devuelven"""
+    headers = {}
+    if content_type:
+        headers["Content-Type"] = content_type
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    req = urllib.request.Request(url, data=body, headers=headers, method="POST" if body is not None else "GET")
+    try:
+        with urllib.request.urlopen(req, timeout=300) as resp:
+            return resp.status, resp.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def _server_peak_rss_kb(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+class LocalServer:
+    """uvicorn (o serve.py) en un subproceso con una base de datos SQLite temporal"""
+
+    def __init__(self, workdir: str, launcher: str = "uvicorn", extra_env: dict = None):
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        env = dict(os.environ)
+        env.update(
+            DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+            JOBS_DIR=os.path.join(workdir, "jobs"),
+            JOBS_DB_PATH=os.path.join(workdir, "jobs", "jobs.db"),
+            ENVIRONMENT="development",
+            **(extra_env or {}),
+        )
+        if launcher == "serve":
+            command = [sys.executable, "serve.py"]
+        else:
+            command = [sys.executable, "-m", "uvicorn", "main:app"]
+        self.started = time.perf_counter()
+        self.process = subprocess.Popen(
+            command + ["--host", "127.0.0.1", "--port", str(self.port), "--log-level", "warning"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=env,
+        )
+
+    def wait_ready(self, timeout: float = 60, poll: float = 0.2):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("El servidor de pruebas terminó al arrancar")
+            try:
+                if _request(self.url + "/health")[0] == 200:
+                    return
+            except OSError:
+                pass
+            time.sleep(poll)
+        raise RuntimeError("El servidor de pruebas no arrancó a tiempo")
+
+    def peak_rss_kb(self) -> int:
+        """Pico de RSS del proceso principal más el de sus hijos (pool de procesos)"""
+        total = _server_peak_rss_kb(self.process.pid)
+        try:
+            children = open(f"/proc/{self.process.pid}/task/{self.process.pid}/children").read().split()
+        except OSError:
+            children = []
+        return total + sum(_server_peak_rss_kb(int(pid)) for pid in children)
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def _login(url: str) -> str:
+    email = f"bench-{uuid.uuid4().hex[:8]}@example.com"
+    password = "bench-password"
+    _request(url + "/auth/register", json.dumps({"email": email, "password": password}).encode(),
+             "application/json")
+    status, body = _request(url + "/auth/login",
+                            urllib.parse.urlencode({"username": email, "password": password}).encode(),
+                            "application/x-www-form-urlencoded")
+    if status != 200:
+        raise RuntimeError(f"No se pudo iniciar sesión en el servidor de pruebas: {status}")
+    return json.loads(body)["access_token"]
+
+
+def _load(name: str, send, requests: int, concurrency: int, server: LocalServer) -> dict:
+    """Lanzar requests peticiones con concurrency hilos y resumir latencias"""
+    def one(i):
+        start = time.perf_counter()
+        status = send(i)
+        return status, (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(one, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [ms for _, ms in outcomes]
+    statuses = {}
+    for status, _ in outcomes:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    ok = statuses.get("200", 0)
+    return {
+        "endpoint": name,
+        "requests": requests,
+        "concurrency": concurrency,
+        "ok": ok,
+        "status_codes": statuses,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(ok / elapsed, 3) if elapsed else 0.0,
+        "server_peak_rss_kb": server.peak_rss_kb(),
+        **summarize_ms(latencies),
+    }
+
+
+def bench_api(resolution: str, fmt: str, requests: int, concurrency: int) -> list:
+    """Prueba de carga de extremo a extremo de /upload/ y /verify/"""
+    width, height = RESOLUTIONS[resolution]
+    original = encode_input(synthetic_image(width, height), fmt)
+    extension = FORMATS[fmt][0]
+    content_type = "image/jpeg" if fmt == "jpeg" else f"image/{fmt}"
+
+    with tempfile.TemporaryDirectory(prefix="invisignia-bench-") as workdir:
+        server = LocalServer(workdir)
+        try:
+            server.wait_ready()
+            token = _login(server.url)
+            marked = []
+
+            def upload(i):
+                body, ctype = _multipart(
+                    {"purpose": f"benchmark {i}"},
+                    {"file": (f"bench_{i}{extension}", original, content_type)},
+                )
+                status, data = _request(server.url + "/upload/", body, ctype, token)
+                if status == 200:
+                    marked.append(data)
+                return status
+
+            def verify(i):
+                body, ctype = _multipart({}, {"file": ("marked.png", marked[i % len(marked)], "image/png")})
+                return _request(server.url + "/verify/", body, ctype, token)[0]
+
+            results = []
+            for name, send in (("/upload/", upload), ("/verify/", verify)):
+                if name == "/verify/" and not marked:
+                    break
+                row = _load(name, send, requests, concurrency, server)
+                row.update(resolution=resolution, format=fmt, input_bytes=len(original))
+                results.append(row)
+                print(f"{name:10s} {resolution:>6s} {fmt:5s} {row['throughput_rps']:7.2f} req/s "
+                      f"p50={row['p50_ms']:9.2f}ms p99={row['p99_ms']:9.2f}ms "
+                      f"rss={row['server_peak_rss_kb'] // 1024}MB codes={row['status_codes']}")
+            return results
+        finally:
+            server.stop()
+
+
+# Modo de arranque -> (lanzador, variables de entorno)
+STARTUP_MODES = {
+    "uvicorn-cold": ("uvicorn", {"WARMUP_ENABLED": "false"}),
+    "uvicorn": ("uvicorn", {}),
+    "serve": ("serve", {"WEB_CONCURRENCY": "2"}),
+}
+
+
+def _startup_metrics(url: str) -> dict:
+    """Fases de invisignia_startup_seconds de /metrics (del worker que responda)"""
+    _, body = _request(url + "/metrics")
+    phases = {}
+    for line in body.decode().splitlines():
+        if line.startswith("invisignia_startup_seconds{"):
+            phase = line.split('"')[1]
+            phases[f"{phase}_s"] = round(float(line.rsplit(" ", 1)[1]), 3)
+    return phases
+
+
+def bench_startup(resolution: str, fmt: str) -> list:
+    """Tiempo hasta el primer /health correcto y latencia de la primera subida por modo"""
+    width, height = RESOLUTIONS[resolution]
+    original = encode_input(synthetic_image(width, height), fmt)
+    content_type = "image/jpeg" if fmt == "jpeg" else f"image/{fmt}"
+
+    results = []
+    for mode, (launcher, env) in STARTUP_MODES.items():
+        with tempfile.TemporaryDirectory(prefix="invisignia-bench-") as workdir:
+            server = LocalServer(workdir, launcher, env)
+            try:
+                server.wait_ready(poll=0.02)
+                healthy = time.perf_counter() - server.started
+                row = {"mode": mode, "healthy_s": round(healthy, 3), **_startup_metrics(server.url)}
+                token = _login(server.url)
+                for name in ("first_upload_ms", "second_upload_ms"):
+                    body, ctype = _multipart(
+                        {"purpose": "benchmark"}, {"file": (f"bench{FORMATS[fmt][0]}", original, content_type)}
+                    )
+                    start = time.perf_counter()
+                    _request(server.url + "/upload/", body, ctype, token)
+                    row[name] = round((time.perf_counter() - start) * 1000, 2)
+                row.update(resolution=resolution, format=fmt, server_peak_rss_kb=server.peak_rss_kb())
+                results.append(row)
+                print(f"{mode:13s} healthy={row['healthy_s']:6.2f}s import={row.get('import_s', 0):5.2f}s "
+                      f"first_upload={row['first_upload_ms']:8.2f}ms second={row['second_upload_ms']:8.2f}ms")
+            finally:
+                server.stop()
+    return results
+
+
+# --- Resultados --------------------------------------------------------------
+
+def environment_info() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": commit or None,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+    }
+
+
+def _key(row: dict):
+    return (row.get("function") or row.get("endpoint"), row["resolution"], row["format"])
+
+
+def compare_results(current: dict, baseline: dict, threshold: float) -> list:
+    """Filas cuyo p50 empeora más que threshold (fracción) respecto a la base"""
+    base_rows = {_key(r): r for section in ("engine", "api") for r in baseline.get(section, [])}
+    regressions = []
+    for section in ("engine", "api"):
+        for row in current.get(section, []):
+            base = base_rows.get(_key(row))
+            if not base or not base["p50_ms"]:
+                continue
+            change = row["p50_ms"] / base["p50_ms"] - 1
+            marker = "REGRESIÓN" if change > threshold else ""
+            print(f"{' '.join(_key(row)):50s} {base['p50_ms']:9.2f}ms -> {row['p50_ms']:9.2f}ms "
+                  f"({change:+.1%}) {marker}")
+            if change > threshold:
+                regressions.append({"key": list(_key(row)), "baseline_p50_ms": base["p50_ms"],
+                                    "p50_ms": row["p50_ms"], "change": round(change, 4)})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks de Invisignia")
+    parser.add_argument("suite", choices=["engine", "api", "startup", "all"])
+    parser.add_argument("--resolutions", default=",".join(RESOLUTIONS),
+                        help="Lista separada por comas (%(default)s)")
+    parser.add_argument("--formats", default=",".join(FORMATS), help="Lista separada por comas (%(default)s)")
+    parser.add_argument("--repeat", type=int, default=5, help="Repeticiones por caso del motor")
+    parser.add_argument("--api-resolution", default="1080p")
+    parser.add_argument("--api-format", default="jpeg")
+    parser.add_argument("--requests", type=int, default=40, help="Peticiones por endpoint")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--output", help="Fichero JSON de resultados (por defecto bench-<fecha>.json)")
+    parser.add_argument("--compare", help="JSON de una ejecución anterior para detectar regresiones")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="Empeoramiento del p50 que cuenta como regresión (%(default)s = 10%%)")
+    args = parser.parse_args()
+
+    resolutions = [r for r in args.resolutions.split(",") if r]
+    formats = [f for f in args.formats.split(",") if f]
+    for res in resolutions + [args.api_resolution]:
+        if res not in RESOLUTIONS:
+            parser.error(f"Resolución desconocida: {res}")
+    for fmt in formats + [args.api_format]:
+        if fmt not in FORMATS:
+            parser.error(f"Formato desconocido: {fmt}")
+
+    results = {
+        "environment": environment_info(),
+        "config": {
+            "resolutions": resolutions,
+            "formats": formats,
+            "repeat": args.repeat,
+            "api_resolution": args.api_resolution,
+            "api_format": args.api_format,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+        },
+    }
+    if args.suite in ("engine", "all"):
+        results["engine"] = bench_engine(resolutions, formats, args.repeat)
+    if args.suite in ("api", "all"):
+        results["api"] = bench_api(args.api_resolution, args.api_format, args.requests, args.concurrency)
+    if args.suite in ("startup", "all"):
+        results["startup"] = bench_startup(args.api_resolution, args.api_format)
+
+    exit_code = 0
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        results["regressions"] = compare_results(results, baseline, args.threshold)
+        exit_code = 1 if results["regressions"] else 0
+
+    output = args.output or f"bench-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Resultados guardados en {output}")
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Marcar en bloque un árbol de imágenes del disco, sin pasar por la API.
+
+Uso: python bulk_mark.py RAÍZ --email usuario@ejemplo.com --purpose "Catálogo 2024"
+         [--output DIR] [--workers N] [--journal FICHERO] [--retry-failed]  (desde api/)
+
+Las salidas se escriben junto a cada entrada ("foto.jpg_marked.png") o, con
+--output, en un árbol espejo. Las marcas se registran a nombre del usuario
+en DATABASE_URL por lotes. El diario (por defecto .bulk_journal.db en el
+directorio de salida) permite cortar con Ctrl+C y reanudar con la misma
+orden sin repetir los ficheros terminados.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from app.core.logging import setup_logging
+from app.database import SessionLocal, engine
+from app.models import User
+from app.utils.bulk import BulkRun, JournalLockedError
+from app.utils.encoding import ENCODING_PROFILES
+
+logger = logging.getLogger("app.bulk")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Marcar en bloque las imágenes de un directorio")
+    parser.add_argument("root", help="Directorio con las imágenes (se recorre entero)")
+    parser.add_argument("--email", required=True, help="Usuario a cuyo nombre se registran las marcas")
+    parser.add_argument("--purpose", required=True, help="Propósito de todas las marcas")
+    parser.add_argument("--output", help="Árbol espejo para las salidas (por defecto, junto a las entradas)")
+    parser.add_argument("--suffix", default="_marked", help="Sufijo del nombre de las salidas")
+    parser.add_argument("--profile", default="png-fast", choices=sorted(ENCODING_PROFILES))
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--journal", help="Diario para reanudar (por defecto .bulk_journal.db en la salida)")
+    parser.add_argument("--db-batch", type=int, default=500, help="Marcas por INSERT")
+    parser.add_argument("--retry-failed", action="store_true", help="Reintentar los ficheros que fallaron")
+    args = parser.parse_args()
+
+    setup_logging()
+    root = os.path.abspath(args.root)
+    if not os.path.isdir(root):
+        parser.error(f"No existe el directorio {args.root}")
+    output_root = os.path.abspath(args.output) if args.output else None
+    if output_root == root:
+        output_root = None
+    if not args.purpose.strip() or len(args.purpose) > 255:
+        parser.error("El propósito es obligatorio y no puede superar los 255 caracteres")
+
+    db = SessionLocal()
+    try:
+        user = db.query(User).filter(User.email == args.email).first()
+    finally:
+        db.close()
+    if user is None:
+        parser.error(f"No existe el usuario {args.email}")
+
+    journal = args.journal or os.path.join(output_root or root, ".bulk_journal.db")
+    try:
+        run = BulkRun(
+            root, user.id, args.purpose, journal,
+            output_root=output_root, suffix=args.suffix, profile=args.profile,
+            workers=args.workers, db_batch=args.db_batch, retry_failed=args.retry_failed,
+        )
+    except JournalLockedError as e:
+        parser.exit(1, f"{e}\n")
+    summary = run.run()
+    engine.dispose()
+
+    logger.info("Marcado en bloque terminado", extra=summary)
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    return 130 if summary["interrupted"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,15 +1,41 @@
-from fastapi import FastAPI
+import time
+# Inicio de la importación (serve.py lo importa antes de hacer fork y los workers lo heredan)
+import_started = time.perf_counter()
+
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from app.database import engine, Base
-import app.models
+from fastapi.responses import PlainTextResponse
+from app.database import create_schema, dispose_engines, get_async_sessionmaker
 from app.routes.watermark import router as watermark_router
 from app.routes.auth import router as auth_router
+from app.routes.jobs import router as jobs_router
+from app.routes.video import router as video_router
+from app.routes.large import router as large_router
+from app.core.config import settings
+from app.core.logging import setup_logging
+from app.utils.executor import shutdown_executor
+from app.utils.jobs import run_inline_worker
+from app.utils.preflight import UploadLimitMiddleware
+from app.utils.metrics import (
+    REQUEST_SECONDS, STARTUP_SECONDS, observe_stages, render_metrics, server_timing, stage_totals,
+    start_timings
+)
+from app.utils.warmup import preload, warm_up_executor
+import asyncio
+import hmac
+import ipaddress
+import logging
 import os
 
-Base.metadata.create_all(bind=engine)
+setup_logging()
+logger = logging.getLogger("app.startup")
+access_logger = logging.getLogger("app.access")
 
 app = FastAPI(title="Invisignia API", version="1.0.0")
 
+# Sin esquema en la importación: lo crea migrate.py o el arranque si AUTO_MIGRATE está activo
+STARTUP_SECONDS.set(time.perf_counter() - import_started, "import")
+
 environment = os.getenv("ENVIRONMENT", "development")
 
 if environment == "production":
@@ -27,6 +53,15 @@ else:
         "*"  # Solo en desarrollo
     ]
 
+# Cortar subidas demasiado grandes mientras llegan, sin esperar al formulario completo
+app.add_middleware(UploadLimitMiddleware, paths=["/upload/", "/test/", "/jobs/"])
+app.add_middleware(
+    UploadLimitMiddleware, paths=["/upload/video/", "/verify/video/"], max_bytes=settings.video_max_bytes
+)
+app.add_middleware(
+    UploadLimitMiddleware, paths=["/upload/large/", "/verify/large/"], max_bytes=settings.tiled_max_bytes
+)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=allowed_origins,
@@ -35,8 +70,85 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def observe_request(request: Request, call_next):
+    """Medir la petición y sus etapas: histogramas, Server-Timing y log de acceso"""
+    timings = start_timings()
+    start = time.perf_counter()
+    response = None
+    try:
+        response = await call_next(request)
+        return response
+    finally:
+        total = time.perf_counter() - start
+        status = response.status_code if response is not None else 500
+        # Plantilla de la ruta (/jobs/{job_id}) para no crear una serie por id
+        route = request.scope.get("route")
+        route_path = getattr(route, "path", "unmatched")
+
+        observe_stages(timings)
+        REQUEST_SECONDS.observe(total, request.method, route_path, str(status))
+        if response is not None and settings.server_timing_enabled:
+            response.headers["Server-Timing"] = server_timing(timings, total)
+
+        access_logger.info(
+            "%s %s %d", request.method, request.url.path, status,
+            extra={
+                "method": request.method,
+                "route": route_path,
+                "status": status,
+                "duration_ms": round(total * 1000, 2),
+                "stages_ms": {name: round(seconds * 1000, 2) for name, seconds in stage_totals(timings).items()},
+            }
+        )
+
 app.include_router(auth_router)
 app.include_router(watermark_router)
+app.include_router(jobs_router)
+app.include_router(video_router)
+app.include_router(large_router)
+
+job_workers = []
+
+@app.on_event("startup")
+async def startup():
+    if settings.auto_migrate:
+        start = time.perf_counter()
+        create_schema()
+        STARTUP_SECONDS.set(time.perf_counter() - start, "migrate")
+
+    # Con DATABASE_ASYNC, una URL sin driver asíncrono debe fallar al arrancar y no en la primera petición
+    if settings.database_async:
+        get_async_sessionmaker()
+
+    # Calentar antes de aceptar conexiones: /health no responde hasta que el worker está listo
+    if settings.warmup_enabled:
+        try:
+            preload()
+            STARTUP_SECONDS.set(await warm_up_executor(), "warmup")
+        except Exception:
+            logger.exception("Falló el calentamiento; el worker arranca en frío")
+
+    # Workers de trabajos dentro de la API; con 0 se usan solo workers externos (worker.py)
+    for _ in range(settings.jobs_inline_workers):
+        job_workers.append(asyncio.create_task(run_inline_worker()))
+
+    ready = time.perf_counter() - import_started
+    STARTUP_SECONDS.set(ready, "ready")
+    logger.info(
+        "Worker listo",
+        extra={"pid": os.getpid(), **{
+            phase: round(STARTUP_SECONDS.value(phase), 3) for phase in ("import", "migrate", "warmup", "ready")
+        }}
+    )
+
+@app.on_event("shutdown")
+async def shutdown():
+    for task in job_workers:
+        task.cancel()
+    job_workers.clear()
+    shutdown_executor()
+    await dispose_engines()
 
 @app.get("/")
 def read_root():
@@ -46,6 +158,34 @@ def read_root():
         "version": "1.0.0"
     }
 
+def _metrics_allowed(request: Request) -> bool:
+    """Token de /metrics o IP del cliente dentro de METRICS_ALLOWED_IPS"""
+    if settings.metrics_token:
+        scheme, _, token = request.headers.get("authorization", "").partition(" ")
+        if scheme.lower() == "bearer" and hmac.compare_digest(token.encode(), settings.metrics_token.encode()):
+            return True
+    try:
+        client = ipaddress.ip_address(request.client.host if request.client else "")
+    except ValueError:
+        return False
+    for allowed in settings.metrics_allowed_ips:
+        try:
+            if client in ipaddress.ip_network(allowed, strict=False):
+                return True
+        except ValueError:
+            logger.warning("METRICS_ALLOWED_IPS: entrada no válida %r", allowed)
+    return False
+
+@app.get("/metrics", include_in_schema=False)
+def metrics(request: Request):
+    """Histogramas de etapas y peticiones en formato de texto de Prometheus (por proceso)"""
+    if not settings.metrics_enabled:
+        return PlainTextResponse("", status_code=404)
+    # Tráfico por ruta, colas y tiempos: no se exponen a cualquiera
+    if not _metrics_allowed(request):
+        return PlainTextResponse("", status_code=403)
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 @app.get("/health")
 def health_check():
     return {"status": "healthy"}
\ No newline at end of file
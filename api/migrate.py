@@ -0,0 +1,18 @@
+"""Crear las tablas e índices que falten en DATABASE_URL.
+
+Uso: python migrate.py  (desde api/, antes de arrancar la API con AUTO_MIGRATE=false)
+Es idempotente: se puede ejecutar en cada despliegue.
+"""
+import logging
+import time
+from app.core.logging import setup_logging
+from app.database import create_schema, engine
+
+if __name__ == "__main__":
+    setup_logging()
+    start = time.perf_counter()
+    create_schema()
+    engine.dispose()
+    logging.getLogger("app.migrate").info(
+        "Esquema actualizado", extra={"seconds": round(time.perf_counter() - start, 3)}
+    )
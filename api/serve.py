@@ -0,0 +1,156 @@
+"""Servidor de producción: varios workers de uvicorn pre-forkeados.
+
+Uso: python serve.py [--host 0.0.0.0] [--port 8000] [--workers N]  (desde api/)
+
+El proceso principal importa la aplicación (FastAPI, OpenCV, NumPy, passlib)
+una sola vez, abre el socket y hace fork: los workers arrancan sin repetir
+las importaciones y comparten esas páginas de memoria. Cada worker calienta
+su pool (WARMUP_ENABLED) antes de aceptar conexiones y el principal vuelve a
+lanzar los que mueren. Con AUTO_MIGRATE el esquema se crea aquí una sola
+vez, no en cada worker; en producción se usa migrate.py y AUTO_MIGRATE=false.
+Solo POSIX (usa fork).
+"""
+import argparse
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+# Un worker que muere antes de esto se relanza con espera para no entrar en bucle
+MIN_WORKER_LIFETIME = 5.0
+
+
+def _bind(host: str, port: int, backlog: int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _run_worker(app, sock: socket.socket, log_level: str):
+    """Proceso hijo: uvicorn sobre el socket heredado (el kernel reparte las conexiones)"""
+    import uvicorn
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    config = uvicorn.Config(app, log_level=log_level)
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="API de Invisignia con workers pre-forkeados")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", 8000)))
+    parser.add_argument("--workers", type=int, help="Número de workers (por defecto WEB_CONCURRENCY o uno por CPU)")
+    parser.add_argument("--backlog", type=int, default=2048)
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    # Importar la aplicación entera antes del fork: es lo que no repiten los workers
+    import main as application
+    from app.core.config import settings
+    from app.database import create_schema, engine
+    from app.utils.metrics import STARTUP_SECONDS
+    from app.utils.warmup import preload
+
+    logger = logging.getLogger("app.serve")
+    import_seconds = time.perf_counter() - start
+
+    if settings.auto_migrate:
+        migrate_start = time.perf_counter()
+        create_schema()
+        STARTUP_SECONDS.set(time.perf_counter() - migrate_start, "migrate")
+        settings.auto_migrate = False
+    # Ninguna conexión abierta debe pasar a los hijos
+    engine.dispose()
+    if settings.warmup_enabled:
+        preload()
+
+    cpus = os.cpu_count() or 1
+    workers = max(1, args.workers or settings.web_concurrency or cpus)
+    if "EXECUTOR_WORKERS" not in os.environ:
+        # Repartir las CPU entre los pools de los workers en lugar de multiplicarlas
+        settings.executor_workers = max(1, cpus // workers)
+
+    sock = _bind(args.host, args.port, args.backlog)
+    # Sacar los objetos importados del GC: así no se copian sus páginas en cada worker
+    gc.freeze()
+
+    logger.info(
+        "Aplicación importada, lanzando workers",
+        extra={
+            "workers": workers,
+            "executor_workers": settings.executor_workers,
+            "import_seconds": round(import_seconds, 3),
+            "address": f"{args.host}:{args.port}",
+        }
+    )
+
+    children = {}
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            # Grupo propio: si el worker muere se puede limpiar también su pool de procesos
+            os.setpgid(0, 0)
+            # Salir con sys.exit y no os._exit: los atexit cierran el pool de procesos
+            try:
+                _run_worker(application.app, sock, args.log_level)
+            except Exception:
+                logger.exception("El worker terminó con error")
+                sys.exit(1)
+            sys.exit(0)
+        children[pid] = time.monotonic()
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(workers):
+        spawn()
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = children.pop(pid, None)
+        try:
+            # Procesos del pool que quedaran huérfanos (p. ej. si el worker murió por OOM)
+            os.killpg(pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        if stopping or started is None:
+            continue
+        lifetime = time.monotonic() - started
+        logger.warning(
+            "Worker terminado, se relanza",
+            extra={"pid": pid, "exit_code": os.waitstatus_to_exitcode(status), "lifetime": round(lifetime, 1)}
+        )
+        if lifetime < MIN_WORKER_LIFETIME:
+            time.sleep(MIN_WORKER_LIFETIME - lifetime)
+        if not stopping:
+            spawn()
+
+    sock.close()
+    logger.info("Servidor detenido")
+
+
+if __name__ == "__main__":
+    main()
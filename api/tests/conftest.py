@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# La configuración se lee al importar app.core.config: fijar el entorno antes
+_tmp = tempfile.mkdtemp(prefix="invisignia-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_tmp, 'test.db')}")
+os.environ.setdefault("JOBS_DIR", os.path.join(_tmp, "jobs"))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,283 @@
+import asyncio
+import types
+from contextlib import asynccontextmanager
+import pytest
+from fastapi.testclient import TestClient
+import main
+from app.database import create_schema
+from app.utils import admission
+from app.utils.admission import AdmissionController, AdmissionRejected
+from app.utils.warmup import warmup_image
+
+
+class Clock:
+    """Reloj de las esperas del controlador (enqueued / mitad de max_wait)"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(admission, "time", types.SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+def _controller(budget=4, user_budget=4, max_wait=10.0, max_queue=8, user_max_queue=4) -> AdmissionController:
+    return AdmissionController(budget, user_budget, max_wait, max_queue, user_max_queue)
+
+
+async def _waiting(controller, user_id, cost, max_wait=None) -> asyncio.Task:
+    """Lanzar un acquire y dejarlo en la cola"""
+    task = asyncio.ensure_future(controller.acquire(user_id, cost, max_wait))
+    await asyncio.sleep(0)
+    assert not task.done()
+    return task
+
+
+def _idle(controller):
+    assert controller.in_use == 0
+    assert not controller._waiters
+    assert not controller._user_in_use and not controller._user_queued
+
+
+def test_grant_and_release_by_weight():
+    async def main():
+        controller = _controller(user_budget=2)
+        assert await controller.acquire(1, 2) == 2
+        assert await controller.acquire(2, 1) == 1
+        assert controller.in_use == 3
+        controller.release(1, 2)
+        controller.release(2, 1)
+        _idle(controller)
+
+    asyncio.run(main())
+
+
+def test_cost_above_user_budget_runs_alone():
+    async def main():
+        controller = _controller(user_budget=2)
+        assert await controller.acquire(1, 50) == 2
+        task = await _waiting(controller, 1, 1)
+        controller.release(1, 2)
+        assert await task == 1
+        controller.release(1, 1)
+        _idle(controller)
+
+    asyncio.run(main())
+
+
+def test_small_request_overtakes_big_one_that_does_not_fit(clock):
+    async def main():
+        controller = _controller()
+        await controller.acquire(1, 3)
+        big = await _waiting(controller, 2, 4)
+
+        # Cabe en el hueco que queda: no espera detrás de la grande
+        assert await controller.acquire(3, 1) == 1
+        controller.release(3, 1)
+        controller.release(1, 3)
+        assert await big == 4
+        controller.release(2, 4)
+        _idle(controller)
+
+    asyncio.run(main())
+
+
+def test_big_request_stops_overtaking_after_half_max_wait(clock):
+    async def main():
+        controller = _controller(max_wait=10.0)
+        await controller.acquire(1, 3)
+        big = await _waiting(controller, 2, 4)
+
+        clock.now += 5.0
+        small = await _waiting(controller, 3, 1)
+
+        # Al soltar, pasa primero la grande; la pequeña espera a que termine
+        controller.release(1, 3)
+        assert await big == 4
+        await asyncio.sleep(0)
+        assert not small.done()
+        controller.release(2, 4)
+        assert await small == 1
+        controller.release(3, 1)
+        _idle(controller)
+
+    asyncio.run(main())
+
+
+def test_user_over_budget_does_not_block_others(clock):
+    async def main():
+        controller = _controller(user_budget=2)
+        await controller.acquire(1, 2)
+        own = await _waiting(controller, 1, 1)
+
+        # La del usuario 1 no cabe por su propio presupuesto: no bloquea a nadie
+        clock.now += 60.0
+        assert await controller.acquire(2, 2) == 2
+        controller.release(2, 2)
+        controller.release(1, 2)
+        assert await own == 1
+        controller.release(1, 1)
+        _idle(controller)
+
+    asyncio.run(main())
+
+
+def test_timeout_on_global_budget_is_503_with_retry_after():
+    async def main():
+        controller = _controller(budget=1, user_budget=1)
+        await controller.acquire(1, 1)
+        with pytest.raises(AdmissionRejected) as e:
+            await controller.acquire(2, 1, max_wait=0.01)
+        controller.release(1, 1)
+        _idle(controller)
+        return e.value
+
+    rejected = asyncio.run(main())
+    assert rejected.status_code == 503
+    assert rejected.headers["Retry-After"] == str(rejected.retry_after)
+    assert 1 <= rejected.retry_after <= 60
+
+
+def test_timeout_on_user_budget_is_429():
+    async def main():
+        controller = _controller(user_budget=1)
+        await controller.acquire(1, 1)
+        with pytest.raises(AdmissionRejected) as e:
+            await controller.acquire(1, 1, max_wait=0.01)
+        controller.release(1, 1)
+        _idle(controller)
+        return e.value
+
+    assert asyncio.run(main()).status_code == 429
+
+
+def test_full_queues_reject_without_waiting():
+    async def main():
+        controller = _controller(budget=1, user_budget=1, max_queue=2, user_max_queue=1)
+        await controller.acquire(1, 1)
+        queued = [await _waiting(controller, 1, 1), await _waiting(controller, 2, 1)]
+
+        with pytest.raises(AdmissionRejected) as user_full:
+            await controller.acquire(1, 1)
+        with pytest.raises(AdmissionRejected) as global_full:
+            await controller.acquire(3, 1)
+        assert len(controller._waiters) == 2
+
+        for task in queued:
+            task.cancel()
+        await asyncio.gather(*queued, return_exceptions=True)
+        controller.release(1, 1)
+        _idle(controller)
+        return user_full.value.status_code, global_full.value.status_code
+
+    assert asyncio.run(main()) == (429, 503)
+
+
+def test_grant_racing_the_timeout_keeps_the_slot(monkeypatch):
+    async def main():
+        controller = _controller(budget=1, user_budget=1)
+        await controller.acquire(1, 1)
+
+        @asynccontextmanager
+        async def granted_as_it_expires(delay):
+            # El hueco llega en la misma vuelta del bucle en que vence el plazo
+            controller.release(1, 1)
+            yield
+            raise asyncio.TimeoutError
+
+        monkeypatch.setattr(admission.asyncio, "timeout", granted_as_it_expires)
+        assert await controller.acquire(2, 1) == 1
+        monkeypatch.undo()
+
+        assert controller.in_use == 1 and not controller._waiters
+        controller.release(2, 1)
+        _idle(controller)
+
+    asyncio.run(main())
+
+
+def test_cancel_while_waiting_leaves_the_queue():
+    async def main():
+        controller = _controller(budget=1, user_budget=1)
+        await controller.acquire(1, 1)
+        task = await _waiting(controller, 2, 1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        controller.release(1, 1)
+        _idle(controller)
+
+    asyncio.run(main())
+
+
+def test_cancel_after_grant_releases_the_slot():
+    async def main():
+        controller = _controller(budget=1, user_budget=1)
+        await controller.acquire(1, 1)
+        task = await _waiting(controller, 2, 1)
+
+        # Se concede y el cliente se va antes de que la tarea lo vea
+        controller.release(1, 1)
+        assert controller.in_use == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        _idle(controller)
+
+    asyncio.run(main())
+
+
+def test_admit_releases_on_error_and_can_be_disabled(monkeypatch):
+    async def main():
+        controller = _controller(budget=1, user_budget=1)
+        with pytest.raises(RuntimeError):
+            async with controller.admit(1, 1):
+                assert controller.in_use == 1
+                raise RuntimeError("falló")
+        _idle(controller)
+
+        await controller.acquire(1, 1)
+        monkeypatch.setattr(admission.settings, "admission_enabled", False)
+        # Desactivado: no espera aunque el presupuesto esté lleno
+        async with controller.admit(2, 1, max_wait=0.01):
+            assert controller.in_use == 1
+
+    asyncio.run(main())
+
+
+@pytest.fixture(scope="module")
+def client():
+    # Sin el contexto de TestClient: ni warmup ni workers inline
+    create_schema()
+    client = TestClient(main.app)
+    client.post("/auth/register", json={"email": "admision@example.com", "password": "pw"})
+    token = client.post("/auth/login", data={"username": "admision@example.com", "password": "pw"}).json()["access_token"]
+    client.headers["Authorization"] = f"Bearer {token}"
+    return client
+
+
+@pytest.mark.parametrize("path,content_type", [
+    ("/upload/large/", "image/png"),
+    ("/verify/large/", "image/png"),
+    ("/upload/video/", "video/x-msvideo"),
+    ("/verify/video/", "video/x-msvideo"),
+    ("/jobs/", "image/png"),
+])
+def test_heavy_routes_wait_for_the_shared_budget(client, monkeypatch, path, content_type):
+    controller = _controller(budget=1, user_budget=1, max_wait=0.05)
+    # Otro usuario ocupa todo el presupuesto
+    asyncio.run(controller.acquire(999999, 1))
+    monkeypatch.setattr(admission, "_controller", controller)
+
+    r = client.post(path, files={"file": ("f", warmup_image(720), content_type)}, data={"purpose": "Pruebas"})
+
+    assert r.status_code == 503
+    assert "Retry-After" in r.headers
+    controller.release(999999, 1)
+    _idle(controller)
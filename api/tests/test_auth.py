@@ -0,0 +1,63 @@
+import asyncio
+import time
+import pytest
+from fastapi.testclient import TestClient
+import main
+from app.routes import auth
+from app.utils.auth import PrincipalCache
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(main.app) as c:
+        yield c
+
+
+def _off_loop(func, calls):
+    def wrapper(*args):
+        # En el threadpool no hay event loop corriendo en el hilo
+        with pytest.raises(RuntimeError):
+            asyncio.get_running_loop()
+        calls.append(func.__name__)
+        return func(*args)
+    return wrapper
+
+
+def test_register_and_login_query_off_the_event_loop(client, monkeypatch):
+    calls = []
+    monkeypatch.setattr(auth, "_find_user", _off_loop(auth._find_user, calls))
+    monkeypatch.setattr(auth, "_create_user", _off_loop(auth._create_user, calls))
+
+    r = client.post("/auth/register", json={"email": "auth@example.com", "password": "pw"})
+    assert r.status_code == 200
+    r = client.post("/auth/register", json={"email": "auth@example.com", "password": "pw"})
+    assert r.status_code == 400
+    r = client.post("/auth/login", data={"username": "auth@example.com", "password": "pw"})
+    assert r.status_code == 200 and r.json()["access_token"]
+    r = client.post("/auth/login", data={"username": "auth@example.com", "password": "mal"})
+    assert r.status_code == 401
+
+    assert calls == ["_find_user", "_create_user", "_find_user", "_find_user", "_find_user"]
+
+
+def test_invalidate_drops_every_entry_of_a_user():
+    cache = PrincipalCache(ttl=60, max_entries=10)
+    exp = int(time.time()) + 600
+    cache.set(1, exp, "usuario 1")
+    cache.set(1, exp + 1, "usuario 1, otro token")
+    cache.set(2, exp, "usuario 2")
+
+    cache.invalidate(1)
+
+    assert cache.get(1, exp) is None and cache.get(1, exp + 1) is None
+    assert cache.get(2, exp) == "usuario 2"
+
+
+def test_creating_a_user_invalidates_its_id(client, monkeypatch):
+    invalidated = []
+    monkeypatch.setattr(auth.principal_cache, "invalidate", invalidated.append)
+
+    r = client.post("/auth/register", json={"email": "nuevo@example.com", "password": "pw"})
+
+    assert r.status_code == 200
+    assert invalidated == [r.json()["id"]]
@@ -0,0 +1,119 @@
+import asyncio
+import io
+import json
+import zipfile
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+import main
+from app.database import SessionLocal
+from app.models import Watermark
+from app.routes import watermark
+from app.utils.warmup import warmup_image
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(main.app) as c:
+        yield c
+
+
+@pytest.fixture(scope="module")
+def headers(client):
+    client.post("/auth/register", json={"email": "lote@example.com", "password": "pw"})
+    token = client.post("/auth/login", data={"username": "lote@example.com", "password": "pw"}).json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
+
+
+def _batch(client, headers, names):
+    image = warmup_image(720)
+    files = [("files", (name, image, "image/png")) for name in names]
+    r = client.post("/upload/batch/", files=files, data={"purpose": "Lote"}, headers=headers)
+    assert r.status_code == 200
+    archive = zipfile.ZipFile(io.BytesIO(r.content))
+    return archive, json.loads(archive.read("manifest.json"))
+
+
+def _registered(hash_ids):
+    db = SessionLocal()
+    try:
+        return db.execute(select(func.count(Watermark.id)).where(Watermark.hash_id.in_(hash_ids))).scalar()
+    finally:
+        db.close()
+
+
+def test_every_delivered_image_is_registered_first(client, headers, monkeypatch):
+    saved = []
+    save = watermark._save_batch_rows
+
+    def recording_save(user_id, marks):
+        # En el threadpool, no en el event loop
+        with pytest.raises(RuntimeError):
+            asyncio.get_running_loop()
+        saved.extend(hash_id for hash_id, _ in marks)
+        save(user_id, marks)
+
+    monkeypatch.setattr(watermark, "_save_batch_rows", recording_save)
+    archive, manifest = _batch(client, headers, ["a.png", "b.png", "c.png"])
+
+    assert manifest["ok"] == 3
+    assert sorted(archive.namelist()) == ["a_marked.png", "b_marked.png", "c_marked.png", "manifest.json"]
+    assert _registered(saved) == 3
+
+
+def test_failed_commit_withholds_the_images(client, headers, monkeypatch):
+    def failing_save(user_id, marks):
+        raise RuntimeError("base de datos caída")
+
+    monkeypatch.setattr(watermark, "_save_batch_rows", failing_save)
+    archive, manifest = _batch(client, headers, ["a.png", "b.png"])
+
+    # Ninguna imagen marcada sin registrar: solo el manifest, con el motivo
+    assert archive.namelist() == ["manifest.json"]
+    assert manifest["ok"] == 0
+    assert {f["detail"] for f in manifest["files"]} == {"No se pudo registrar la marca"}
+
+
+def test_single_upload_commits_off_the_event_loop(client, headers, monkeypatch):
+    threads = []
+    commit = Session.commit
+
+    def recording_commit(self):
+        with pytest.raises(RuntimeError):
+            asyncio.get_running_loop()
+        threads.append(True)
+        commit(self)
+
+    monkeypatch.setattr(Session, "commit", recording_commit)
+    r = client.post(
+        "/upload/", files={"file": ("a.png", warmup_image(720), "image/png")},
+        data={"purpose": "Suelta"}, headers=headers
+    )
+
+    assert r.status_code == 200
+    assert threads
+
+
+def test_verify_cache_hit_revalidates_off_the_event_loop(client, headers, monkeypatch):
+    calls = []
+    index = watermark.get_watermark_index()
+    last_id = index.last_id
+
+    def recording_last_id(db, user_id):
+        with pytest.raises(RuntimeError):
+            asyncio.get_running_loop()
+        calls.append(user_id)
+        return last_id(db, user_id)
+
+    monkeypatch.setattr(index, "last_id", recording_last_id)
+    # Sin marca: el resultado guardado depende de last_id y se revalida en cada acierto
+    image = warmup_image(720)
+    statuses = []
+    for _ in range(2):
+        r = client.post("/verify/", files={"file": ("a.png", image, "image/png")}, headers=headers)
+        assert r.status_code == 404
+        statuses.append(r.headers["X-Verify-Cache"])
+
+    assert statuses == ["miss", "hit"]
+    assert len(calls) == 2
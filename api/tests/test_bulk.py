@@ -0,0 +1,122 @@
+import os
+import sqlite3
+import uuid
+import pytest
+from sqlalchemy import delete, func, select
+from app.database import SessionLocal, create_schema
+from app.models import User, Watermark
+from app.utils.bulk import ERROR, OK, PENDING, BulkJournal, BulkRun, JournalLockedError, mark_file
+from app.utils.warmup import warmup_image
+
+
+def crashing_mark_file(path, rel_path, base, hash_id, profile):
+    """Como mark_file, pero el worker muere (como con el OOM killer) con los ficheros crash*"""
+    if os.path.basename(path).startswith("crash"):
+        os._exit(1)
+    return mark_file(path, rel_path, base, hash_id, profile)
+
+
+class CrashingRun(BulkRun):
+    task = staticmethod(crashing_mark_file)
+
+
+@pytest.fixture
+def user_id():
+    create_schema()
+    db = SessionLocal()
+    try:
+        user = User(email=f"{uuid.uuid4().hex}@example.com", password="x")
+        db.add(user)
+        db.commit()
+        return user.id
+    finally:
+        db.close()
+
+
+def _tree(root, names):
+    data = warmup_image(720)
+    for name in names:
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+
+def _registered(user_id):
+    db = SessionLocal()
+    try:
+        return db.execute(select(func.count(Watermark.id)).where(Watermark.user_id == user_id)).scalar()
+    finally:
+        db.close()
+
+
+def _journal(path):
+    conn = sqlite3.connect(path)
+    try:
+        return dict(conn.execute("SELECT path, status FROM files").fetchall())
+    finally:
+        conn.close()
+
+
+def test_same_name_different_extension_do_not_collide(tmp_path, user_id):
+    _tree(tmp_path, ["foto.jpg", "foto.png"])
+    journal = str(tmp_path / ".journal.db")
+
+    summary = BulkRun(str(tmp_path), user_id, "p", journal).run()
+
+    assert summary["ok"] == 2
+    assert os.path.exists(tmp_path / "foto.jpg_marked.png")
+    assert os.path.exists(tmp_path / "foto.png_marked.png")
+    # Las salidas de la ejecución anterior no se vuelven a marcar
+    assert BulkRun(str(tmp_path), user_id, "p", journal).run()["skipped"] == 2
+
+
+def test_worker_crash_is_journaled_and_run_continues(tmp_path, user_id):
+    _tree(tmp_path / "in", ["crash.png"] + [f"d{i}.png" for i in range(5)])
+    journal = str(tmp_path / "journal.db")
+
+    summary = CrashingRun(str(tmp_path / "in"), user_id, "p", journal, workers=1).run()
+
+    statuses = _journal(journal)
+    assert statuses["crash.png"] == ERROR
+    assert len(statuses) == 6
+    assert summary["ok"] >= 1 and summary["ok"] + summary["failures"][ERROR] == 6
+    assert _registered(user_id) == summary["ok"]
+    # Al reanudar ya no vuelve a tropezar con él
+    assert CrashingRun(str(tmp_path / "in"), user_id, "p", journal).run()["skipped"] == 6
+
+
+def test_resume_resolves_pending_batch(tmp_path, user_id):
+    _tree(tmp_path / "in", ["a.png", "b.png", "c.png"])
+    journal = str(tmp_path / "journal.db")
+    BulkRun(str(tmp_path / "in"), user_id, "p", journal, output_root=str(tmp_path / "out")).run()
+
+    # Simular un corte entre apuntar el lote como PENDING y terminar el INSERT:
+    # a.png llegó a registrarse, b.png no
+    conn = sqlite3.connect(journal)
+    hashes = dict(conn.execute("SELECT path, hash_id FROM files").fetchall())
+    conn.execute("UPDATE files SET status = ? WHERE path IN ('a.png', 'b.png')", (PENDING,))
+    conn.commit()
+    conn.close()
+    db = SessionLocal()
+    db.execute(delete(Watermark).where(Watermark.hash_id == hashes["b.png"]))
+    db.commit()
+    db.close()
+
+    summary = BulkRun(str(tmp_path / "in"), user_id, "p", journal, output_root=str(tmp_path / "out")).run()
+
+    assert summary["recovered"] == 1
+    assert summary["processed"] == 1 and summary["ok"] == 1
+    assert summary["skipped"] == 2
+    assert set(_journal(journal).values()) == {OK}
+    assert _registered(user_id) == 3
+
+
+def test_journal_allows_one_run_at_a_time(tmp_path):
+    journal = BulkJournal(str(tmp_path / "journal.db"))
+    try:
+        with pytest.raises(JournalLockedError):
+            BulkJournal(str(tmp_path / "journal.db"))
+    finally:
+        journal.close()
+    BulkJournal(str(tmp_path / "journal.db")).close()
@@ -0,0 +1,39 @@
+import pytest
+from sqlalchemy.ext.asyncio import create_async_engine
+from app.database import async_database_url
+
+
+@pytest.mark.parametrize("url, expected", [
+    ("postgresql://u:p@db/invisignia", "postgresql+asyncpg://u:p@db/invisignia"),
+    ("postgres://u:p@db/invisignia", "postgresql+asyncpg://u:p@db/invisignia"),
+    ("postgresql+psycopg2://u:p@db:5432/invisignia", "postgresql+asyncpg://u:p@db:5432/invisignia"),
+    ("postgresql+asyncpg://u:p@db/invisignia", "postgresql+asyncpg://u:p@db/invisignia"),
+    ("postgresql+psycopg2://u:p%40ss@db/invisignia?sslmode=require",
+     "postgresql+asyncpg://u:p%40ss@db/invisignia?ssl=require"),
+    ("postgresql://u:p@db/invisignia?sslmode=verify-full&application_name=api",
+     "postgresql+asyncpg://u:p@db/invisignia?application_name=api&ssl=verify-full"),
+    ("sqlite:///./watermark.db", "sqlite+aiosqlite:///./watermark.db"),
+    ("sqlite+pysqlite:///:memory:", "sqlite+aiosqlite:///:memory:"),
+])
+def test_any_driver_is_rewritten_to_the_async_one(url, expected):
+    assert async_database_url(url) == expected
+
+
+@pytest.mark.parametrize("url", ["mssql+pyodbc://u:p@db/invisignia", "oracle://u:p@db/invisignia"])
+def test_dialect_without_async_driver_fails_clearly(url):
+    with pytest.raises(ValueError, match="DATABASE_ASYNC no admite"):
+        async_database_url(url)
+
+
+def test_rewritten_sqlite_url_builds_an_async_engine(tmp_path):
+    engine = create_async_engine(async_database_url(f"sqlite+pysqlite:///{tmp_path}/t.db"))
+    assert engine.dialect.is_async
+    engine.sync_engine.dispose()
+
+
+def test_rewritten_postgres_url_passes_ssl_to_asyncpg():
+    pytest.importorskip("asyncpg")
+    engine = create_async_engine(async_database_url("postgresql://u:p@db/invisignia?sslmode=require"))
+    _, options = engine.dialect.create_connect_args(engine.url)
+    assert options["ssl"] == "require" and "sslmode" not in options
+    engine.sync_engine.dispose()
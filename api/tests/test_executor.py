@@ -0,0 +1,39 @@
+import asyncio
+import os
+from concurrent.futures.process import BrokenProcessPool
+import pytest
+from fastapi import HTTPException
+from app.routes import watermark
+from app.utils.executor import WatermarkExecutor
+
+
+def test_pool_broken_in_flight_is_shut_down_and_replaced():
+    executor = WatermarkExecutor("process", workers=1, max_queue=1)
+
+    async def main():
+        broken = executor.pool
+        # El worker muere con el trabajo en vuelo (como un OOM)
+        with pytest.raises(BrokenProcessPool):
+            await executor.run(os._exit, 1)
+        assert executor._pool is not broken
+        assert broken._shutdown_thread
+        assert executor.in_flight == 0
+
+        assert await executor.run(abs, -3) == 3
+
+    try:
+        asyncio.run(main())
+    finally:
+        executor.shutdown()
+
+
+def test_run_cpu_maps_broken_pool_to_503(monkeypatch):
+    class BrokenExecutor:
+        async def run(self, func, *args, timeout=None):
+            raise BrokenProcessPool("un worker murió")
+
+    monkeypatch.setattr(watermark, "get_executor", BrokenExecutor)
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(watermark.run_cpu(abs, -3))
+    assert e.value.status_code == 503
+    assert e.value.headers["Retry-After"] == "5"
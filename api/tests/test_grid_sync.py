@@ -0,0 +1,48 @@
+import cv2
+import numpy as np
+import pytest
+from app.utils.dct_watermark import embed_watermark_array
+from app.utils.grid_sync import extract_watermark_synced
+
+HASH = "a5" * 8 + "3c" * 8 + "f0" * 8 + "19" * 8
+
+
+def _marked(rows: int, cols: int) -> np.ndarray:
+    rng = np.random.default_rng(1)
+    noise = (rng.random((rows // 16, cols // 16, 3)) * 255).astype(np.uint8)
+    img = cv2.GaussianBlur(cv2.resize(noise, (cols, rows)), (3, 3), 0)
+    return embed_watermark_array(img, HASH)
+
+
+def _bit_errors(hash_hex: str) -> int:
+    return (int(hash_hex, 16) ^ int(HASH, 16)).bit_count()
+
+
+TRANSFORMS = {
+    "sin_cambios": lambda m: m,
+    "recortada": lambda m: m[m.shape[0] // 8:, m.shape[1] // 10:-m.shape[1] // 12],
+    "con_borde": lambda m: cv2.copyMakeBorder(m, 100, 100, 100, 100, cv2.BORDER_CONSTANT, value=(128, 128, 128)),
+    "ampliada_a_la_derecha": lambda m: cv2.copyMakeBorder(m, 0, 0, 0, 300, cv2.BORDER_REPLICATE),
+    "recortada_y_con_borde": lambda m: cv2.copyMakeBorder(m[50:, 70:], 0, 40, 90, 0, cv2.BORDER_REFLECT),
+}
+
+
+@pytest.mark.parametrize("shape", [(1000, 1000), (700, 1600)])
+@pytest.mark.parametrize("transform", sorted(TRANSFORMS))
+def test_sync_recovers_hash(shape, transform):
+    marked = _marked(*shape)
+    original_cols = extract_watermark_synced(marked).n_cols
+
+    result = extract_watermark_synced(TRANSFORMS[transform](marked))
+
+    assert result.n_cols == original_cols
+    assert _bit_errors(result.hash_hex) == 0
+    assert result.confidence > 0.9
+
+
+def test_sync_bordered_jpeg():
+    marked = cv2.copyMakeBorder(_marked(1000, 1000), 100, 100, 100, 100, cv2.BORDER_CONSTANT)
+    ok, encoded = cv2.imencode(".jpg", marked, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    result = extract_watermark_synced(cv2.imdecode(encoded, cv2.IMREAD_COLOR))
+
+    assert _bit_errors(result.hash_hex) <= 8
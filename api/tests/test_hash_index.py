@@ -0,0 +1,73 @@
+import threading
+from app.utils.dct_watermark import new_hash_id
+from app.utils.hash_index import WatermarkIndex
+
+
+class _Result:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def partitions(self):
+        if self.rows:
+            yield self.rows
+
+
+class FakeDB:
+    """Sesión mínima: devuelve las filas (id, hash) dadas, opcionalmente tras esperar un evento"""
+
+    def __init__(self, rows=(), gate=None):
+        self.rows = list(rows)
+        self.gate = gate
+        self.queries = 0
+
+    def execute(self, statement):
+        self.queries += 1
+        if self.gate is not None:
+            self.gate.wait(5)
+        return _Result(self.rows)
+
+
+def test_slow_query_does_not_block_other_users():
+    index = WatermarkIndex(16)
+    gate = threading.Event()
+    slow = threading.Thread(target=index.sync, args=(FakeDB(gate=gate), 1))
+    slow.start()
+    try:
+        hash_id = new_hash_id("Pruebas")
+        done = threading.Event()
+
+        def other_user():
+            index.nearest(FakeDB([(1, hash_id)]), 2, hash_id)
+            # Ni siquiera el propio usuario 1 espera a la consulta para registrar
+            index.add(1, new_hash_id("Pruebas"))
+            done.set()
+
+        threading.Thread(target=other_user).start()
+        assert done.wait(2)
+    finally:
+        gate.set()
+        slow.join()
+
+
+def test_finds_rows_loaded_since_the_last_sync():
+    index = WatermarkIndex(16)
+    first, second = new_hash_id("Pruebas"), new_hash_id("Pruebas")
+    assert index.nearest(FakeDB([(1, first)]), 7, first) == (first, 0)
+    assert index.last_id(FakeDB([(5, second)]), 7) == 5
+    assert index.nearest(FakeDB(), 7, second) == (second, 0)
+
+
+def test_least_recently_used_partition_is_evicted_and_reloaded():
+    index = WatermarkIndex(16, max_users=2)
+    hashes = {user_id: new_hash_id("Pruebas") for user_id in (1, 2, 3)}
+    for user_id in (1, 2):
+        index.sync(FakeDB([(user_id, hashes[user_id])]), user_id)
+    # Usar el 1 lo deja como el más reciente: se descarta el 2
+    index.sync(FakeDB(), 1)
+    index.sync(FakeDB([(3, hashes[3])]), 3)
+
+    assert len(index) == 2
+    assert index.nearest(FakeDB(), 1, hashes[1]) == (hashes[1], 0)
+    # La partición descartada se vuelve a cargar desde la tabla (aquí, vacía)
+    assert index.nearest(FakeDB(), 2, hashes[2]) is None
+    assert len(index) == 2
@@ -0,0 +1,153 @@
+import asyncio
+import os
+import time
+import pytest
+from app.utils.idempotency import CachedUpload, EmbedCache, InFlight
+
+
+def _entry(size: int, fingerprint: str = "f") -> CachedUpload:
+    return CachedUpload("h" * 64, fingerprint, "image/png", "a_marked.png", {}, b"x" * size)
+
+
+def _dir_bytes(directory) -> int:
+    return sum(os.path.getsize(os.path.join(directory, n)) for n in os.listdir(directory) if n.endswith(".bin"))
+
+
+def _age(directory, key, seconds, ext=(".bin", ".json")):
+    past = time.time() - seconds
+    for e in ext:
+        os.utime(os.path.join(directory, key + e), (past, past))
+
+
+def test_memory_cache_is_lru_bounded_by_bytes():
+    cache = EmbedCache(ttl=60, max_bytes=250)
+    cache.set("a", _entry(100))
+    cache.set("b", _entry(100))
+    assert cache.get("a") is not None  # "a" pasa a ser la más reciente
+    cache.set("c", _entry(100))
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+
+
+def test_memory_cache_expires():
+    cache = EmbedCache(ttl=0.05, max_bytes=1000)
+    cache.set("a", _entry(10))
+    time.sleep(0.1)
+    assert cache.get("a") is None
+
+
+def test_disk_entry_is_shared_between_workers(tmp_path):
+    first = EmbedCache(ttl=60, max_bytes=1000, directory=str(tmp_path))
+    second = EmbedCache(ttl=60, max_bytes=1000, directory=str(tmp_path))
+    first.set("a", _entry(10, "huella"))
+
+    assert second.get("a").fingerprint == "huella"
+
+
+def test_disk_expired_entry_is_deleted_on_read(tmp_path):
+    cache = EmbedCache(ttl=0.05, max_bytes=1000, directory=str(tmp_path))
+    cache.set("a", _entry(10))
+    time.sleep(0.1)
+
+    assert cache.get("a") is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_disk_limit_is_shared_by_all_workers(tmp_path):
+    workers = [EmbedCache(ttl=60, max_bytes=1600, directory=str(tmp_path)) for _ in range(4)]
+    for i in range(200):
+        workers[i % 4].set(f"k{i}", _entry(100))
+
+    # Cada worker puede pasarse como mucho 1/SWEEP_FRACTION del límite entre barridos
+    assert _dir_bytes(tmp_path) <= 1600 * (1 + 4 / EmbedCache.SWEEP_FRACTION)
+    # Y lo más reciente sigue ahí
+    assert workers[0].get("k199") is not None
+
+
+def test_disk_leftovers_are_trimmed_at_startup(tmp_path):
+    old = EmbedCache(ttl=60, max_bytes=10_000, directory=str(tmp_path))
+    for i in range(10):
+        old.set(f"k{i}", _entry(100))
+        _age(tmp_path, f"k{i}", 100 - i, ext=(".bin",))
+    old.get("k0")  # un acierto la convierte en la más reciente
+    open(os.path.join(tmp_path, "muerto.bin.123.tmp"), "wb").close()
+    _age(tmp_path, "muerto.bin.123", 3600, ext=(".tmp",))
+
+    EmbedCache(ttl=60, max_bytes=500, directory=str(tmp_path))
+
+    remaining = sorted(n[:-4] for n in os.listdir(tmp_path) if n.endswith(".bin"))
+    assert remaining == ["k0", "k6", "k7", "k8", "k9"]
+    assert not [n for n in os.listdir(tmp_path) if n.endswith(".tmp")]
+
+
+def test_disk_sweep_removes_expired_and_orphans(tmp_path):
+    cache = EmbedCache(ttl=60, max_bytes=10_000, directory=str(tmp_path))
+    cache.set("viva", _entry(10))
+    cache.set("caducada", _entry(10))
+    _age(tmp_path, "caducada", 120)
+    cache.set("huerfana", _entry(10))
+    os.remove(os.path.join(tmp_path, "huerfana.json"))
+    _age(tmp_path, "huerfana", 120, ext=(".bin",))
+    cache.set("escribiendose", _entry(10))
+    os.remove(os.path.join(tmp_path, "escribiendose.json"))
+
+    cache.sweep()
+
+    assert sorted(os.listdir(tmp_path)) == ["escribiendose.bin", "viva.bin", "viva.json"]
+
+
+def test_inflight_runs_once_and_shares_the_result():
+    calls = []
+
+    async def embed():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "resultado"
+
+    async def main():
+        inflight = InFlight()
+        results = await asyncio.gather(*[inflight.run("k", embed) for _ in range(5)])
+        again = await inflight.run("k", embed)
+        return results, again
+
+    results, again = asyncio.run(main())
+    assert len(calls) == 2
+    assert sorted(shared for _, shared in results) == [False, True, True, True, True]
+    assert all(value == "resultado" for value, _ in results)
+    assert again == ("resultado", False)
+
+
+def test_inflight_propagates_errors_and_releases_the_key():
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("falló")
+
+    async def ok():
+        return "bien"
+
+    async def main():
+        inflight = InFlight()
+        results = await asyncio.gather(inflight.run("k", fail), inflight.run("k", fail), return_exceptions=True)
+        return results, await inflight.run("k", ok)
+
+    results, after = asyncio.run(main())
+    assert all(isinstance(r, ValueError) for r in results)
+    assert after == ("bien", False)
+
+
+def test_inflight_cancelled_leader_does_not_hang_followers():
+    async def slow():
+        await asyncio.sleep(10)
+
+    async def main():
+        inflight = InFlight()
+        leader = asyncio.ensure_future(inflight.run("k", slow))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(inflight.run("k", slow))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(follower, 1)
+
+    asyncio.run(main())
@@ -0,0 +1,218 @@
+import asyncio
+import os
+import uuid
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import func, select
+import main
+from app.database import SessionLocal, create_schema
+from app.routes import jobs as job_routes
+from app.models import User, Watermark
+from app.utils import jobs
+from app.utils.dct_watermark import new_hash_id
+from app.utils.jobs import DONE, FAILED, PROCESSING, QUEUED, JobStore, process_job
+from app.utils.warmup import warmup_image
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    # process_job abre su propio JobStore: cola y ficheros propios de cada test
+    monkeypatch.setattr(jobs.settings, "jobs_dir", str(tmp_path))
+    monkeypatch.setattr(jobs.settings, "jobs_db_path", str(tmp_path / "jobs.db"))
+    store = JobStore()
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def user_id():
+    create_schema()
+    db = SessionLocal()
+    try:
+        user = User(email=f"{uuid.uuid4().hex}@example.com", password="x")
+        db.add(user)
+        db.commit()
+        return user.id
+    finally:
+        db.close()
+
+
+def _claimed(store, user_id):
+    job_id = store.submit(user_id, new_hash_id("Pruebas"), "Pruebas", "foto.png", warmup_image(720))
+    assert store.claim() == job_id
+    return job_id
+
+
+def _registered(hash_id):
+    db = SessionLocal()
+    try:
+        return db.execute(select(func.count(Watermark.id)).where(Watermark.hash_id == hash_id)).scalar()
+    finally:
+        db.close()
+
+
+def test_finish_and_fail_only_touch_running_jobs(store, user_id):
+    job_id = _claimed(store, user_id)
+
+    assert store.fail(job_id, "La imagen tardó demasiado en procesarse")
+    store.set_progress(job_id, "encoding", 0.7)
+    assert not store.finish(job_id)
+    assert not store.fail(job_id, "otro error")
+
+    job = store.get(job_id)
+    assert (job["status"], job["stage"]) == (FAILED, FAILED)
+    assert job["error"] == "La imagen tardó demasiado en procesarse"
+
+
+def test_finish_after_requeue_is_ignored(store, user_id):
+    job_id = _claimed(store, user_id)
+    store.requeue(job_id)
+
+    assert not store.finish(job_id)
+    assert store.get(job_id)["status"] == QUEUED
+
+
+def test_process_job_finishes_running_job(store, user_id):
+    job_id = _claimed(store, user_id)
+    job = store.get(job_id)
+
+    assert process_job(job_id) == DONE
+
+    assert store.get(job_id)["status"] == DONE
+    assert os.path.exists(store.result_path(job_id))
+    assert _registered(job["hash_id"]) == 1
+
+
+def test_late_process_job_does_not_flip_timed_out_job(store, user_id, monkeypatch):
+    job_id = _claimed(store, user_id)
+    job = store.get(job_id)
+    encode = jobs.WatermarkPipeline.encode
+
+    def encode_after_timeout(self, profile):
+        # El worker inline agota su espera y da el trabajo por fallido
+        # mientras el proceso del pool sigue marcando
+        assert store.get(job_id)["status"] == PROCESSING
+        store.fail(job_id, "La imagen tardó demasiado en procesarse")
+        return encode(self, profile)
+
+    monkeypatch.setattr(jobs.WatermarkPipeline, "encode", encode_after_timeout)
+
+    assert process_job(job_id) == FAILED
+
+    assert store.get(job_id)["status"] == FAILED
+    assert not os.path.exists(store.result_path(job_id))
+    assert _registered(job["hash_id"]) == 0
+
+
+@pytest.fixture(scope="module")
+def client():
+    # Sin el contexto de TestClient no arrancan los workers inline: los trabajos quedan en cola
+    client = TestClient(main.app)
+    client.post("/auth/register", json={"email": "trabajos@example.com", "password": "pw"})
+    token = client.post("/auth/login", data={"username": "trabajos@example.com", "password": "pw"}).json()["access_token"]
+    client.headers["Authorization"] = f"Bearer {token}"
+    return client
+
+
+def _post_job(client, data, content_type="image/png"):
+    return client.post("/jobs/", files={"file": ("foto.png", data, content_type)}, data={"purpose": "Pruebas"})
+
+
+def test_submit_is_queued_off_the_event_loop(client, monkeypatch):
+    calls = []
+    submit = job_routes._submit
+
+    def recording_submit(*args):
+        with pytest.raises(RuntimeError):
+            asyncio.get_running_loop()
+        calls.append(args[1])
+        return submit(*args)
+
+    monkeypatch.setattr(job_routes, "_submit", recording_submit)
+    r = _post_job(client, warmup_image(720))
+
+    assert r.status_code == 202
+    assert r.json()["status"] == QUEUED and r.json()["queue_position"] >= 1
+    assert len(calls) == 1
+
+
+def test_submit_runs_the_upload_preflight(client):
+    r = _post_job(client, warmup_image(200))
+    assert r.status_code == 400
+
+
+def test_submit_is_cut_by_the_upload_limit(client, monkeypatch):
+    monkeypatch.setattr(jobs.settings, "max_upload_bytes", 1024)
+    r = _post_job(client, b"\0" * (200 * 1024))
+    assert r.status_code == 413
+
+
+def test_purge_deletes_expired_rows_after_retention(store, user_id, monkeypatch):
+    monkeypatch.setattr(jobs.settings, "jobs_result_ttl", 0)
+    monkeypatch.setattr(jobs.settings, "jobs_expired_retention", 3600)
+    old, recent = _claimed(store, user_id), _claimed(store, user_id)
+    store.fail(old, "falló")
+    store.fail(recent, "falló")
+    store.conn.execute("UPDATE jobs SET expires_at = expires_at - 7200 WHERE id = ?", (old,))
+
+    store.purge()
+
+    # El reciente sigue (410 Caducado); el antiguo ya no existe
+    assert store.get(recent)["status"] == jobs.EXPIRED
+    assert store.get(old) is None
+
+
+def test_inline_worker_keeps_sqlite_off_the_event_loop(store, monkeypatch):
+    calls = []
+
+    def off_loop(name):
+        def call(*args):
+            with pytest.raises(RuntimeError):
+                asyncio.get_running_loop()
+            calls.append(name)
+        return call
+
+    monkeypatch.setattr(store, "claim", off_loop("claim"))
+    monkeypatch.setattr(store, "purge", off_loop("purge"))
+    monkeypatch.setattr(jobs.settings, "jobs_poll_interval", 0.01)
+
+    async def main():
+        worker = asyncio.ensure_future(jobs.run_inline_worker(store))
+        await asyncio.sleep(0.2)
+        worker.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await worker
+
+    asyncio.run(main())
+    assert calls[:2] == ["purge", "claim"] and calls.count("claim") > 1
+
+
+def test_inline_worker_requeues_when_admission_rejects(store, user_id, monkeypatch):
+    job_id = store.submit(user_id, new_hash_id("Pruebas"), "Pruebas", "foto.png", warmup_image(720))
+    ran, requeued = [], []
+    requeue = store.requeue
+
+    class FullBudget:
+        def admit(self, user_id, cost, max_wait=None):
+            raise jobs.AdmissionRejected(503, "Servidor ocupado", 5)
+
+    def recording_requeue(job_id):
+        requeue(job_id)
+        # Estado justo tras devolverlo (el worker lo vuelve a reclamar enseguida)
+        requeued.append(store.get(job_id)["status"])
+
+    monkeypatch.setattr(jobs, "get_admission", FullBudget)
+    monkeypatch.setattr(jobs, "process_job", ran.append)
+    monkeypatch.setattr(store, "requeue", recording_requeue)
+    monkeypatch.setattr(jobs.settings, "jobs_poll_interval", 0.01)
+
+    async def main():
+        worker = asyncio.ensure_future(jobs.run_inline_worker(store))
+        await asyncio.sleep(0.2)
+        worker.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await worker
+
+    asyncio.run(main())
+    assert not ran
+    assert requeued and set(requeued) == {QUEUED}
@@ -0,0 +1,34 @@
+import pytest
+from fastapi.testclient import TestClient
+from starlette.requests import Request
+import main
+
+
+@pytest.fixture
+def client():
+    return TestClient(main.app)
+
+
+def test_metrics_are_refused_to_unknown_clients(client):
+    # TestClient no llega desde una IP local
+    assert client.get("/metrics").status_code == 403
+
+
+def test_metrics_with_token(client, monkeypatch):
+    monkeypatch.setattr(main.settings, "metrics_token", "secreto")
+    assert client.get("/metrics", headers={"Authorization": "Bearer otro"}).status_code == 403
+
+    r = client.get("/metrics", headers={"Authorization": "Bearer secreto"})
+    assert r.status_code == 200
+    assert "# TYPE" in r.text
+
+
+def _request(host):
+    return Request({"type": "http", "method": "GET", "path": "/metrics", "headers": [], "client": (host, 5000)})
+
+
+def test_metrics_from_allowed_network(monkeypatch):
+    monkeypatch.setattr(main.settings, "metrics_allowed_ips", ["10.0.0.0/8", "no-es-una-ip", "::1"])
+    assert main._metrics_allowed(_request("10.1.2.3"))
+    assert main._metrics_allowed(_request("::1"))
+    assert not main._metrics_allowed(_request("192.168.1.5"))
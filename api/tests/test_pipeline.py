@@ -0,0 +1,34 @@
+import cv2
+import numpy as np
+import pytest
+from app.utils import dct_watermark
+from app.utils.dct_watermark import LOSSLESS_FALLBACK_PROFILE, WatermarkPipeline, new_hash_id
+from app.utils.encoding import detect_format
+from app.utils.warmup import warmup_image
+
+
+@pytest.fixture(scope="module")
+def jpeg():
+    img = cv2.imdecode(np.frombuffer(warmup_image(720), np.uint8), cv2.IMREAD_COLOR)
+    return cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 95])[1].tobytes()
+
+
+def test_lossy_output_is_kept_when_the_mark_survives(jpeg, monkeypatch):
+    monkeypatch.setattr(dct_watermark.settings, "min_survival", 0.0)
+    result = WatermarkPipeline(jpeg).run(new_hash_id("Pruebas"), "source")
+
+    assert result.encoding.profile == "source"
+    assert detect_format(result.data) == "jpeg"
+    assert 0.0 <= result.survival <= 1.0
+
+
+def test_lossy_output_falls_back_to_lossless_below_min_survival(jpeg, monkeypatch):
+    # Ninguna salida con pérdidas llega a más de 1.0: siempre recurre al perfil sin pérdidas
+    monkeypatch.setattr(dct_watermark.settings, "min_survival", 1.01)
+    hash_id = new_hash_id("Pruebas")
+    result = WatermarkPipeline(jpeg).run(hash_id, "source")
+
+    assert result.encoding.profile == LOSSLESS_FALLBACK_PROFILE
+    assert result.encoding.lossless and result.survival == 1.0
+    assert detect_format(result.data) == "png"
+    assert dct_watermark.extract_watermark_memory(result.data) == hash_id
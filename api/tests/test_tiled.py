@@ -0,0 +1,75 @@
+import io
+import numpy as np
+import pytest
+from fastapi import HTTPException, UploadFile
+from PIL import Image
+from starlette.datastructures import Headers
+from app.routes.large import _check_large_image
+from app.utils.tiled import TiledSource, is_mappable
+
+
+def _image(fmt: str, **params) -> bytes:
+    rng = np.random.default_rng(2)
+    pixels = rng.integers(40, 216, (700, 700, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, fmt, **params)
+    return buffer.getvalue()
+
+
+def _upload(data: bytes, content_type: str) -> UploadFile:
+    return UploadFile(io.BytesIO(data), size=len(data), headers=Headers({"content-type": content_type}))
+
+
+@pytest.fixture
+def small_opencv_limit(monkeypatch):
+    # 700x700 supera este límite: simula una imagen por encima de CV_IO_MAX_IMAGE_PIXELS
+    monkeypatch.setattr("app.core.config.settings.opencv_max_pixels", 400_000)
+
+
+def test_only_uncompressed_rgb_tiff_is_mappable():
+    assert is_mappable(io.BytesIO(_image("TIFF")))
+    assert not is_mappable(io.BytesIO(_image("TIFF", compression="tiff_lzw")))
+    assert not is_mappable(io.BytesIO(_image("PNG")))
+    assert not is_mappable(io.BytesIO(b"II*\0garbage"))
+
+
+@pytest.mark.parametrize("fmt, params, content_type", [
+    ("PNG", {}, "image/png"),
+    ("TIFF", {"compression": "tiff_lzw"}, "image/tiff"),
+])
+def test_preflight_caps_decoded_formats_at_opencv_limit(small_opencv_limit, fmt, params, content_type):
+    with pytest.raises(HTTPException) as e:
+        _check_large_image(_upload(_image(fmt, **params), content_type))
+    assert e.value.status_code == 413
+
+
+def test_preflight_lets_mappable_tiff_exceed_opencv_limit(small_opencv_limit):
+    upload = _upload(_image("TIFF"), "image/tiff")
+    _check_large_image(upload)
+    assert upload.file.tell() == 0
+
+
+def test_source_refuses_to_decode_above_opencv_limit(small_opencv_limit, tmp_path):
+    png, tiff = tmp_path / "grande.png", tmp_path / "grande.tif"
+    png.write_bytes(_image("PNG"))
+    tiff.write_bytes(_image("TIFF"))
+
+    with pytest.raises(ValueError, match="demasiados píxeles"):
+        TiledSource(str(png))
+
+    source = TiledSource(str(tiff))
+    assert source.mapped and (source.height, source.width) == (700, 700)
+    source.close()
+
+
+def test_decoded_formats_are_capped_well_below_opencv_limit(monkeypatch, tmp_path):
+    # 700x700 cabe en OpenCV pero no en el límite de decodificación
+    monkeypatch.setattr("app.core.config.settings.tiled_decode_max_pixels", 400_000)
+    with pytest.raises(HTTPException) as e:
+        _check_large_image(_upload(_image("TIFF", compression="tiff_deflate"), "image/tiff"))
+    assert e.value.status_code == 413
+
+    bmp = tmp_path / "grande.bmp"
+    bmp.write_bytes(_image("BMP"))
+    with pytest.raises(ValueError, match="demasiado grande"):
+        TiledSource(str(bmp))
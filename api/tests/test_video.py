@@ -0,0 +1,92 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+import pytest
+from app.utils import video
+from app.utils.dct_watermark import bit_survival
+from app.utils.video import VIDEO_CODECS, extract_video_watermark, watermark_video_file
+
+HASH = "a5" * 8 + "3c" * 8 + "f0" * 8 + "19" * 8
+FRAMES = 12
+
+
+@pytest.fixture(scope="module")
+def clip(tmp_path_factory):
+    rng = np.random.default_rng(3)
+    noise = (rng.random((45, 45, 3)) * 255).astype(np.uint8)
+    base = cv2.GaussianBlur(cv2.resize(noise, (720, 720)), (3, 3), 0)
+    path = str(tmp_path_factory.mktemp("video") / "entrada.avi")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 25, (720, 720))
+    for i in range(FRAMES):
+        writer.write(np.roll(base, 4 * i, axis=1))
+    writer.release()
+    return path
+
+
+@pytest.fixture(scope="module")
+def process_pool():
+    pool = ProcessPoolExecutor(2, mp_context=multiprocessing.get_context("spawn"))
+    yield pool
+    pool.shutdown()
+
+
+def _frames(path):
+    cap = cv2.VideoCapture(path)
+    frames = []
+    while True:
+        ok, frame = cap.read()
+        if not ok:
+            break
+        frames.append(frame)
+    cap.release()
+    return frames
+
+
+@pytest.mark.parametrize("codec", sorted(VIDEO_CODECS))
+def test_marks_every_frame_and_reports_survival(clip, tmp_path, codec, monkeypatch):
+    monkeypatch.setattr(video.settings, "min_survival", 0.0)
+    output = str(tmp_path / ("salida" + VIDEO_CODECS[codec][1]))
+    seen = []
+
+    result = watermark_video_file(clip, output, HASH, codec, batch_frames=5, progress=seen.append)
+
+    assert result.frames == FRAMES
+    assert seen[-1] == FRAMES
+    extracted = extract_video_watermark(output).hash_hex
+    if VIDEO_CODECS[codec][3]:
+        assert extracted == HASH
+        assert result.survival == 1.0
+    else:
+        # Medida sobre el fichero escrito, no supuesta
+        assert result.survival == bit_survival(HASH, extracted)
+        assert result.survival > 0.9
+
+
+def test_batches_marked_in_process_pool_are_written_in_order(clip, tmp_path, process_pool):
+    serial, parallel = str(tmp_path / "serie.mkv"), str(tmp_path / "paralelo.mkv")
+    watermark_video_file(clip, serial, HASH, "ffv1")
+
+    # 12 fotogramas en lotes de 2 con 2 workers: 4 lotes en vuelo como mucho
+    result = watermark_video_file(clip, parallel, HASH, "ffv1", pool=process_pool, workers=2, batch_frames=2)
+
+    assert result.frames == FRAMES
+    expected, written = _frames(serial), _frames(parallel)
+    assert len(written) == FRAMES
+    assert all(np.array_equal(a, b) for a, b in zip(expected, written))
+
+
+def test_lossy_codec_below_min_survival_is_refused(clip, tmp_path, monkeypatch):
+    monkeypatch.setattr(video.settings, "min_survival", 1.01)
+    with pytest.raises(ValueError, match="no sobrevive"):
+        watermark_video_file(clip, str(tmp_path / "salida.avi"), HASH, "mjpeg")
+
+
+def test_rejects_too_small_video(tmp_path):
+    path = str(tmp_path / "pequeño.avi")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 25, (160, 120))
+    writer.write(np.zeros((120, 160, 3), np.uint8))
+    writer.release()
+
+    with pytest.raises(ValueError):
+        watermark_video_file(path, str(tmp_path / "salida.mkv"), HASH, "ffv1")
@@ -0,0 +1,11 @@
+"""Worker independiente de trabajos asíncronos.
+
+Uso: python worker.py  (desde api/, con las mismas variables de entorno que la API)
+Arranca tantos como haga falta; comparten la cola SQLite de JOBS_DB_PATH.
+"""
+from app.core.logging import setup_logging
+from app.utils.jobs import run_worker
+
+if __name__ == "__main__":
+    setup_logging()
+    run_worker()